@@ -0,0 +1,630 @@
+# benchmarks for bones.py, each timing the original approach against the one bones uses now
+# run with: python bench_bones.py [name ...]
+# module globals a benchmark changes (ROLL_MODE, RATE_LIMITS, BONES_PORT) are set on bones itself, where the server reads them
+
+import bones
+from bones import *
+
+# original rx parsing: regex over the whole accumulated buffer per packet, remainder copied by slicing
+def regex_unpack(data):
+	packets = []
+	while True:
+		x = re.search('(.*?):(\d*):(.*)', data)
+		if x == None: break
+		command, arg_length, moredata = x.group(1), int(x.group(2)), x.group(3)
+		if len(moredata) < arg_length + 1: break
+		packets.append((command, moredata[:arg_length]))
+		data = moredata[arg_length + 1:]
+	return packets, data
+
+# a burst of small pipelined packets fed in RX_CHUNK_SIZE pieces, as rx would see it
+def benchmark_framing(npackets = 20000):
+	args = str((1, 'RB'))
+	stream = ("handrelay:%d:%s|" % (len(args), args)) * npackets
+	chunks = [stream[i:i + RX_CHUNK_SIZE] for i in xrange(0, len(stream), RX_CHUNK_SIZE)]
+	
+	t0 = time.time()
+	data, n1 = '', 0
+	for chunk in chunks:
+		packets, data = regex_unpack(data + chunk)
+		n1 += len(packets)
+	t1 = time.time()
+	decoder, n2 = FrameDecoder(), 0
+	for chunk in chunks:
+		decoder.feed(chunk)
+		n2 += len(decoder.packets())
+	t2 = time.time()
+	
+	# everything in one recv is where the regex parser goes quadratic
+	t3 = time.time()
+	regex_unpack(stream[:len(stream) / 10])
+	t4 = time.time()
+	decoder = FrameDecoder()
+	decoder.feed(stream[:len(stream) / 10])
+	decoder.packets()
+	t5 = time.time()
+	
+	assert n1 == n2 == npackets
+	print "framing: %d packets in %d byte chunks" % (npackets, RX_CHUNK_SIZE)
+	print "  regex:   %8.1f ms" % ((t1 - t0) * 1000)
+	print "  decoder: %8.1f ms" % ((t2 - t1) * 1000)
+	print "framing: %d packets in a single burst" % (npackets / 10)
+	print "  regex:   %8.1f ms" % ((t4 - t3) * 1000)
+	print "  decoder: %8.1f ms" % ((t5 - t4) * 1000)
+
+# per-message command lookup and argument decoding, eval based vs dispatch table and literal parser
+def benchmark_dispatch(nrounds = 20000):
+	ni = NetworkInterfaceClient(None)
+	messages = [('accepts', '2'),
+				('handrelay', str((1, 'RB'))),
+				('contributionrelay', str((2, 10, 'y'))),
+				('responses', str(((1, 'd'), (2, 'f'), (3, 'c')))),
+				('spoils', str(((2, 20, 'y'), (1, 0, 'y'), (3, 0, 'y')))),
+				('messagerelay', str((3, "it's a 'quote'")))]
+	for command, args in messages[1:]:
+		assert ni.tuple_unpack(args) == eval(args, {'__builtins__':None})
+	
+	t0 = time.time()
+	for i in xrange(nrounds):
+		for command, args in messages:
+			handler = eval('ni.cmd_%s' % command)
+			eval(args, {'__builtins__':None})
+	t1 = time.time()
+	for i in xrange(nrounds):
+		for command, args in messages:
+			handler = ni.handlers[command]
+			ni.tuple_unpack(args)
+	t2 = time.time()
+	
+	nmessages = nrounds * len(messages)
+	print "dispatch: %d messages" % nmessages
+	print "  eval:           %6.2f us/message" % ((t1 - t0) / nmessages * 1e6)
+	print "  table + parser: %6.2f us/message" % ((t2 - t1) / nmessages * 1e6)
+
+# bytes on the wire and decode time for a table's worth of typical broadcasts, text vs binary
+def benchmark_protocol(nplayers = 50, nrounds = 200):
+	ni = NetworkInterfaceClient(None)
+	ids = range(1, nplayers + 1)
+	messages = [('handrelay', (id, 'RB')) for id in ids]
+	messages += [('responses', tuple([(id, 'c') for id in ids]))]
+	messages += [('contributionrelay', (id, 10, 'y')) for id in ids]
+	messages += [('spoils', tuple([(id, 0, 'y') for id in ids]))]
+	
+	for protocol, name in [(PROTOCOL_TEXT, 'text'), (PROTOCOL_BINARY, 'binary')]:
+		stream = ''.join([ni.encode(command, args, protocol) for command, args in messages])
+		t0 = time.time()
+		for i in xrange(nrounds):
+			decoder = FrameDecoder()
+			decoder.feed(stream)
+			for command, args in decoder.packets():
+				ni.tuple_unpack(args)
+		t1 = time.time()
+		print "protocol %-6s: %6d bytes per game, decode %6.2f ms per game" % (name, len(stream), (t1 - t0) / nrounds * 1000)
+
+# a table-wide broadcast to connected socket pairs, encode and blocking send per connection vs encode once into outboxes
+def benchmark_broadcast(nplayers = 50, nmessages = 2000):
+	ni = NetworkInterfaceClient(None)
+	ni.connections = {}
+	ni.startflusher()
+	pairs = [socket.socketpair() for id in xrange(nplayers)]
+	ids = range(1, nplayers + 1)
+	for id, (near, far) in zip(ids, pairs):
+		ni.connections[id] = (None, near, None)
+		ni.outboxes[id] = Outbox(near)
+	
+	# keep the far ends drained so that neither method is held up by a full socket
+	def sink(sock):
+		while sock.recv(65536): pass
+	for near, far in pairs:
+		sinker = threading.Thread(target = sink, args = (far,))
+		sinker.daemon = True
+		sinker.start()
+	
+	args = tuple([(id, 10, 'y') for id in ids])
+	t0 = time.time()
+	for i in xrange(nmessages):
+		for id in ids:
+			ni.connections[id][1].sendall(ni.encode('spoils', args, PROTOCOL_TEXT))
+	t1 = time.time()
+	for i in xrange(nmessages):
+		ni.fanout(ids, 'spoils', args)
+	while any([outbox.nbytes for outbox in ni.outboxes.values()]): time.sleep(0.001)
+	t2 = time.time()
+	
+	print "broadcast: %d messages to %d connections" % (nmessages, nplayers)
+	print "  encode + sendall each: %6.1f us/broadcast" % ((t1 - t0) / nmessages * 1e6)
+	print "  encode once + outbox:  %6.1f us/broadcast" % ((t2 - t1) / nmessages * 1e6)
+	for near, far in pairs: near.close()
+
+# stands in for a connection's Outbox, counting the writes and bytes that would hit the socket
+class CountingOutbox:
+	def __init__(self): self.nwrites, self.nbytes, self.total = 0, 0, 0
+	def put(self, packet):
+		self.nwrites += 1
+		self.total += len(packet)
+		return 0
+	def flush(self): return True
+	def abandon(self): pass
+
+# socket writes and bytes to seat a table's worth of players one after another, newplayer storm vs batched roster
+def benchmark_join(nplayers = 50):
+	logging.disable(logging.CRITICAL)
+	
+	# the original seating: every player is rebroadcast to everyone on each arrival, one write per message
+	def storm(ni, id, tableid):
+		ni.game.seat(id, tableid)
+		table = ni.game.tables[tableid]
+		ni.tx('seated', (table.id, table.name), id)
+		for player in table.players.values():
+			ni.tablecast(table, 'newplayer', (player.getid(), player.getname()))
+	
+	for name in ['newplayer storm', 'batched roster']:
+		game = GameServer()
+		ni = game.ni
+		if name == 'newplayer storm':
+			ni.seat = lambda id, tableid: storm(ni, id, tableid)
+			ni.batched = lambda fn, *args: fn(*args)
+		ni.connections = {}
+		outboxes = [CountingOutbox() for id in xrange(nplayers)]
+		t0 = time.time()
+		for id, outbox in zip(xrange(1, nplayers + 1), outboxes):
+			ni.connections[id] = (None, None, None)
+			ni.outboxes[id] = outbox
+			ni.protocols[id] = PROTOCOL_TEXT # said hello
+			ni.command_handler(id, 'mynameis', 'player%d' % id)
+		t1 = time.time()
+		nwrites = sum([outbox.nwrites for outbox in outboxes])
+		nbytes = sum([outbox.total for outbox in outboxes])
+		print "join %-15s: %6d writes, %7d bytes, %6.1f ms to seat %d players" % (name, nwrites, nbytes, (t1 - t0) * 1000, nplayers)
+	
+	logging.disable(logging.NOTSET)
+
+# one client flooding its table with messages, with and without RATE_LIMITS: what the rest of the table is sent
+def benchmark_flood(nplayers = 50, nmessages = 2000):
+	logging.disable(logging.CRITICAL)
+	limits = bones.RATE_LIMITS
+	for name, ratelimits in [('unlimited', {}), ('rate limited', limits)]:
+		bones.RATE_LIMITS = ratelimits
+		game = GameServer()
+		ni = game.ni
+		ni.connections = {}
+		outboxes = [CountingOutbox() for id in xrange(nplayers)]
+		for id, outbox in zip(xrange(1, nplayers + 1), outboxes):
+			ni.connections[id] = (None, None, None)
+			ni.outboxes[id] = outbox
+			ni.command_handler(id, 'mynameis', 'player%d' % id)
+		nwrites = sum([outbox.nwrites for outbox in outboxes])
+		nbytes = sum([outbox.total for outbox in outboxes])
+		t0 = time.time()
+		for i in xrange(nmessages):
+			ni.command_handler(1, 'message', 'spam')
+		t1 = time.time()
+		nwrites = sum([outbox.nwrites for outbox in outboxes]) - nwrites
+		nbytes = sum([outbox.total for outbox in outboxes]) - nbytes
+		print "flood %-12s: %6d writes, %7d bytes, %6.1f ms for %d messages to %d players" % (name, nwrites, nbytes, (t1 - t0) * 1000, nmessages, nplayers)
+	bones.RATE_LIMITS = limits
+	logging.disable(logging.NOTSET)
+
+# a table playing from wager to denouement under each ROLL_MODE: commands the server handles, socket writes, time
+def benchmark_rounds(nplayers = 6, ngames = 200):
+	logging.disable(logging.CRITICAL)
+	mode, limits = bones.ROLL_MODE, bones.RATE_LIMITS
+	bones.RATE_LIMITS = {} # every game is sent as fast as it can be handled
+	for bones.ROLL_MODE in ['client', 'server', 'batch']:
+		game = GameServer()
+		ni = game.ni
+		ni.connections = {}
+		outboxes = dict([(id, CountingOutbox()) for id in xrange(1, nplayers + 1)])
+		for id, outbox in outboxes.iteritems():
+			ni.connections[id] = (None, None, None)
+			ni.outboxes[id] = outbox
+			ni.protocols[id] = PROTOCOL_TEXT # said hello
+			ni.command_handler(id, 'mynameis', 'player%d' % id)
+		table = game.tables[DEFAULT_TABLE_ID]
+		for outbox in outboxes.values(): outbox.nwrites = 0
+		ncommands = 0
+		
+		t0 = time.time()
+		for i in xrange(ngames):
+			commands = [(1, 'wager', (1, 'y'))] + [(id, 'accept', '') for id in outboxes if id != 1]
+			if bones.ROLL_MODE == 'client': commands += [(id, 'hand', 'RB') for id in outboxes]
+			if bones.ROLL_MODE == 'server': commands += [(id, 'roll', '') for id in outboxes] * 2
+			commands += [(id, 'continue', '') for id in outboxes]
+			if bones.ROLL_MODE == 'client': commands += [(id, 'hand', 'RBG') for id in outboxes]
+			if bones.ROLL_MODE == 'server': commands += [(id, 'roll', '') for id in outboxes]
+			for id, command, args in commands:
+				ni.command_handler(id, command, args)
+			assert table.status == 'denouement'
+			ncommands += len(commands)
+			table.dice = None
+			table.forumreset()
+		t1 = time.time()
+		
+		nwrites = sum([outbox.nwrites for outbox in outboxes.values()])
+		print "rounds %-6s: %5.1f commands handled, %5.1f writes, %6.0f us per game to denouement" % \
+			(bones.ROLL_MODE, float(ncommands) / ngames, float(nwrites) / ngames, (t1 - t0) / ngames * 1e6)
+	bones.ROLL_MODE, bones.RATE_LIMITS = mode, limits
+	logging.disable(logging.NOTSET)
+
+# response phase odds for every 2-roll hand against a table of known 2-roll hands, first query vs memoized
+def benchmark_odds(nplayers = 6, nqueries = 20000):
+	odds = Odds()
+	hands = sorted(set([''.join(sorted(hand)) for hand in itertools.product(DIE_COLORS, repeat = 2)]))
+	tables = [(random.choice(hands), tuple([random.choice(hands) for i in xrange(nplayers - 1)])) for i in xrange(200)]
+	
+	t0 = time.time()
+	for hand, others in tables: odds.against(hand, others)
+	t1 = time.time()
+	for i in xrange(nqueries):
+		hand, others = tables[i % len(tables)]
+		odds.against(hand, others)
+	t2 = time.time()
+	
+	print "odds: %d player tables" % nplayers
+	print "  exact enumeration: %8.1f us/query" % ((t1 - t0) / len(tables) * 1e6)
+	print "  memoized:          %8.1f us/query" % ((t2 - t1) / nqueries * 1e6)
+
+# working out the response strategy for every table vs looking a hint up once it's known
+def benchmark_policy(nqueries = 100000):
+	policy = Policy(Odds())
+	t0 = time.time()
+	policy.table = policy.build()
+	t1 = time.time()
+	tables = policy.table.keys()
+	queries = [(table[0], table[1:]) for table in tables]
+	t2 = time.time()
+	for i in xrange(nqueries):
+		hand, others = queries[i % len(queries)]
+		policy.hint(hand, others)
+	t3 = time.time()
+	
+	print "policy: %d tables of up to %d players" % (len(tables), POLICY_MAX_PLAYERS)
+	print "  solve all: %8.1f s" % (t1 - t0)
+	print "  hint:      %8.1f us/query" % ((t3 - t2) / nqueries * 1e6)
+
+# whole games played out with Player/GameTable one at a time vs the simulator's arrays
+def benchmark_simulate(nplayers = 4, ngames = 20000):
+	table = GameTable(1, 'bench')
+	for id in xrange(1, nplayers + 1):
+		player = Player('player%d' % id)
+		player.setid(id)
+		table.addplayer(player)
+	dice = DiceRNG(0)
+	t0 = time.time()
+	for game in xrange(ngames / 10):
+		table.forumreset()
+		for player in table.playerlist():
+			player.accept()
+			player.roll(dice)
+			player.roll(dice)
+			player.continue_()
+			player.roll(dice)
+		table.calcrankings()
+		table.winners()
+	t1 = time.time()
+	totals = Simulator(['continue'] * nplayers).run(ngames / 100, 100)
+	t2 = time.time()
+	
+	print "simulate: %d player games" % nplayers
+	print "  Player/GameTable: %10.0f games/s" % (ngames / 10 / (t1 - t0))
+	print "  Simulator:        %10.0f games/s" % (totals['games'] / (t2 - t1))
+
+# bytes reachable from objects, each object counted once (classes, functions and modules aren't counted)
+def deepsize(objects):
+	seen = set()
+	size = 0
+	stack = list(objects)
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen or isinstance(obj, (type, types.ClassType, types.ModuleType, types.FunctionType)): continue
+		seen.add(id(obj))
+		size += sys.getsizeof(obj)
+		stack.extend(gc.get_referents(obj))
+	return size
+
+# the original Player: instance dict, hand as a list of one character strings, string statuses
+class LegacyPlayer:
+	def __init__(self, name):
+		self.name = name
+		self.id = 0
+		self.hand = []
+		self.bank = SeedBank()
+		self.acceptstatus = ''
+		self.response = ''
+		self.rank = -1
+		self.contribution = Seeds(0, COLOR_BASE)
+		self.income = Seeds(0, COLOR_BASE)
+	def getscore(self):
+		if self.response == 'f': return FORFEITSCORE
+		elif len(self.hand) - self.hand.count('X') == 2: return LONERSCORE
+		handc = self.hand[:]
+		handc.sort()
+		return CODEBOOK[''.join(handc)]
+
+# memory per seated player mid-game and time to score a hand, original Player vs slotted Player
+def benchmark_player(nplayers = 10000, nscores = 200000):
+	for name, cls in [('original', LegacyPlayer), ('slotted', Player)]:
+		players = []
+		for id in xrange(nplayers):
+			player = cls('player%d' % id)
+			player.id = id
+			for roll in 'RBG':
+				if cls is Player: player.addroll(roll)
+				else: player.hand.append(roll)
+			players.append(player)
+		perplayer = float(deepsize(players) - sys.getsizeof(players)) / nplayers
+		
+		t0 = time.time()
+		for i in xrange(nscores): players[i % nplayers].getscore()
+		t1 = time.time()
+		print "player %-8s: %6.0f bytes per player, %5.2f us/getscore" % (name, perplayer, (t1 - t0) / nscores * 1e6)
+
+# a big table through the wager and round 1, checking for the end of the phase after every player as the server does
+# original full rescans vs the running counts
+def benchmark_phases(nplayers = 500):
+	table = GameTable(1, 'bench')
+	for id in xrange(1, nplayers + 1):
+		player = Player('player%d' % id)
+		player.setid(id)
+		table.addplayer(player)
+	
+	def rescan_respondents(): return sum([p.accepted() for p in table.playerlist()]) + sum([p.rejected() for p in table.playerlist()])
+	def rescan_rolled(): return sum([p.nrolls() == 2 for p in table.playerlist()])
+	def rescan_accepted(): return sum([p.accepted() for p in table.playerlist()])
+	
+	for name, respondents, rolled, accepted in [('rescans', rescan_respondents, rescan_rolled, rescan_accepted),
+												('counts', table.nrespondents, lambda: table.nrolled(2), table.naccepted)]:
+		table.forumreset()
+		t0 = time.time()
+		for player in table.playerlist():
+			player.accept()
+			respondents() == table.nplayers()
+		for player in table.playerlist():
+			player.addroll('R')
+			player.addroll('B')
+			rolled() == accepted()
+		t1 = time.time()
+		print "phases %-7s: %8.1f ms for %d players" % (name, (t1 - t0) * 1000, nplayers)
+
+# the original mutable Seeds, arithmetic through base-color intermediates and in-place convert/optimize
+class LegacySeeds:
+	def __init__(self, count, color):
+		if not isinstance(count, int):
+			raise Exception("Error: non-integer count input to Seeds - %s" % count)
+		if color not in COLORS:
+			raise Exception("Error: invalid color input into Seeds - %s. Try one of these:%s" % (color, ' '.join(COLORS)))
+		self.count = count
+		self.color = color
+	def __cmp__(self, other): return cmp(self.value(), other.value())
+	def __add__(self, other): return self.combine(self.value() + other.value(), other)
+	def __sub__(self, other): return self.combine(self.value() - other.value(), other)
+	def combine(self, value, other):
+		s = LegacySeeds(value, COLOR_BASE)
+		if self.getcolor() == other.getcolor(): s.convert(self.getcolor())
+		else: s.optimize()
+		return s
+	def __mul__(self, n): return LegacySeeds(n * self.getcount(), self.getcolor())
+	def __div__(self, n): return self.fit(int(self.value() / n))
+	def __mod__(self, n): return self.fit(int(self.value() % n))
+	def __divmod__(self, n): return (self/n, self%n)
+	def fit(self, value):
+		result = LegacySeeds(value, COLOR_BASE)
+		if value % COLOR_VAL_LUT[self.getcolor()] == 0: result.convert(self.getcolor())
+		else: result.optimize()
+		return result
+	def getcolor(self): return self.color
+	def getcount(self): return self.count
+	def value(self): return self.count * COLOR_VAL_LUT[self.color]
+	def convert(self, color):
+		count, residual = divmod(self.value(), COLOR_VAL_LUT[color])
+		r = LegacySeeds(residual, self.color)
+		self.color = color
+		self.count = count
+		return r
+	def optimize(self):
+		for value in COLOR_VALS:
+			if self.value() % value == 0:
+				self.convert(COLOR_VAL_INV[value])
+				return
+
+# the currency side of settling games: pot from the wager, summed contributions, shares, everyone's net
+# original Seeds vs immutable Seeds
+def benchmark_seeds(nplayers = 6, ngames = 5000):
+	for name, cls in [('original', LegacySeeds), ('immutable', Seeds)]:
+		t0 = time.time()
+		for game in xrange(ngames):
+			wager = cls(5, 'r')
+			ndoubled, nforfeited = game % 3, game % 2
+			pot = wager * (ndoubled + 1) * nplayers - wager * nforfeited
+			contributions = [wager * (ndoubled + 1) - (wager if i < nforfeited else cls(0, 'r')) for i in xrange(nplayers)]
+			contributions[-1] = cls(contributions[-1].value(), COLOR_BASE) # someone paid in yellows
+			total = contributions[0]
+			for contribution in contributions[1:]:
+				total += contribution
+			share, residue = divmod(total, 2)
+			incomes = [share, share + cls(1, COLOR_BASE)] + [cls(0, 'r')] * (nplayers - 2)
+			nets = [income - contribution for income, contribution in zip(incomes, contributions)]
+			assert pot == total
+		t1 = time.time()
+		print "seeds %-9s: %6.1f us per game settled" % (name, (t1 - t0) / ngames * 1e6)
+
+# the original SeedBank: any shortfall in the requested color flattens the whole bank to yellows and re-optimizes greedily
+class LegacySeedBank(SeedBank):
+	def withdraw(self, seeds, settleforless = True):
+		if self.bank[seeds.getcolor()] >= seeds.getcount():
+			self.bank[seeds.getcolor()] -= seeds.getcount()
+		else:
+			remaining = self.value() - seeds.value()
+			for value in COLOR_VALS:
+				self.bank[COLOR_VAL_INV[value]], remaining = divmod(remaining, value)
+		return seeds
+
+def benchmark_change(nwithdrawals = 20000):
+	rng = random.Random(0)
+	cases = []
+	for i in xrange(nwithdrawals):
+		holdings = dict([(color, rng.randint(0, 12)) for color in COLORS])
+		holdings[COLOR_BASE] += 1
+		value = sum([COLOR_VAL_LUT[color] * count for color, count in holdings.iteritems()])
+		cases.append((holdings, Seeds.ofvalue(rng.randint(1, min(value, 50)), rng.choice(COLORS[:2])))) # wager-sized
+	for name, cls in [('original', LegacySeedBank), ('changemaker', SeedBank)]:
+		banks = []
+		for holdings, seeds in cases:
+			bank = cls()
+			bank.bank = holdings.copy()
+			banks.append(bank)
+		t0 = time.time()
+		for bank, (holdings, seeds) in zip(banks, cases):
+			bank.withdraw(seeds)
+		t1 = time.time()
+		# seeds the holder ends up with that weren't simply left in their purse
+		disturbed = sum([max(0, bank[color] - holdings[color]) for bank, (holdings, seeds) in zip(banks, cases) for color in COLORS])
+		print "change %-11s: %6.1f us per withdrawal, %5.2f seeds changed per withdrawal" % (name, (t1 - t0) / nwithdrawals * 1e6, float(disturbed) / nwithdrawals)
+
+def benchmark_ledger(ntables = 8, ngames = 250):
+	directory = tempfile.mkdtemp()
+	records = [('Player %d' % i, 10, 20 if i == 0 else 0) for i in xrange(4)]
+	for name, nthreads in [('one table', 1), ('%d tables' % ntables, ntables)]:
+		ledger = Ledger(os.path.join(directory, 'ledger%d.log' % nthreads), os.path.join(directory, 'ledger%d.snapshot' % nthreads))
+		ledger.open()
+		def table(tableid):
+			for game in xrange(ngames):
+				ledger.wait(ledger.settle(tableid, records))
+		threads = [threading.Thread(target = table, args = (tableid,)) for tableid in xrange(nthreads)]
+		t0 = time.time()
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		t1 = time.time()
+		print "ledger %-9s: %6.0f games settled per second, %4.1f games per fsync" % \
+			(name, ledger.seq / (t1 - t0), float(ledger.seq) / ledger.nsyncs)
+	
+	t0 = time.time()
+	replayed = Ledger(ledger.logname, ledger.snapshotname)
+	replayed.open()
+	t1 = time.time()
+	assert replayed.balances == ledger.balances
+	print "ledger replay   : %6.1f ms for %d games (snapshot at %d)" % ((t1 - t0) * 1000, replayed.seq, replayed.snapshotseq)
+
+# tables finishing games at once, each settling its own game and waiting on the ledger vs handing them to the SettlementStage
+def benchmark_settlement(ntables = 16, ngames = 100):
+	directory = tempfile.mkdtemp()
+	entries = tuple([(pid, 'Player %d' % pid, Seeds(5, 'r'), pid % 3) for pid in xrange(4)])
+	for name in ['inline', 'stage']:
+		ledger = Ledger(os.path.join(directory, name + '.log'), os.path.join(directory, name + '.snapshot'))
+		ledger.open()
+		stage = SettlementStage(ledger, None)
+		done = dict([(tableid, threading.Event()) for tableid in xrange(ntables)])
+		stage.deliver = lambda tableid, spoils: done[tableid].set()
+		if name == 'stage': stage.start()
+		def table(tableid):
+			for game in xrange(ngames):
+				if name == 'inline':
+					spoils, records = stage.split(entries, ())
+					ledger.wait(ledger.settle(tableid, records))
+				else:
+					done[tableid].clear()
+					stage.submit(tableid, entries, ())
+					done[tableid].wait()
+		threads = [threading.Thread(target = table, args = (tableid,)) for tableid in xrange(ntables)]
+		t0 = time.time()
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		t1 = time.time()
+		if name == 'stage': stage.stop()
+		print "settlement %-6s: %6.0f games settled per second, %4.1f games per fsync" % \
+			(name, ledger.seq / (t1 - t0), float(ledger.seq) / ledger.nsyncs)
+
+# rolls one at a time from the global generator and from a game's DiceRNG, and in bulk for simulations
+def benchmark_dice(nrolls = 200000):
+	t0 = time.time()
+	for i in xrange(nrolls): random.choice(DIE)
+	t1 = time.time()
+	dice = DiceRNG(0)
+	for i in xrange(nrolls): dice.roll(i & 7)
+	t2 = time.time()
+	print "dice global    : %6.2f us per roll" % ((t1 - t0) / nrolls * 1e6)
+	print "dice DiceRNG   : %6.2f us per roll" % ((t2 - t1) / nrolls * 1e6)
+	if numpy is None: return
+	t0 = time.time()
+	rolls = dice.bulk((nrolls / 6, 2, 3))
+	t1 = time.time()
+	assert rolls.size == nrolls / 6 * 6 and 0 <= rolls.min() and rolls.max() < len(DIE)
+	print "dice bulk      : %6.3f us per roll" % ((t1 - t0) / rolls.size * 1e6)
+
+# reaching the one live server among candidates that don't answer (listeners with a stuffed backlog)
+# the original tried each in turn with a 0.3 s timeout, probe tries them all at once
+def benchmark_connect(nconnects = 5):
+	live = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	live.bind(('127.0.0.1', 0))
+	live.listen(nconnects * 2)
+	port = live.getsockname()[1]
+	dead = ['127.0.0.2', '127.0.0.3']
+	stuffed = []
+	for ip in dead:
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.bind((ip, port))
+		listener.listen(0)
+		stuffed += [listener, socket.create_connection((ip, port))]
+	ips = dead + ['127.0.0.1']
+	
+	def sequential():
+		for ip in ips:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.settimeout(0.3)
+			try:
+				sock.connect((ip, port))
+				return sock
+			except socket.error:
+				sock.close()
+	
+	for name, attempt in [('sequential', sequential), ('probe', lambda: probe(list(ips), port, CONNECT_TIMEOUT)[0])]:
+		t0 = time.time()
+		for i in xrange(nconnects):
+			sock = attempt()
+			assert sock.getpeername()[0] == '127.0.0.1'
+			sock.close()
+			live.accept()[0].close()
+		t1 = time.time()
+		print "connect %-10s: %6.1f ms to reach the server" % (name, (t1 - t0) / nconnects * 1000)
+	for sock in stuffed + [live]: sock.close()
+
+# launching a server whose ip discovery takes a second, until a local client gets through
+# the original found and posted its ips before it listened
+def benchmark_startup(delay = 1.0):
+	logging.disable(logging.CRITICAL)
+	port = bones.BONES_PORT
+	for name in ['discover first', 'listen first']:
+		probe_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		probe_socket.bind(('127.0.0.1', 0))
+		bones.BONES_PORT = probe_socket.getsockname()[1]
+		probe_socket.close()
+		
+		ni = GameServer().ni
+		ni.acquire_ips = lambda: time.sleep(delay)
+		ni.post_ips = lambda: None
+		ni.cachedips = lambda: None
+		ni.cacheips = lambda: None
+		t0 = time.time()
+		if name == 'discover first':
+			ni.acquire_ips()
+			ni.post_ips()
+		ni.start()
+		sock = socket.create_connection(('127.0.0.1', bones.BONES_PORT))
+		t1 = time.time()
+		while not ni.connections: time.sleep(0.01) # let the hub finish with it before we move on
+		sock.close()
+		print "startup %-14s: %6.1f ms to the first connection" % (name, (t1 - t0) * 1000)
+	bones.BONES_PORT = port
+	logging.disable(logging.NOTSET)
+
+BENCHMARKS = [('framing', benchmark_framing), ('dispatch', benchmark_dispatch), ('protocol', benchmark_protocol),
+	('broadcast', benchmark_broadcast), ('join', benchmark_join), ('odds', benchmark_odds), ('policy', benchmark_policy),
+	('simulate', benchmark_simulate), ('player', benchmark_player), ('phases', benchmark_phases), ('seeds', benchmark_seeds),
+	('change', benchmark_change), ('ledger', benchmark_ledger),
+	('settlement', benchmark_settlement), ('dice', benchmark_dice), ('rounds', benchmark_rounds),
+	('connect', benchmark_connect), ('startup', benchmark_startup), ('flood', benchmark_flood)]
+
+if __name__ == "__main__":
+	for name, benchmark in BENCHMARKS:
+		if sys.argv[1:] and name not in sys.argv[1:]: continue
+		benchmark()
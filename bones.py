@@ -22,12 +22,10 @@
 # game.status description
 # command descriptions
 # repr/str fix?
-# enhance SeedBank making change algorithm
 # alternate wager architecture: everyone says their maximum wager
 # what if someone disconnects while others are playing i.e. they rejected, how to not interrupt game
 # potential for multiple servers? - conflict with IP address posting / reading
 # resolve annoying confusion: seeds return values as seeds, but banks return values as a net integer
-# use None for e.g. acceptstatus?
 # constantify animate roll parameters
 
 # resolve file access issues (e.g. images) based on where script is run (for portability)
@@ -53,9 +51,26 @@ import logging
 import re
 import urllib2
 import errno
+import select
+import asyncore
+import asynchat
 import traceback
 import os
 import sys
+import itertools
+import collections
+import fractions
+import hashlib
+import multiprocessing
+import gc
+import types
+import json
+import tempfile
+import BaseHTTPServer
+try:
+	import numpy
+except ImportError:
+	numpy = None # only the simulator needs it
 #from bones_gui import *
 
 ################################################################################
@@ -79,10 +94,73 @@ CODEBOOK = {'GGG': 1, 'BGG': 2, 'BBB': 3, 'GGR': 4, 'BBG': 5, 'RRR': 6, 'GRR': 7
 FORFEITSCORE = 11
 LONERSCORE = 0
 
+# ROLL_MODE - who rolls the dice
+#   'client' - every client rolls its own and reports the hand (works with every client, but takes their word for it)
+#   'server' - clients ask the server to roll for them and only the server's rolls count; each game's dice seed is
+#              committed to (sha256) as the game starts and revealed at the end, so clients can check every roll
+#              (needs clients that say hello - legacy clients can only report hands, which are ignored)
+#   'batch'  - as 'server', but the server rolls for everyone at once on entering round1 and round2 and sends all
+#              the hands in one message, no one waits on anyone's roll (legacy clients are sent a handrelay for each)
+# ROLL_TIMEOUT - seconds a client waits for the server to roll for it
+# DICE_SEED - None for fresh entropy every game, or a string to make every game's dice repeatable (testing)
+ROLL_MODE = 'client'
+ROLL_TIMEOUT = 5
+DICE_SEED = None
+
+# POLICY_FNAME        where the solved continue/forfeit/double strategy is kept between runs
+# POLICY_MAX_PLAYERS  largest table the strategy is worked out for in advance (bigger ones are solved on demand)
+POLICY_FNAME = 'bones-policy.txt'
+POLICY_MAX_PLAYERS = 6
+
+# SIMULATION_WAGER     wager (in yellows) the simulator's tables play for
+# SIMULATION_BANKROLL  yellows each simulated player starts with
+# SIMULATION_STRATEGIES  the simulator's response strategies (see Simulator)
+SIMULATION_WAGER = 1
+SIMULATION_BANKROLL = 100
+SIMULATION_STRATEGIES = ['policy', 'continue', 'forfeit', 'double', 'random']
+
 # derivations
 DIE_COLORS = list(set(DIE)) # uniquify
 DIE_COLOR_NAMES = [name for symbol, name in DIE_COLOR_LUT.iteritems()]
 
+# hands are held as ints, HAND_ROLL_BITS per roll in the order rolled (first roll in the low bits)
+# ROLL_CODES    code of each roll: 1 up for the die colors (sorted), all bits set for a forfeit 'X'
+# HAND_CODE     hand string: int
+# HAND_STR      hand int: string e.g. 'RBG', '' for anything that isn't a hand
+# SCORE         hand int: score as Player.getscore (FORFEITSCORE, LONERSCORE or from CODEBOOK), None if unfinished
+# NROLLS        hand int: number of rolls, not counting 'X'
+# SCORE_RANGE   every score is below this
+HAND_ROLL_BITS = 3
+ROLL_CODES = dict([(color, code) for code, color in enumerate(sorted(DIE_COLORS), 1)])
+ROLL_CODES['X'] = (1 << HAND_ROLL_BITS) - 1
+HAND_CODE = {'': 0}
+for nrolls in xrange(1, 4):
+	for rolls in itertools.product(sorted(DIE_COLORS), repeat = nrolls):
+		for hand in [''.join(rolls), ''.join(rolls) + 'X']:
+			HAND_CODE[hand] = sum([ROLL_CODES[roll] << (HAND_ROLL_BITS * i) for i, roll in enumerate(hand)])
+HAND_CODE['X'] = ROLL_CODES['X']
+HAND_STR = [''] * (1 << (HAND_ROLL_BITS * 4))
+SCORE = [None] * len(HAND_STR)
+NROLLS = [0] * len(HAND_STR)
+for hand, code in HAND_CODE.iteritems():
+	HAND_STR[code] = hand
+	NROLLS[code] = len(hand) - hand.count('X')
+	if 'X' in hand: SCORE[code] = FORFEITSCORE
+	elif len(hand) == 2: SCORE[code] = LONERSCORE
+	elif len(hand) == 3: SCORE[code] = CODEBOOK[''.join(sorted(hand))]
+SCORE_RANGE = max(CODEBOOK.values() + [FORFEITSCORE, LONERSCORE]) + 1
+
+# player statuses, as held by Player - the symbols are how they're shown and sent
+# ACCEPT_*    response to the wager
+# RESPONSE_*  response after round 1, continue/forfeit/double
+ACCEPT_NONE, ACCEPT_ACCEPTED, ACCEPT_REJECTED = 0, 1, 2
+ACCEPT_SYMBOLS = ['', 'a', 'r']
+RESPONSE_NONE, RESPONSE_CONTINUED, RESPONSE_FORFEITED, RESPONSE_DOUBLED = 0, 1, 2, 3
+RESPONSE_SYMBOLS = ['', 'c', 'f', 'd']
+
+# GAME_DEBUG_INVARIANTS - check a game's running player counts against a full recount on every change (slow)
+GAME_DEBUG_INVARIANTS = False
+
 ########################################
 # Seed Colors / Values
 ########################################
@@ -112,6 +190,9 @@ COLOR_VALS = [value for symbol, name, value in COLOR_CORE]
 COLOR_VALS.sort()
 COLOR_VALS.reverse()
 
+# SEEDS_INTERN_LIMIT - Seeds of every color with a count below this are shared rather than created anew
+SEEDS_INTERN_LIMIT = 256
+
 ########################################
 # Networking Parameters
 ########################################
@@ -126,8 +207,82 @@ WWW_IP_URL = "https://duckduckgo.com/?q=what+is+my+ip+address&t=keywordsearch"
 IPS_FNAME = r"C:\Users\stoberc\Dropbox\bones\bonesip.txt"
 IPS_URL = "https://www.dropbox.com/s/mto8psfi5zjb6kg/bonesip.txt?dl=1"
 
+# the server finds and posts its IPs in the background, it takes connections on localhost meanwhile
+# DISCOVERY_TIMEOUT - seconds the server waits on WWW_IP_URL
+# IPS_CACHE_FNAME - where the server keeps the IPs it last found, posted straight away on the next launch
+# IPS_CACHE_TTL - seconds the cached IPs are trusted for
+# IP_PUBLISHER - where the server posts its IPs for clients to find
+#   'file' - IPS_FNAME, served to clients as IPS_URL
+#   'http' - a page served on PUBLISH_HTTP_PORT, a local stand-in for IPS_URL (point IPS_URL at it)
+#   None   - nowhere
+DISCOVERY_TIMEOUT = 5
+IPS_CACHE_FNAME = 'bones-ips.cache'
+IPS_CACHE_TTL = 24 * 60 * 60
+IP_PUBLISHER = 'file'
+PUBLISH_HTTP_PORT = 8821
+
 MAX_CLIENTS = 5 # max concurrent connection attempts to server
 
+# admission control for the server's connections (see Admission)
+# MAX_CONNECTIONS - connections the server holds at once, any more are turned away
+# MAX_CONNECTIONS_PER_IP - how many of those may come from one address (0 for no limit)
+# RATE_LIMITS - command: (commands per second, burst) each connection may send, None for every command not listed
+#   commands over the limit are dropped, and a connection that has had RATE_VIOLATION_LIMIT of them dropped is cut off
+# RX_BUFFER_LIMIT - bytes of unfinished packet a connection may leave waiting before it is cut off
+# ADMISSION_METRICS_INTERVAL - seconds between admission metrics log lines (0 to disable)
+MAX_CONNECTIONS = 500
+MAX_CONNECTIONS_PER_IP = 20
+RATE_LIMITS = {'message': (1, 5), 'newname': (0.2, 3), 'tables': (1, 5), 'balance': (1, 5),
+	'newtable': (0.1, 2), 'jointable': (0.5, 3), None: (20, 100)}
+RATE_VIOLATION_LIMIT = 100
+RX_BUFFER_LIMIT = 64 * 1024
+ADMISSION_METRICS_INTERVAL = 60
+
+# SERVER_IO_MODE - how the server services its connections
+#   'threaded' - one rx thread per connection feeding a shared task queue
+#   'select'   - single thread multiplexing every connection on readiness (epoll where available)
+#   'async'    - asyncore channels with buffered non-blocking sends
+# CLIENT_IO_MODE - 'threaded' or 'async', as above
+# RX_CHUNK_SIZE - max bytes taken from a socket per recv
+# RX_BUFFER_SIZE - initial size of each connection's preallocated rx buffer (grows as needed)
+# SELECT_TIMEOUT - seconds the select/async loops may sleep waiting for activity
+SERVER_IO_MODE = 'threaded'
+CLIENT_IO_MODE = 'threaded'
+RX_CHUNK_SIZE = 1024
+RX_BUFFER_SIZE = 4096
+SELECT_TIMEOUT = 1.0
+
+# COMMAND_SHARDS - worker threads the threaded server spreads commands over
+#   every table is pinned to one shard, so a table's commands are handled in order
+# SHARD_METRICS_INTERVAL - seconds between shard metrics log lines (0 to disable)
+# LOBBY_ROUTE - shard key for connections that aren't seated at a table
+# OUTBOX_LIMIT - bytes that may queue up for one slow connection before it is cut off
+OUTBOX_LIMIT = 256 * 1024
+
+COMMAND_SHARDS = 4
+SHARD_METRICS_INTERVAL = 60
+LOBBY_ROUTE = 0
+
+# SESSION_GRACE - seconds a player whose connection breaks keeps their seat, and their part in the game, for them to resume
+# TRANSCRIPT_LENGTH - messages each table keeps to replay to a resuming player (one who missed more starts afresh)
+SESSION_GRACE = 60
+TRANSCRIPT_LENGTH = 500
+
+# HEARTBEAT_INTERVAL - seconds between the server's pings to each client that said hello (they answer pong)
+# HEARTBEAT_TIMEOUT - seconds such a client may go unheard before its connection is taken for dead and cut off
+#   clients give up on a server that's been quiet this long too
+#   clients that never said hello can't answer pings, their sockets are left to TCP keepalive, probing after this long idle
+# TURN_TIMEOUTS - seconds a table waits in each phase for its slowest players before acting for them:
+#   rejecting the wager, rolling their dice, forfeiting, or contributing what they owe
+# TURN_CHECK_INTERVAL - seconds between checks on every table's turn
+# BROKEN_ERRNOS - socket errors meaning the peer is gone (the WSA ones are windows' names for them)
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 30
+TURN_TIMEOUTS = {'wagering': 60, 'round1': 60, 'round2': 60, 'response': 60, 'denouement': 30}
+TURN_CHECK_INTERVAL = 1
+BROKEN_ERRNOS = set([errno.ECONNRESET, errno.ECONNABORTED, errno.ETIMEDOUT, errno.EPIPE, errno.ENOTCONN] +
+	[getattr(errno, name) for name in ['WSAECONNRESET', 'WSAECONNABORTED', 'WSAETIMEDOUT'] if hasattr(errno, name)])
+
 SERVER_LOGGING_LEVEL = logging.INFO
 CLIENT_LOGGING_LEVEL = logging.WARNING
 LOGGING_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
@@ -135,14 +290,38 @@ LOGGING_DATE_FORMAT = '%H:%M:%S'
 LOGFILE_DATE_FORMAT = '%Y-%m-%d ' + LOGGING_DATE_FORMAT
 SERVER_LOGFILENAME = 'bones-server.log'
 
-# time to wait between iterated client reconnection attempts measured in seconds
-# padded to start counting from 1
-RECONNECT_DELAYS = [0, 5, 20, 60]
-MAX_RECONNECT_ITERATIONS = len(RECONNECT_DELAYS) - 1
+# CONNECT_TIMEOUT - seconds a client waits on a candidate server address before writing it off
+#   every candidate is tried at once, so this bounds the whole attempt rather than each address
+# IPS_URL_TIMEOUT - seconds a client waits for IPS_URL, which is fetched while the candidates on hand are tried
+# SERVER_CACHE_FNAME - where a client remembers the last server it reached, tried first next time
+# SERVER_CACHE_TTL - seconds the remembered server stays worth trying
+# RECONNECT_BASE_DELAY - seconds before the first reconnection attempt, doubling after each failure...
+# RECONNECT_MAX_DELAY - ...up to this many seconds
+# RECONNECT_JITTER - fraction each delay is randomly stretched or shrunk by, so clients don't retry in lockstep
+# MAX_RECONNECT_ATTEMPTS - attempts before the client stops trying on its own
+CONNECT_TIMEOUT = 0.5
+IPS_URL_TIMEOUT = 5
+SERVER_CACHE_FNAME = 'bones-server.cache'
+SERVER_CACHE_TTL = 7 * 24 * 60 * 60
+RECONNECT_BASE_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+RECONNECT_JITTER = 0.5
+MAX_RECONNECT_ATTEMPTS = 10
 
 # initial ID reserved for server
 SERVERID = 0
 
+########################################
+# Ledger
+########################################
+
+# LEDGER_FNAME - write-ahead log of every game the server has settled, one JSON line per game
+# LEDGER_SNAPSHOT_FNAME - balances as of some point in the log, so only the log past it is replayed on start
+# LEDGER_SNAPSHOT_INTERVAL - records between snapshots (the log is emptied after each)
+LEDGER_FNAME = 'bones-ledger.log'
+LEDGER_SNAPSHOT_FNAME = 'bones-ledger.snapshot'
+LEDGER_SNAPSHOT_INTERVAL = 1000
+
 ########################################
 # Command Parameters
 ########################################
@@ -167,23 +346,89 @@ SERVERID = 0
 # messagerelay:(pid, msg)		# pid says msg
 # handrelay:(pid, hand)			# pid rolled hand
 # response:						# all players have reported their hands, moving to response round
+# seated:(tid, name)			# you are now seated at table tid
+# tablelist:((tid, name, nplayers, status), ...)	# the tables on this server
+# protocol:2					# wire protocol picked from those offered in hello
+# roster:((pid,name),...)		# everyone at your table - sent on sitting down, in place of newplayer for each
+# balanceis:(name,net,ngames)	# name has won net yellows over ngames settled games, according to the ledger
+# rollmode:server				# who rolls the dice (ROLL_MODE) - sent in answer to hello
+# rolled:B						# the server rolled you a B (server roll mode)
+# dicecommit:hash				# sha256 of the seed of this game's dice (server roll mode) - sent with round1
+# rolls:((pid,hand),...)		# everyone's hand now that the server has rolled for the round (batch roll mode)
+# diceseed:seed					# this game's dice seed, to check every roll against the commitment
+# session:token					# token to resume your player with if the connection breaks - sent with assignID to clients that said hello
+# seq:n							# you've now had n messages from your table - sent after each batch of them
+# delta:((command,args),...)	# the table messages you missed since the seq you resumed from
+# playeraway:(pid, seconds)		# pid's connection broke, their seat is held for seconds in case they resume
+# playerback:pid				# pid resumed
+# ping:							# are you still there? answer pong (clients that said hello, every HEARTBEAT_INTERVAL)
 
 ### client to server ###
 
+# hello:(1, 2)					# wire protocols the client speaks - sent just before mynameis
 # mynameis:%s					# notify client of name - triggers broadcast
+# resume:(token, seq, name)		# give me back my player, I'd heard up to seq from the table - in place of mynameis
 # newname:Vinnie				# player has changed name
 # wager:6y						# wager e.g. 6 yellows; appropriate during forum phase only
 # accept:						# accept a wager on the table
 # reject:						# reject a wager on the table
 # message:msg					# please broadcast this message
 # hand:hand						# my hand is ...
+# tables:						# list the tables on this server
+# newtable:name					# open a new table and sit at it
+# jointable:tid					# move to table tid (between games only)
+# balance:name					# what has name won or lost over time? (own name if blank)
+# roll:							# roll for me (server roll mode, in place of hand)
+# pong:							# still here - answers ping
+
+
+### wire protocols
+# the text protocol frames every message as command:arglength:str(args)|
+# the binary protocol frames a message as BINARY_MARKER, opcode byte, varint payload length, payload
+#   payload is one tagged value (nothing at all for a command without args):
+#     0x00-0x7f  small non-negative int
+#     0x80 None, 0x81 False, 0x82 True
+#     0x83 int - zigzag varint follows
+#     0x84 str - varint length then bytes follow
+#     0x85 tuple - varint item count then items follow
+#     0xc0-0xff  entry of WIRE_SYMBOLS
+# frames are self-describing (no command name starts with BINARY_MARKER) so either side may mix the two
+# commands missing from OPCODES always go as text, keep OPCODES append-only so old builds still agree
+PROTOCOL_TEXT = 1
+PROTOCOL_BINARY = 2
+PROTOCOL_VERSIONS = (PROTOCOL_TEXT, PROTOCOL_BINARY) # every protocol we speak
+BINARY_MARKER = 0xb0
+OPCODES = ['hello', 'protocol', 'mynameis', 'assignID', 'newplayer', 'newname', 'nameadjust', 'hold',
+		   'wager', 'wagerontable', 'accept', 'accepts', 'reject', 'rejects', 'round1', 'forum', 'orate',
+		   'message', 'messagerelay', 'hand', 'handrelay', 'response', 'continue', 'forfeit', 'double',
+		   'responses', 'denouement', 'contribution', 'contributionrelay', 'spoils', 'mandown',
+		   'tables', 'tablelist', 'newtable', 'jointable', 'seated', 'roster', 'balance', 'balanceis',
+		   'rollmode', 'roll', 'rolled', 'dicecommit', 'diceseed', 'rolls',
+		   'session', 'resume', 'delta', 'seq', 'playeraway', 'playerback', 'ping', 'pong']
+OPCODE_LUT = dict([(command, opcode) for opcode, command in enumerate(OPCODES)])
+
+# WIRE_SYMBOLS - short strings sent as a single byte: colors, every partial/complete/forfeited hand, responses
+# sorted so that every build lists them in the same order
+WIRE_SYMBOLS = [''] + COLORS + ['c', 'f', 'd']
+for nrolls in xrange(1, 4):
+	WIRE_SYMBOLS += [''.join(hand) for hand in itertools.product(sorted(DIE_COLORS), repeat = nrolls)]
+WIRE_SYMBOLS += [''.join(hand) + 'X' for hand in itertools.product(sorted(DIE_COLORS), repeat = 2)]
+WIRE_SYMBOL_LUT = dict([(symbol, index) for index, symbol in enumerate(WIRE_SYMBOLS)])
 
+# LITERAL_TOKEN_RE - one token of a tuple argument string: ( ) int 'string' constant, commas and spaces skipped
+# LITERAL_CONSTANTS - names allowed to appear in argument strings
+LITERAL_TOKEN_RE = re.compile(r"""[\s,]*(?:(\()|(\))|(-?\d+)L?|('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|(None|True|False))[\s,]*""")
+LITERAL_CONSTANTS = {'None': None, 'True': True, 'False': False}
 
 ########################################
 # Miscellaneous
 ########################################
 
 DEFAULT_PLAYER_NAME = 'Anon'
+DEFAULT_TABLE_ID = 1 # the table every player is seated at on arrival
+DEFAULT_TABLE_NAME = 'main'
+LOBBY_COMMANDS = ['hello', 'mynameis', 'resume', 'tables', 'newtable', 'jointable', 'balance', 'pong'] # commands that don't need a seat at a table
+QUIET_COMMANDS = ['ping', 'pong'] # not worth a log line each
 CLI_PROMPT = '> '
 TIGER_WORD = 'Ridat' # 'Ridat' or 'tiger'
 
@@ -208,15 +453,20 @@ INTRO_ART = """
 ################################################################################
 
 # an individual player
-class Player:
+# slotted, with the hand as an int and statuses as small ints (see HAND_CODE, ACCEPT_*, RESPONSE_*)
+# so that scoring and reporting a hand are table lookups
+class Player(object):
+	
+	__slots__ = ['name', 'id', 'hand', 'bank', 'acceptstatus', 'response', 'rank', 'contribution', 'income', 'game']
 	
 	def __init__(self, name):
+		self.game = None # the Game keeping count of this player, see Game.addplayer
 		self.name = name
 		self.id = 0
-		self.hand = [] # list of die rolls
+		self.hand = 0 # die rolls, see HAND_CODE
 		self.bank = SeedBank()
-		self.acceptstatus = '' #a/r for accept/reject
-		self.response = '' # response c/f/d for continue forfeit double
+		self.acceptstatus = ACCEPT_NONE
+		self.response = RESPONSE_NONE # continue forfeit double
 		self.rank = -1 # rank at end of game 1, 2, 3, etc.
 		self.contribution = Seeds(0, COLOR_BASE) # amount put in pot
 		self.income = Seeds(0, COLOR_BASE) # income from winning
@@ -226,8 +476,8 @@ class Player:
 		lines.append("Player name: " + self.name + "\n")
 		lines.append("Player id: " + str(self.id) + "\n")
 		lines.append("Player hand: " + self.gethand() + "\n")
-		lines.append("Player acceptstatus: " + self.acceptstatus + "\n")
-		lines.append("Player response: " + self.response + "\n")
+		lines.append("Player acceptstatus: " + ACCEPT_SYMBOLS[self.acceptstatus] + "\n")
+		lines.append("Player response: " + self.getresponse() + "\n")
 		#lines.append(repr(self.bank))
 		return ''.join(lines)
 	
@@ -240,88 +490,191 @@ class Player:
 	def setrank(self, rank): self.rank = rank
 	def getrank(self): return self.rank
 	
-	def getresponse(self): return self.response
+	def getresponse(self): return RESPONSE_SYMBOLS[self.response]
 	
-	def setcontribution(self, contribution): self.contribution = contribution
+	def setcontribution(self, contribution):
+		game = self.game
+		if game is not None:
+			game.ncontributors += (contribution.value() > 0) - self.contributed()
+			self.contribution = contribution
+			if GAME_DEBUG_INVARIANTS: game.checkcounts()
+		else: self.contribution = contribution
 	def getcontribution(self): return self.contribution
 	def setincome(self, income): self.income = income
 	def getincome(self): return self.income
 	
 	# find net income (your winnings - what you put in)
-	# optimizes in the case of disparate colors
-	def getnet(self):
-		result = self.income - self.contribution
-		if self.income.getcolor() != self.contribution.getcolor(): result.optimize()
-		return result
+	# optimized in the case of disparate colors (see Seeds.__sub__)
+	def getnet(self): return self.income - self.contribution
 	
-	# roll a die and add it to the hand, return it for external use
-	def roll(self):
-		result = random.choice(DIE)
-		self.hand.append(result)
+	# changes to anything the game counts players by go through the set* methods, so that its counts follow along
+	def sethandcode(self, hand):
+		game = self.game
+		if game is not None:
+			game.rollcounts[NROLLS[self.hand]] -= 1
+			game.rollcounts[NROLLS[hand]] += 1
+			self.hand = hand
+			if GAME_DEBUG_INVARIANTS: game.checkcounts()
+		else: self.hand = hand
+	def setacceptstatus(self, status):
+		game = self.game
+		if game is not None:
+			game.acceptcounts[self.acceptstatus] -= 1
+			game.acceptcounts[status] += 1
+			self.acceptstatus = status
+			if GAME_DEBUG_INVARIANTS: game.checkcounts()
+		else: self.acceptstatus = status
+	def setresponse(self, response):
+		game = self.game
+		if game is not None:
+			game.responsecounts[self.response] -= 1
+			game.responsecounts[response] += 1
+			self.response = response
+			if GAME_DEBUG_INVARIANTS: game.checkcounts()
+		else: self.response = response
+	
+	# add a roll to the end of the hand
+	def addroll(self, roll):
+		nsymbols = (self.hand.bit_length() + HAND_ROLL_BITS - 1) // HAND_ROLL_BITS
+		self.sethandcode(self.hand | ROLL_CODES[roll] << (HAND_ROLL_BITS * nsymbols))
+	
+	# roll a die from the game's dice and add it to the hand, return it for external use
+	def roll(self, dice):
+		result = dice.roll(self.id)
+		self.addroll(result)
 		return result
 	
 	# number of rolls (excludes 'X' from forfeiture)
-	def nrolls(self):
-		return len(self.hand) - self.hand.count('X')
+	def nrolls(self): return NROLLS[self.hand]
 	
 	# return the hand as a string e.g 'RG'
-	def gethand(self): return ''.join(self.hand)
+	def gethand(self): return HAND_STR[self.hand]
 	
 	# configure the hand using e.g. 'RBB'
 	# used for filling in local data on other players from server
-	def sethand(self, hand): self.hand = [roll for roll in hand]
+	def sethand(self, hand): self.sethandcode(HAND_CODE[hand])
 	
 	# reset back to forum following full or partial game (wagering onward)
 	def reset(self):
-		self.hand = []
-		self.response = ''
-		self.acceptstatus = ''
+		game = self.game
+		if game is not None: game.tally(self, -1)
+		self.hand = 0
+		self.response = RESPONSE_NONE
+		self.acceptstatus = ACCEPT_NONE
 		self.rank = -1
 		self.contribution = Seeds(0, COLOR_BASE)
 		self.income = Seeds(0, COLOR_BASE)
+		if game is not None:
+			game.tally(self, 1)
+			if GAME_DEBUG_INVARIANTS: game.checkcounts()
 		
 	# score the three dice rolls
 	# assume caller knows to only call at end of game - will throw exception else
 	def getscore(self):
-		if self.forfeited(): return FORFEITSCORE
-		elif self.nrolls() == 2: return LONERSCORE
-		handc = self.hand[:] # don't want to sort the original, do we?
-		handc.sort()
-		return CODEBOOK[''.join(handc)]
-		
-	def accept(self): self.acceptstatus = 'a'
-	def reject(self): self.acceptstatus = 'r'
-	def accepted(self):	return self.acceptstatus == 'a' # True/False
-	def rejected(self):	return self.acceptstatus == 'r' # True/False
-	def responded_to_wager(self): return self.accepted() or self.rejected() # True/False
-	
-	def continue_(self): self.response = 'c'
+		if self.response == RESPONSE_FORFEITED: return FORFEITSCORE
+		score = SCORE[self.hand]
+		if score is None: raise Exception("Trying to score an unfinished hand: %s" % self.gethand())
+		return score
+		
+	def accept(self): self.setacceptstatus(ACCEPT_ACCEPTED)
+	def reject(self): self.setacceptstatus(ACCEPT_REJECTED)
+	def accepted(self):	return self.acceptstatus == ACCEPT_ACCEPTED # True/False
+	def rejected(self):	return self.acceptstatus == ACCEPT_REJECTED # True/False
+	def responded_to_wager(self): return self.acceptstatus != ACCEPT_NONE # True/False
+	
+	def continue_(self): self.setresponse(RESPONSE_CONTINUED)
 	def forfeit(self):
 		# don't allow double forfeit due to server redundancy
 		# normally inconsequential, but here would cause double 'X'
-		if self.response == 'f': return
-		self.response = 'f'
-		self.hand += ['X']
-	def double(self): self.response = 'd'
-	def continued(self): return self.response == 'c'
-	def forfeited(self): return self.response == 'f'
-	def doubled(self): return self.response == 'd'
-	def responded_to_cfd(self): return self.continued() or self.forfeited() or self.doubled()
+		if self.response == RESPONSE_FORFEITED: return
+		self.setresponse(RESPONSE_FORFEITED)
+		self.addroll('X')
+	def double(self): self.setresponse(RESPONSE_DOUBLED)
+	def continued(self): return self.response == RESPONSE_CONTINUED
+	def forfeited(self): return self.response == RESPONSE_FORFEITED
+	def doubled(self): return self.response == RESPONSE_DOUBLED
+	def responded_to_cfd(self): return self.response != RESPONSE_NONE
 	
 	# fails if a person contributed 0 seeds
 	# should be impossible if game mechanics are implemented correctly
-	def contributed(self): return self.getcontribution() > Seeds(0, COLOR_BASE)
+	def contributed(self): return self.contribution.value() > 0
+
+# the dice for one game - a seeded stream of rolls for every seat, so a game can be replayed (or checked) from its seed
+# the seed is a string: fresh entropy, derived from DICE_SEED, or given (an int or tuple of ints for simulations)
+# each seat's stream is seeded from sha256(seed/seat), which anyone holding the seed can recompute
+# bulk() fills numpy arrays of rolls (as indices into DIE) for simulations, from a generator of its own
+class DiceRNG:
+	issued = itertools.count() # games dealt from DICE_SEED so far
+	
+	def __init__(self, seed = None):
+		if seed is None:
+			if DICE_SEED is None: seed = os.urandom(16).encode('hex')
+			else: seed = '%s-%d' % (DICE_SEED, next(DiceRNG.issued))
+		elif isinstance(seed, (int, long)): seed = '%x' % seed
+		elif isinstance(seed, tuple): seed = '-'.join(['%x' % part for part in seed])
+		self.seed = seed
+		self.streams = {} # seat: random.Random
+		self.bulkrng = None
+	
+	# the stream of rolls for a seat (player id)
+	def stream(self, seat):
+		if seat not in self.streams:
+			self.streams[seat] = random.Random(long(hashlib.sha256('%s/%s' % (self.seed, seat)).hexdigest(), 16))
+		return self.streams[seat]
+	
+	def roll(self, seat = 0):
+		stream = self.streams.get(seat) or self.stream(seat)
+		return DIE[int(stream.random() * len(DIE))] # as stream.choice(DIE), a call shorter
+	def rolls(self, seat, n): return [self.roll(seat) for i in xrange(n)]
+	
+	# published before any rolls, checked against the seed once it's revealed
+	def commitment(self): return hashlib.sha256(self.seed).hexdigest()
+	
+	# the numpy generator behind bulk, for any other randomness a simulation needs
+	def generator(self):
+		if self.bulkrng is None:
+			self.bulkrng = numpy.random.RandomState(numpy.frombuffer(hashlib.sha256(self.seed).digest(), dtype = '<u4'))
+		return self.bulkrng
+	
+	# an array of rolls of the given shape, as indices into DIE
+	def bulk(self, shape): return self.generator().randint(0, len(DIE), size = shape)
 
 # class for currency - atomic units e.g. five yellows, three blues
-class Seeds:
+# immutable, so small amounts are shared (SEEDS_INTERN_LIMIT) and the value in base seeds is worked out once
+# arithmetic is done on values, only the result is given a color
+class Seeds(object):
+	
+	__slots__ = ['count', 'color', 'basevalue']
+	interned = {} # (count, color): Seeds
 	
-	def __init__(self, count, color):
-		if not isinstance(count, int):
+	def __new__(cls, count, color):
+		# checked before the intern lookup, where 1.0 would pass for 1
+		if not isinstance(count, (int, long)):
 			raise Exception("Error: non-integer count input to Seeds - %s" % count)
-		if color not in COLORS:
+		if color not in COLOR_VAL_LUT:
 			raise Exception("Error: invalid color input into Seeds - %s. Try one of these:%s" % (color, ' '.join(COLORS)))
-		self.count = count
-		self.color = color
+		seeds = Seeds.interned.get((count, color))
+		if seeds is not None: return seeds
+		
+		seeds = object.__new__(cls)
+		object.__setattr__(seeds, 'count', count)
+		object.__setattr__(seeds, 'color', color)
+		object.__setattr__(seeds, 'basevalue', count * COLOR_VAL_LUT[color])
+		if 0 <= count < SEEDS_INTERN_LIMIT: Seeds.interned[(count, color)] = seeds
+		return seeds
+	
+	def __setattr__(self, name, value):
+		raise AttributeError("Seeds are immutable - make new ones instead.")
+	
+	# the seeds worth value - in color if that comes out exact, otherwise in the highest color that does
+	@staticmethod
+	def ofvalue(value, color = None):
+		if color is not None and value % COLOR_VAL_LUT[color] == 0:
+			return Seeds(value // COLOR_VAL_LUT[color], color)
+		# relies on COLOR_VALS being in descending order
+		for colorvalue in COLOR_VALS:
+			if value % colorvalue == 0:
+				return Seeds(value // colorvalue, COLOR_VAL_INV[colorvalue])
 		
 	# violates convention that __repr__ return value should be pythonic, but very convenient for debug
 	def __repr__(self):
@@ -332,83 +685,138 @@ class Seeds:
 		return "%d %s%s" % (self.count, COLOR_LUT[self.color], suffix)
 		
 	def __cmp__(self, other):
-		return cmp(self.value(), other.value())
+		return cmp(self.basevalue, other.basevalue)
+	def __hash__(self): return hash(self.basevalue)
 
 	# keeps color if both inputs are the same color
 	def __add__(self, other):
-		s = Seeds(self.value() + other.value(), COLOR_BASE)
-		if self.getcolor() == other.getcolor():
-			s.convert(self.getcolor())
-		else:
-			s.optimize()
-		return s
+		if self.color == other.color: return Seeds(self.count + other.count, self.color)
+		return Seeds.ofvalue(self.basevalue + other.basevalue)
 	
 	# if both arguments are same color, result will match
 	def __sub__(self, other):
-		s = Seeds(self.value() - other.value(), COLOR_BASE)
-		if self.getcolor() == other.getcolor():
-			s.convert(self.getcolor())
-		else:
-			s.optimize()
-		return s
+		if self.color == other.color: return Seeds(self.count - other.count, self.color)
+		return Seeds.ofvalue(self.basevalue - other.basevalue)
 	
 	def __mul__(self, n):
-		count = n * self.getcount()
-		return Seeds(count, self.getcolor())
+		return Seeds(n * self.count, self.color)
 		
 	__rmul__ = __mul__
 	
 	# keeps same color when possible, else optimizes
 	def __div__(self, n):
-		value = int(self.value() / n)
-		result = Seeds(value, COLOR_BASE)
-		if value % COLOR_VAL_LUT[self.getcolor()] == 0:
-			result.convert(self.getcolor())
-		else:
-			result.optimize()
-		return result
+		return Seeds.ofvalue(int(self.basevalue / n), self.color)
 	
 	# keeps same color when possible, else optimizes
 	def __mod__(self, n):
-		value = int(self.value() % n)
-		result = Seeds(value, COLOR_BASE)
-		if value % COLOR_VAL_LUT[self.getcolor()] == 0:
-			result.convert(self.getcolor())
-		else:
-			result.optimize()
-		return result		
+		return Seeds.ofvalue(int(self.basevalue % n), self.color)
 		
 	def __divmod__(self, n): return (self/n, self%n)
 
 	def getcolor(self): return self.color
 	def getcount(self): return self.count
-	def value(self):
-		return self.count * COLOR_VAL_LUT[self.color]
-		
-	# converts into a different color
-	# returns any incurred loss
-	# e.g. convert 34 yellows into red converts into 3 reds, returning 4 yellows
-	# if refuse_imperfect = True, the conversion will only succeed if there's no remainder
-	def convert(self, color, refuse_imperfect = False):
-		count, residual = divmod(self.value(), COLOR_VAL_LUT[color])
-		if refuse_imperfect and residual != 0:
-			return Seeds(0, COLOR_BASE)
-		r = Seeds(residual, self.color)
-		self.color = color
-		self.count = count
-		return r
+	def value(self): return self.basevalue
 		
-	# convert to the highest denomination possible without loss
-	def optimize(self):
-		# cycle through them until the first viable match is found (could be self)
-		# relies on COLOR_VALS being in descending order
-		for value in COLOR_VALS:
-			if self.value() % value == 0:
-				self.convert(COLOR_VAL_INV[value])
-				return		
+	# the same value in a different color
+	# if it doesn't come out exact, the highest color that does instead
+	def converted(self, color): return Seeds.ofvalue(self.basevalue, color)
+		
+	# the same value in the highest denomination possible without loss
+	def optimized(self): return Seeds.ofvalue(self.basevalue)
 		
+# fewest-seed change making for any set of denominations, including ones where greedy fails
+# (with 1, 3 and 4, 6 is 3 + 3 rather than 4 + 1 + 1)
+# in a fewest-seed payment no smaller denomination d appears c / gcd(c, d) times, or those seeds would be traded
+# for fewer seeds of c - so past a bound everything is paid in the largest seed, and the tables only ever cover the
+# bounded remainder, whatever the amount
+class ChangeMaker:
+	
+	def __init__(self, values):
+		self.values = sorted(values) # least to greatest, must include 1
+		# per denomination: (most value the smaller denominations make up in a fewest-seed payment,
+		#                    most smaller seeds ever traded for one of it)
+		self.bounds = []
+		for i, c in enumerate(self.values):
+			smaller = self.values[:i]
+			self.bounds.append((sum([d * (c / fractions.gcd(c, d) - 1) for d in smaller]), max([d / fractions.gcd(c, d) for d in smaller] or [0])))
+		self.table = None # value: (fewest seeds, largest seed in such a payment) for values up to the top bound, built on first use
+		# when every denomination divides the next (as in COLOR_CORE) taking as many of the largest seed as fit is already best
+		self.chain = all([b % a == 0 for a, b in zip(self.values, self.values[1:])])
+	
+	def buildtable(self):
+		self.table = [(0, None)]
+		for value in xrange(1, self.bounds[-1][0] + 1):
+			nseeds, seed = min([(self.table[value - d][0] + 1, -d) for d in self.values if d <= value])
+			self.table.append((nseeds, -seed))
+	
+	# fewest seeds worth value, as {denomination: count}
+	def coins(self, value):
+		if self.table is None: self.buildtable()
+		counts = dict.fromkeys(self.values, 0)
+		top, bound = self.values[-1], self.bounds[-1][0]
+		if value > bound:
+			counts[top] = -(-(value - bound) // top)
+			value -= counts[top] * top
+		while value:
+			seed = self.table[value][1]
+			counts[seed] += 1
+			value -= seed
+		return counts
+	
+	# best payment of at most target out of holdings {denomination: count} - the most value, then the fewest seeds
+	# returns (value, {denomination: count})
+	def payable(self, holdings, target):
+		if self.chain:
+			paid, value = {}, 0
+			for c in reversed(self.values):
+				paid[c] = min(holdings.get(c, 0), (target - value) // c)
+				value += paid[c] * c
+			return value, paid
+		
+		memo = {}
+		# best payment of at most target using only the i + 1 smallest denominations, as (value, nseeds, counts)
+		def best(i, target):
+			if (i, target) in memo: return memo[(i, target)]
+			c = self.values[i]
+			most = min(holdings.get(c, 0), target // c)
+			if i == 0:
+				result = (most * c, most, (most,))
+			else:
+				# by the exchange argument only the top few counts of c can be part of the best payment
+				# (a trade needs traded seeds of c left over, so with every seed of c but traded - 1 in use none is possible)
+				bound, traded = self.bounds[i]
+				result = None
+				for k in xrange(most, max(0, most - max(bound // c, traded - 1)) - 1, -1):
+					value, nseeds, counts = best(i - 1, target - k * c)
+					if result is None or (value + k * c, -nseeds - k) > (result[0], -result[1]):
+						result = (value + k * c, nseeds + k, counts + (k,))
+			memo[(i, target)] = result
+			return result
+		value, nseeds, counts = best(len(self.values) - 1, target)
+		return value, dict(zip(self.values, counts))
+	
+	# settle target out of holdings {denomination: count}, which must be worth at least that much
+	# pays exactly when the holdings allow it, otherwise breaks the smallest single seed that covers the gap
+	# returns ({denomination: count} handed over, {denomination: count} given back as change)
+	def pay(self, holdings, target):
+		value, paid = self.payable(holdings, target)
+		if value == target: return paid, {}
+		
+		for c in self.values:
+			if not holdings.get(c): continue
+			rest = holdings.copy()
+			rest[c] -= 1
+			value, paid = self.payable(rest, target - 1)
+			if value + c >= target:
+				paid[c] += 1
+				return paid, self.coins(value + c - target)
+		
+		raise ValueError("holdings are worth less than %d" % target)
+
 # currency management - bank of varying quantities of each currency
 class SeedBank:
+	change = ChangeMaker(COLOR_VALS) # shared by every bank, so the change tables are built once
+	
 	def __init__(self):
 		self.bank = {}
 		for color in COLORS:
@@ -419,9 +827,7 @@ class SeedBank:
 		output = "Bank contents:\n"
 		for color in COLORS:
 			output += " " + str(Seeds(self.bank[color], color)) + "\n"
-		totalvalue = Seeds(self.value(), COLOR_BASE)
-		totalvalue.optimize()
-		output += "Total value: %s\n" % totalvalue
+		output += "Total value: %s\n" % Seeds.ofvalue(self.value())
 		return output
 	
 	def __getitem__(self, key):
@@ -462,36 +868,23 @@ class SeedBank:
 			self.bank[seeds.getcolor()] -= seeds.getcount()
 			return seeds
 		
-		# otherwise, withdraw equivalent amount - 
-		# for now, just turn everything to yellows, then force optimization
-		# can later implement more natural (but complex) algorithm:
-		# starting with color requested, then break up larger denominations, 
-		# then group smaller denominations
+		# otherwise, withdraw equivalent amount out of the seeds on hand, breaking a seed for change only if there's no exact way
 		elif self.value() >= seeds.value():
-			target = seeds.value()
-			bv = self.value()
-			
-			for color in COLORS:
-				if color == COLOR_BASE:
-					self.bank[color] = bv - target
-				else:
-					self.bank[color] = 0
-				
-			self.optimize()
+			paid, change = SeedBank.change.pay(self.holdings(), seeds.value())
+			for value, count in paid.iteritems():
+				self.bank[COLOR_VAL_INV[value]] -= count
+			for value, count in change.iteritems():
+				self.bank[COLOR_VAL_INV[value]] += count
 			
 			return seeds
 					
 		# withdraw max amount if willing to settle
 		elif settleforless:
-			bv = Seeds(self.value(), COLOR_BASE)
-			bv.optimize()
+			# if possible, return in the desired color
+			bv = Seeds.ofvalue(self.value(), seeds.getcolor())
 			
 			for color in COLORS:
 				self.bank[color] = 0
-			
-			# if possible, return in the desired color
-			if bv.getcount() % COLOR_VAL_LUT[seeds.getcolor()] == 0:
-				bv.convert(seeds.getcolor())
 	
 			return bv
 		
@@ -499,14 +892,546 @@ class SeedBank:
 		else:
 			return Seeds(0, COLOR_BASE)
 									
-	# rebalance bank to use highest valued seeds possible
+	# rebalance bank to hold the fewest seeds possible
 	def optimize(self):
-		remaining = self.value()
+		for value, count in SeedBank.change.coins(self.value()).iteritems():
+			self.bank[COLOR_VAL_INV[value]] = count
+	
+	# bank contents as {value: count}
+	def holdings(self):
+		return dict([(COLOR_VAL_LUT[color], count) for color, count in self.bank.iteritems()])
+
+# the server's durable record of every settled game, with balances kept by player name
+# each game is appended to the log (LEDGER_FNAME) as one JSON line by a writer thread, which writes and fsyncs
+# everything waiting at once - games settling together on different tables share a single flush to disk
+# every LEDGER_SNAPSHOT_INTERVAL records the balances are written aside and renamed over the snapshot, and the log emptied
+# on start the snapshot is loaded and the log replayed past it, dropping a final line left torn by a crash
+# names are written as latin-1 so that any name round-trips byte for byte
+class Ledger:
+	
+	def __init__(self, logname = LEDGER_FNAME, snapshotname = LEDGER_SNAPSHOT_FNAME):
+		self.logname = logname
+		self.snapshotname = snapshotname
+		self.balances = {} # name: [net yellows, games settled]
+		self.seq = 0 # last record settled
+		self.synced = 0 # last record safely on disk
+		self.snapshotseq = 0 # last record in the snapshot
+		self.pending = [] # log lines waiting for the writer
+		self.nsyncs = 0
+		self.cv = threading.Condition()
+		self.log = None
+		self.good = 0 # bytes of the log known to hold whole records
+	
+	# load the snapshot, replay the log past it, and start the writer
+	def open(self):
+		t0 = time.time()
+		if os.path.exists(self.snapshotname):
+			with open(self.snapshotname, 'rb') as fp:
+				snapshot = json.load(fp)
+			self.balances = dict([(name.encode('latin-1'), balance) for name, balance in snapshot['balances'].iteritems()])
+			self.seq = self.synced = self.snapshotseq = snapshot['seq']
+		
+		nreplayed = good = 0
+		if os.path.exists(self.logname):
+			with open(self.logname, 'rb') as fp:
+				for line in fp:
+					try:
+						if not line.endswith('\n'): raise ValueError("unterminated")
+						record = json.loads(line)
+					except ValueError:
+						break
+					good += len(line)
+					if record['seq'] <= self.seq: continue # already in the snapshot
+					record['settle'] = [(name.encode('latin-1'), contribution, income) for name, contribution, income in record['settle']]
+					self.apply(record)
+					nreplayed += 1
+			torn = os.path.getsize(self.logname) - good
+			if torn: logging.warning("Ledger: dropping %d bytes of incomplete log after record %d." % (torn, self.seq))
+		self.synced = self.seq
+		
+		self.good = good
+		self.reopen()
+		logging.info("Ledger: %d players, %d records replayed past snapshot %d in %.1f ms." % \
+			(len(self.balances), nreplayed, self.snapshotseq, (time.time() - t0) * 1000))
+		
+		self.writer_thread = threading.Thread(target = self.writer, name = 'ledger_writer')
+		self.writer_thread.daemon = True # so that it will not attempt to persist when the program terminates
+		self.writer_thread.start()
+	
+	def apply(self, record):
+		for name, contribution, income in record['settle']:
+			balance = self.balances.setdefault(name, [0, 0])
+			balance[0] += income - contribution
+			balance[1] += 1
+		self.seq = record['seq']
+	
+	# record a settled game - records are (name, contribution, income) with amounts in yellows
+	# balances reflect it at once, returns its sequence number for wait
+	def settle(self, tableid, records): return self.settlemany([(tableid, records)])
+	
+	# record several settled games as (tableid, records), all in the same write
+	# returns the sequence number of the last
+	def settlemany(self, games):
+		with self.cv:
+			for tableid, records in games:
+				record = {'seq': self.seq + 1, 'table': tableid, 'time': int(time.time()), 'settle': records}
+				self.apply(record)
+				self.pending.append(json.dumps(record, encoding = 'latin-1') + '\n')
+			self.cv.notify_all()
+			return self.seq
+	
+	# block until record seq is on disk
+	def wait(self, seq):
+		with self.cv:
+			while self.synced < seq: self.cv.wait()
+	
+	# (net yellows, games settled) for a name
+	def balance(self, name):
+		with self.cv:
+			return tuple(self.balances.get(name, (0, 0)))
+	
+	# write out whatever has been settled since the last pass, one fsync for the lot
+	# runs as thread
+	def writer(self):
+		while True:
+			with self.cv:
+				while not self.pending: self.cv.wait()
+				lines, self.pending = self.pending, []
+				seq = self.seq
+			
+			data = ''.join(lines)
+			try:
+				if self.log is None: self.reopen()
+				self.log.write(data)
+				self.log.flush()
+				os.fsync(self.log.fileno())
+			except (IOError, OSError) as e:
+				# keep the lines and try again once the log is cut back to its last whole record
+				# (a torn fragment left in front of them would end replay there, taking every later record with it)
+				logging.error("Ledger: unable to write log (%s), retrying." % e)
+				with self.cv: self.pending[:0] = lines
+				self.discard()
+				time.sleep(1)
+				continue
+			self.good += len(data)
+			
+			with self.cv:
+				self.synced = seq
+				self.nsyncs += 1
+				self.cv.notify_all()
+			
+			if seq - self.snapshotseq >= LEDGER_SNAPSHOT_INTERVAL: self.snapshot()
+	
+	# open the log for appending, cut back to what's known to be whole
+	def reopen(self):
+		self.log = open(self.logname, 'ab')
+		self.log.truncate(self.good)
+	
+	# let go of a log that failed us, along with anything still buffered for it
+	def discard(self):
+		try:
+			self.log.close()
+		except (IOError, OSError, AttributeError):
+			pass
+		self.log = None
+	
+	# write the balances aside, then rename them into place and empty the log
+	# a crash at any point leaves either the old snapshot and the whole log, or the new snapshot
+	def snapshot(self):
+		with self.cv:
+			balances = dict([(name, list(balance)) for name, balance in self.balances.iteritems()])
+			seq = self.seq # may be ahead of the log, the records in between are skipped when replayed
+		
+		try:
+			tmpname = self.snapshotname + '.tmp'
+			with open(tmpname, 'wb') as fp:
+				json.dump({'seq': seq, 'balances': balances}, fp, encoding = 'latin-1')
+				fp.flush()
+				os.fsync(fp.fileno())
+			if os.name == 'nt' and os.path.exists(self.snapshotname): os.remove(self.snapshotname) # can't rename over a file
+			os.rename(tmpname, self.snapshotname)
+		except (IOError, OSError) as e:
+			logging.error("Ledger: unable to write snapshot (%s)." % e)
+			return
+		
+		self.log.seek(0)
+		self.log.truncate()
+		self.good = 0
+		self.snapshotseq = seq
+		logging.info("Ledger: snapshot at record %d." % seq)
+
+# end-of-game payouts, worked out and put on the books away from the tables
+# a table hands over a finished game and moves on; the stage thread takes every game waiting at once,
+# splits each pot, commits the lot to the ledger with one wait, then hands each game's spoils to deliver
+# a game is (tableid, ((pid, name, contribution, score), ...) for everyone who played, ids of everyone else at the table)
+# spoils are ((pid, count, color), ...) as in the spoils command
+class SettlementStage:
+	
+	def __init__(self, ledger, deliver):
+		self.ledger = ledger
+		self.deliver = deliver # deliver(tableid, spoils), called on the stage thread
+		self.queue = Queue.Queue()
+		self.rng = random.Random()
+		self.nbatches = self.ngames = 0
+	
+	def start(self):
+		self.thread = threading.Thread(target = self.run, name = 'settlement')
+		self.thread.daemon = True # so that it will not attempt to persist when the program terminates
+		self.thread.start()
+	
+	def submit(self, tableid, entries, otherids):
+		self.queue.put((tableid, entries, otherids))
+	
+	# finish what's been submitted, then end the thread
+	def stop(self):
+		self.queue.put(None)
+		self.thread.join()
+	
+	# runs as thread
+	def run(self):
+		while True:
+			games = [self.queue.get()]
+			while True:
+				try: games.append(self.queue.get_nowait())
+				except Queue.Empty: break
+			stopping = None in games
+			games = [game for game in games if game is not None]
+			
+			results = []
+			for tableid, entries, otherids in games:
+				spoils, records = self.split(entries, otherids)
+				results.append((tableid, spoils, records))
+			self.ledger.wait(self.ledger.settlemany([(tableid, records) for tableid, spoils, records in results]))
+			self.nbatches += 1
+			self.ngames += len(games)
+			
+			for tableid, spoils, records in results:
+				self.deliver(tableid, spoils)
+			if stopping: return
+	
+	# pot goes to the best score, split evenly in yellows with the odd ones given out at random
+	# returns (spoils, ledger records)
+	def split(self, entries, otherids):
+		contributions = [contribution for pid, name, contribution, score in entries]
+		pot = contributions[0]
+		for contribution in contributions[1:]:
+			pot += contribution
+		best = min([score for pid, name, contribution, score in entries])
+		winnerids = [pid for pid, name, contribution, score in entries if score == best]
+		
+		share, residue = divmod(pot.value(), len(winnerids))
+		incomes = dict.fromkeys(winnerids, share)
+		for pid in self.rng.sample(winnerids, residue):
+			incomes[pid] += 1
+		
+		spoils = []
+		for pid in winnerids:
+			income = Seeds.ofvalue(incomes[pid], pot.getcolor())
+			spoils.append((pid, income.getcount(), income.getcolor()))
+		for pid in [pid for pid, name, contribution, score in entries if pid not in incomes] + list(otherids):
+			spoils.append((pid, 0, pot.getcolor()))
+		
+		records = [(name, contribution.value(), incomes.get(pid, 0)) for pid, name, contribution, score in entries]
+		return tuple(spoils), records
+
+# exact odds derived from the scoring rules (DIE, CODEBOOK, FORFEITSCORE, LONERSCORE)
+# a game is only len(DIE)**3 outcomes per player, so everything is enumerated exactly in fractions
+# results are memoized, so repeat queries (e.g. during the response phase) are dict lookups
+# hands are as from Player.gethand(): '' (not yet rolled), 'RB', 'RBX' (forfeited), 'RBG'
+class Odds:
+	
+	def __init__(self):
+		self.rollprobs = dict([(color, fractions.Fraction(DIE.count(color), len(DIE))) for color in DIE_COLORS])
+		self.dists = {} # hand: {score: probability}
+		self.results = {} # (hand, other hands): (win, tie, share)
+	
+	# distribution of the final score of a hand that is played out to three rolls
+	# e.g. scoredist() is the distribution of Player.getscore for a fresh hand, scoredist('RB') given two rolls
+	def scoredist(self, hand = ''):
+		hand = ''.join(sorted(hand)) # order of the rolls doesn't matter
+		if hand in self.dists: return self.dists[hand]
+		
+		if 'X' in hand: dist = {FORFEITSCORE: fractions.Fraction(1)}
+		elif len(hand) == 3: dist = {CODEBOOK[hand]: fractions.Fraction(1)}
+		else:
+			dist = {}
+			for color, p in self.rollprobs.iteritems():
+				for score, q in self.scoredist(hand + color).iteritems():
+					dist[score] = dist.get(score, 0) + p * q
+		self.dists[hand] = dist
+		return dist
+	
+	# chances of hand coming out on top against the other hands at the table
+	# returns (win, tie, share) - outright win, tie for first, and expected fraction of the pot
+	def against(self, hand = '', others = ('',)):
+		key = (''.join(sorted(hand)), tuple(sorted([''.join(sorted(other)) for other in others])))
+		if key in self.results: return self.results[key]
+		hand, others = key
+		
+		mine = self.scoredist(hand)
+		if 'X' not in hand and all(['X' in other for other in others]):
+			mine = {LONERSCORE: fractions.Fraction(1)} # everyone else forfeited
+		
+		win = tie = share = fractions.Fraction(0)
+		for score, p in mine.iteritems():
+			# ways[k] - probability that no one beats score and exactly k others match it
+			ways = [fractions.Fraction(1)]
+			for other in others:
+				dist = self.scoredist(other)
+				worse = sum([q for s, q in dist.iteritems() if s > score])
+				level = dist.get(score, 0)
+				ways = [a * worse + b * level for a, b in zip(ways + [0], [0] + ways)]
+			win += p * ways[0]
+			tie += p * sum(ways[1:])
+			share += p * sum([a / (k + 1) for k, a in enumerate(ways)])
+		
+		self.results[key] = (win, tie, share)
+		return win, tie, share
+	
+	# odds for a hand in a game of nplayers where nothing is known about the others
+	def winodds(self, nplayers, hand = ''):
+		return self.against(hand, ('',) * (nplayers - 1))
+
+# the expected-value maximizing continue/forfeit/double response for every table of 2-roll hands
+# everyone sees every hand (handrelay) before responding in private, so the solver iterates best responses
+#  (in units of the wager, under the liability and pot rules of the denouement) until no hand gains by switching
+# hands alike respond alike, ties go to the response already held
+# worked out once for every table up to POLICY_MAX_PLAYERS and kept in POLICY_FNAME, one table per line e.g.
+#  BB,GR,RR ccd
+# the client loads it in the background (prepare), hints asked for before it's ready solve just their own table
+class Policy:
+	
+	def __init__(self, odds, fname = POLICY_FNAME):
+		self.odds = odds
+		self.fname = fname
+		self.table = None # sorted hands: responses in the same order
+		self.solved = {} # as table, for tables solved on demand
+		self.loading = None # background load thread
+	
+	# load in the background, so that nobody waits on the strategy being worked out (seconds, the first time)
+	def prepare(self):
+		self.loading = threading.Thread(target = self.load, name = 'policy')
+		self.loading.daemon = True # so that it will not attempt to persist when the program terminates
+		self.loading.start()
+	
+	# the best response for hand at a table with the others, and its expected result in wagers
+	def hint(self, hand, others):
+		if self.table is None and self.loading is None: self.load()
+		hand = ''.join(sorted(hand))
+		hands = tuple(sorted([hand] + [''.join(sorted(other)) for other in others]))
+		responses = (self.table or {}).get(hands) or self.solved.get(hands)
+		if responses is None: responses = self.solved[hands] = self.solve(hands)
+		i = hands.index(hand)
+		return responses[i], self.ev(i, hands, responses)
+	
+	# expected net result for player i in wagers, given everyone's responses
+	def ev(self, i, hands, responses):
+		nround2 = len(responses) - responses.count('f')
+		if nround2 == 0: return 0 # everyone forfeited, no contest
+		ndoubled = responses.count('d')
+		if responses[i] == 'f': return -ndoubled # forfeiting always loses
+		others = [hands[j] + 'X' * (responses[j] == 'f') for j in xrange(len(hands)) if j != i]
+		share = self.odds.against(hands[i], others)[2]
+		pot = (ndoubled + 1) * len(hands) - responses.count('f')
+		return share * pot - (ndoubled + 1)
+	
+	def solve(self, hands):
+		responses = ['c'] * len(hands)
+		for iteration in xrange(20): # settles in a few, the cap guards against cycling
+			changed = False
+			for hand in sorted(set(hands)):
+				alike = [i for i in xrange(len(hands)) if hands[i] == hand]
+				values = {}
+				for response in 'cfd':
+					trial = responses[:]
+					trial[alike[0]] = response
+					values[response] = self.ev(alike[0], hands, trial)
+				best = max('cfd', key = lambda response: (values[response], response == responses[alike[0]]))
+				if best != responses[alike[0]]:
+					changed = True
+					for i in alike: responses[i] = best
+			if not changed: break
+		return ''.join(responses)
+	
+	# every table of 2-roll hands up to POLICY_MAX_PLAYERS
+	def build(self):
+		kinds = sorted(set([''.join(sorted(hand)) for hand in itertools.product(DIE_COLORS, repeat = 2)]))
+		table = {}
+		for nplayers in xrange(2, POLICY_MAX_PLAYERS + 1):
+			for hands in itertools.combinations_with_replacement(kinds, nplayers):
+				table[hands] = self.solve(hands)
+		return table
+	
+	# the cache is only good for the rules it was worked out under
+	def signature(self):
+		rules = (DIE, sorted(CODEBOOK.items()), FORFEITSCORE, LONERSCORE, POLICY_MAX_PLAYERS)
+		return hashlib.md5(repr(rules)).hexdigest()
+	
+	# read the cached strategy, working it out (and caching it) if missing or outdated
+	# the table only appears once it's complete
+	def load(self):
+		try:
+			with open(self.fname) as f:
+				lines = f.read().splitlines()
+		except IOError:
+			lines = []
+		if lines and lines[0] == self.signature():
+			table = {}
+			for line in lines[1:]:
+				hands, responses = line.split()
+				table[tuple(hands.split(','))] = responses
+			self.table = table
+			return
 		
-		for value in COLOR_VALS:
-			color = COLOR_VAL_INV[value]
-			count, remaining = divmod(remaining, value)
-			self.bank[color] = count
+		logging.info("Working out the response strategy for up to %d players..." % POLICY_MAX_PLAYERS)
+		self.table = self.build()
+		try:
+			with open(self.fname, 'w') as f:
+				f.write(self.signature() + '\n')
+				for hands in sorted(self.table):
+					f.write("%s %s\n" % (','.join(hands), self.table[hands]))
+		except IOError:
+			logging.warning("Unable to save the response strategy to %s." % self.fname)
+
+# headless games in bulk - ntables independent tables of one player per strategy, held as numpy arrays
+# every table plays ngames back to back: everyone who can cover the wager accepts, rolls twice, responds
+#  by their seat's strategy, rolls again, contributes their liability (or what's left of their bankroll)
+#  and the pot is split between the winners as the server does it, residue to randomly chosen winners
+# strategies are from SIMULATION_STRATEGIES, 'policy' plays the solved Policy for the hands at the table
+# doubling takes a bankroll of twice the wager (as the CLI insists), short of that a double is a continue
+class Simulator:
+	
+	def __init__(self, strategies, wager = SIMULATION_WAGER, bankroll = SIMULATION_BANKROLL):
+		if numpy is None:
+			raise Exception("The simulator needs NumPy - try pip install numpy.")
+		for strategy in strategies:
+			if strategy not in SIMULATION_STRATEGIES:
+				raise Exception("Unknown strategy %s. Try one of these: %s" % (strategy, ' '.join(SIMULATION_STRATEGIES)))
+		self.strategies = strategies
+		self.nplayers = len(strategies)
+		self.wager = wager
+		self.bankroll = bankroll
+		
+		# rolls are indices into DIE
+		# scores[a, b, c] - score of a full hand
+		# handtypes[a, b] - index into hands of a 2-roll hand
+		faces = xrange(len(DIE))
+		self.hands = sorted(set([''.join(sorted(hand)) for hand in itertools.product(DIE_COLORS, repeat = 2)]))
+		self.scores = numpy.array([[[CODEBOOK[''.join(sorted(DIE[a] + DIE[b] + DIE[c]))] for c in faces] for b in faces] for a in faces])
+		self.handtypes = numpy.array([[self.hands.index(''.join(sorted(DIE[a] + DIE[b]))) for b in faces] for a in faces])
+		
+		# the policy as an array - responses[table, handtype] is an index into 'cfd'
+		# table numbers the hands present: sum of count(handtype) * (nplayers + 1) ** handtype
+		self.radix = (self.nplayers + 1) ** numpy.arange(len(self.hands))
+		if 'policy' in strategies:
+			if self.nplayers > POLICY_MAX_PLAYERS:
+				raise Exception("The policy only covers tables of up to %d players." % POLICY_MAX_PLAYERS)
+			policy = Policy(Odds())
+			policy.load()
+			self.responses = numpy.zeros(((self.nplayers + 1) ** len(self.hands), len(self.hands)), dtype = numpy.int8)
+			for hands, responses in policy.table.iteritems():
+				if len(hands) > self.nplayers: continue
+				counts = numpy.array([hands.count(hand) for hand in self.hands])
+				for hand, response in zip(hands, responses):
+					self.responses[counts.dot(self.radix), self.hands.index(hand)] = 'cfd'.index(response)
+	
+	# play, returns the totals: games, net and wins (per seat), responses (per seat, c/f/d), busted (per seat)
+	def run(self, ntables, ngames, seed = 0):
+		dice = DiceRNG(seed)
+		rng = dice.generator()
+		wager = self.wager
+		bank = numpy.empty((ntables, self.nplayers), dtype = numpy.int64)
+		bank.fill(self.bankroll)
+		totals = {'games': 0,
+				  'net': numpy.zeros(self.nplayers, dtype = numpy.int64),
+				  'wins': numpy.zeros(self.nplayers, dtype = numpy.int64),
+				  'responses': numpy.zeros((self.nplayers, 3), dtype = numpy.int64)}
+		
+		for game in xrange(ngames):
+			# wager / accept
+			accepted = bank >= wager
+			accepted &= (accepted.sum(1) >= 2)[:, None]
+			totals['games'] += int(accepted.any(1).sum())
+			
+			# round 1 / response
+			rolls = dice.bulk((ntables, self.nplayers, 3))
+			handtype = self.handtypes[rolls[:, :, 0], rolls[:, :, 1]]
+			responses = numpy.zeros((ntables, self.nplayers), dtype = numpy.int8)
+			if 'policy' in self.strategies:
+				present = (handtype[:, :, None] == numpy.arange(len(self.hands))) & accepted[:, :, None]
+				table = present.sum(1).dot(self.radix)
+			for seat, strategy in enumerate(self.strategies):
+				if strategy == 'policy': responses[:, seat] = self.responses[table, handtype[:, seat]]
+				elif strategy == 'random': responses[:, seat] = rng.randint(0, 3, size = ntables)
+				else: responses[:, seat] = 'cfd'.index(strategy[0])
+			responses[(responses == 2) & (bank < 2 * wager)] = 0
+			forfeited = accepted & (responses == 1)
+			doubled = accepted & (responses == 2)
+			contest = (accepted & ~forfeited).any(1)[:, None] # everyone forfeiting is a draw
+			for response in xrange(3):
+				totals['responses'][:, response] += (accepted & (responses == response)).sum(0)
+			
+			# round 2 / denouement
+			score = self.scores[rolls[:, :, 0], rolls[:, :, 1], rolls[:, :, 2]]
+			score[forfeited] = FORFEITSCORE
+			score[~accepted] = FORFEITSCORE + 1
+			liability = wager * (doubled.sum(1)[:, None] + 1) - wager * forfeited
+			contribution = numpy.minimum(liability, bank) * (accepted & contest)
+			pot = contribution.sum(1)
+			
+			# spoils - split evenly, residue one apiece to randomly chosen winners
+			winners = accepted & contest & (score == score.min(1)[:, None])
+			nwinners = numpy.maximum(winners.sum(1), 1)
+			share, residue = pot // nwinners, pot % nwinners
+			draw = numpy.where(winners, rng.random_sample((ntables, self.nplayers)), 2.0).argsort(1).argsort(1)
+			income = (share[:, None] + (draw < residue[:, None])) * winners
+			
+			bank += income - contribution
+			totals['net'] += (income - contribution).sum(0)
+			totals['wins'] += winners.sum(0)
+		
+		totals['busted'] = (bank < wager).sum(0)
+		return totals
+
+# one process's share of a simulation, module level so multiprocessing can hand it out
+def simulate_worker(job):
+	strategies, ntables, ngames, seed, index, wager, bankroll = job
+	return Simulator(strategies, wager, bankroll).run(ntables, ngames, seed = (seed, index))
+
+# spread ntables over nprocesses, each seeded from seed and its index so a run can be repeated exactly
+# (given the same number of processes), returns the combined totals
+def simulate(strategies, ntables, ngames, nprocesses = 1, seed = 0, wager = SIMULATION_WAGER, bankroll = SIMULATION_BANKROLL):
+	if 'policy' in strategies: Policy(Odds()).load() # so that the workers find it worked out already
+	counts = [ntables // nprocesses + (index < ntables % nprocesses) for index in xrange(nprocesses)]
+	jobs = [(strategies, count, ngames, seed, index, wager, bankroll) for index, count in enumerate(counts) if count]
+	if nprocesses == 1:
+		results = map(simulate_worker, jobs)
+	else:
+		pool = multiprocessing.Pool(nprocesses)
+		results = pool.map(simulate_worker, jobs)
+		pool.close()
+	totals = results[0]
+	for result in results[1:]:
+		for key in totals: totals[key] = totals[key] + result[key]
+	return totals
+
+# run from the command line: python bones.py simulate strategy,strategy,... [ntables] [ngames] [nprocesses] [seed]
+def simulation_report(args):
+	strategies = args[0].split(',') if args else ['policy', 'continue']
+	ntables, ngames, nprocesses, seed = ([int(arg) for arg in args[1:]] + [10000, 100, multiprocessing.cpu_count(), 0][len(args[1:]):])[:4]
+	
+	t0 = time.time()
+	totals = simulate(strategies, ntables, ngames, nprocesses, seed)
+	seconds = time.time() - t0
+	
+	print "%d games at %d tables in %.2f s (%d processes) - %.0f games/s" % \
+		(totals['games'], ntables, seconds, nprocesses, totals['games'] / seconds)
+	print " seat | strategy | wins   | net/game | continue forfeit double | busted"
+	for seat, strategy in enumerate(strategies):
+		responses = totals['responses'][seat] * 100.0 / max(totals['responses'][seat].sum(), 1)
+		print " %4d | %-8s | %5.1f%% | %+8.3f | %7.1f%% %6.1f%% %5.1f%% | %5.1f%%" % \
+			(seat, strategy, totals['wins'][seat] * 100.0 / totals['games'], float(totals['net'][seat]) / totals['games'],
+			 responses[0], responses[1], responses[2], totals['busted'][seat] * 100.0 / ntables)
 
 # base class for server and client game management containing mutually necessary functions
 # useless independently
@@ -515,6 +1440,14 @@ class Game:
 	def __init__(self):
 		self.rankingsknown = False
 		self.wager = Seeds(0, COLOR_BASE)
+		self.players = {}
+		
+		# running counts of players by state, kept in step by the players themselves (see tally)
+		# so that checking whether a phase is complete doesn't take a pass over every player
+		self.acceptcounts = [0] * len(ACCEPT_SYMBOLS)
+		self.responsecounts = [0] * len(RESPONSE_SYMBOLS)
+		self.rollcounts = [0] * (max(NROLLS) + 1)
+		self.ncontributors = 0
 	
 	def __str__(self):
 		lines = []
@@ -559,28 +1492,65 @@ class Game:
 			total += c
 		return total
 		
+	# players come and go through these so that the counts stay right
+	def addplayer(self, player):
+		self.players[player.getid()] = player
+		player.game = self
+		self.tally(player, 1)
+		if GAME_DEBUG_INVARIANTS: self.checkcounts()
+	def removeplayer(self, pid):
+		player = self.players.pop(pid)
+		self.tally(player, -1)
+		player.game = None
+		if GAME_DEBUG_INVARIANTS: self.checkcounts()
+	
+	# count a player in (sign 1) or out (sign -1) under their current state
+	def tally(self, player, sign):
+		self.acceptcounts[player.acceptstatus] += sign
+		self.responsecounts[player.response] += sign
+		self.rollcounts[NROLLS[player.hand]] += sign
+		if player.contributed(): self.ncontributors += sign
+	
+	# the counts the hard way, for checking the running ones
+	def recount(self):
+		acceptcounts = [0] * len(self.acceptcounts)
+		responsecounts = [0] * len(self.responsecounts)
+		rollcounts = [0] * len(self.rollcounts)
+		ncontributors = 0
+		for player in self.playerlist():
+			acceptcounts[player.acceptstatus] += 1
+			responsecounts[player.response] += 1
+			rollcounts[player.nrolls()] += 1
+			ncontributors += player.contributed()
+		return acceptcounts, responsecounts, rollcounts, ncontributors
+	
+	def checkcounts(self):
+		counts = (self.acceptcounts, self.responsecounts, self.rollcounts, self.ncontributors)
+		if counts != self.recount():
+			raise Exception("Player counts out of step: kept %s, recounted %s" % (counts, self.recount()))
+	
 	###############################################
 	### COUNT PLAYERS WITH PARTICULAR CHACTERISTICS
 	
 	def nplayers(self):	return len(self.players)
 	
 	# number of player who've rolled n times (to our knowledge)
-	def nrolled(self, n): return sum([player.nrolls() == n for player in self.playerlist()])
+	def nrolled(self, n): return self.rollcounts[n] if 0 <= n < len(self.rollcounts) else 0
 	
-	def naccepted(self): return sum([player.accepted() for player in self.playerlist()])
-	def nrejected(self): return sum([player.rejected() for player in self.playerlist()])
+	def naccepted(self): return self.acceptcounts[ACCEPT_ACCEPTED]
+	def nrejected(self): return self.acceptcounts[ACCEPT_REJECTED]
 	def nrespondents(self):	return self.naccepted() + self.nrejected()
 	
-	def ncontinued(self): return sum([player.continued() for player in self.playerlist()])
-	def nforfeited(self): return sum([player.forfeited() for player in self.playerlist()])
-	def ndoubled(self): return sum([player.doubled() for player in self.playerlist()])
+	def ncontinued(self): return self.responsecounts[RESPONSE_CONTINUED]
+	def nforfeited(self): return self.responsecounts[RESPONSE_FORFEITED]
+	def ndoubled(self): return self.responsecounts[RESPONSE_DOUBLED]
 	# number of players who get to participate in round2 (responded continue or double)
 	def nround2(self): return self.ncontinued() + self.ndoubled()
 	
 	# number who have continue/forfeit/double values assigned
 	def ncfd(self): return self.ncontinued() + self.nforfeited() + self.ndoubled()
 	
-	def ncontributed(self): return sum([player.contributed() for player in self.playerlist()])
+	def ncontributed(self): return self.ncontributors
 	
 	def nwinners(self): return len(self.winners())
 	
@@ -609,24 +1579,17 @@ class Game:
 	# determines the ranking of scores and saves it for every player
 	def calcrankings(self):
 		accepted_players = self.accepted_players()
-		scores = [player.getscore() for player in accepted_players]
-		scores.sort()
-		
-		# make a LUT to convert scores into rankings (incl. ties) e.g.
-		# [4, 4, 7, 11, 11, 11, 12] ->
-		#  {4:1, 7:3, 11:4, 12:7}
-		#  4 is 1st, 7 is 3rd, 11 is 4th, 12 is 7th
-		ranking = {}
-		i = 1
-		for score in scores:
-			if score not in ranking:
-				ranking[score] = i
-			i += 1
-		# alternate algorithm: start with worst rank and fill in ranking unconditionally
-		# ties will be naturally overridden instead of creating a new entry in dict
-		#scores.reverse()
-		#i = len(scores)
-		#for score in scores: ranking[score]=i; i-=1
+		
+		# count the players on each score, then turn the counts into rankings (incl. ties) e.g.
+		# scores 4, 4, 7, 11, 11, 11 ->
+		#  4 is 1st, 7 is 3rd, 11 is 4th
+		# scores are bounded (SCORE_RANGE) so this is a counting sort rather than a sort
+		ranking = [0] * SCORE_RANGE
+		for player in accepted_players:
+			ranking[player.getscore()] += 1
+		rank = 1
+		for score in xrange(SCORE_RANGE):
+			rank, ranking[score] = rank + ranking[score], rank
 		
 		for player in accepted_players:
 			player.setrank(ranking[player.getscore()])
@@ -640,8 +1603,16 @@ class GameClient(Game):
 		Game.__init__(self)
 		player = Player(DEFAULT_PLAYER_NAME)
 		self.localplayerid = player.getid()
-		self.players = {player.getid(): player}
-		self.ni = NetworkInterfaceClient(self)
+		self.addplayer(player)
+		self.tableid = None # table we're seated at on the server
+		self.tablename = ''
+		self.odds = Odds()
+		self.policy = Policy(self.odds) # loaded on first use
+		self.rollmode = 'client' # until the server says otherwise
+		self.dice = None # this game's DiceRNG when we roll our own
+		self.dicecommit = None # the server's commitment to this game's dice when it rolls
+		if CLIENT_IO_MODE == 'async': self.ni = AsyncNetworkInterfaceClient(self)
+		else: self.ni = NetworkInterfaceClient(self)
 		self.status = 'disconnected'
 		
 		# configure logger
@@ -650,24 +1621,45 @@ class GameClient(Game):
 		# configure user interface as CLI or GUI
 		if useGUI: self.ui = GUI(self)
 		else: self.ui = CLI(self)
+	
+	def start(self):
+		self.policy.prepare() # while the player is still entering their name
+		Game.start(self)
 		
 	# accesses the local player
 	def localplayer(self):
 		if self.localplayerid is not None: # necessary language because id can be zero
 			return self.players[self.localplayerid]
 
-# server-side container for game data and management
-class GameServer(Game):
+# server-side container for a single table's game data
+# the server hosts many of these at once, each an independent game
+class GameTable(Game):
 	
-	def __init__(self):
+	def __init__(self, id, name):
 		Game.__init__(self)
+		self.id = id
+		self.name = name
 		self.localplayerid = None
-		self.players = {}
-		self.ni = NetworkInterfaceServer(self)
-		self.ui = None # no user interface to the server
 		self.status = 'forum'
-		
+		self.dice = None # the current game's DiceRNG, in server roll mode
+		self.seq = 0 # messages sent to the table so far
+		self.transcript = collections.deque(maxlen = TRANSCRIPT_LENGTH) # the latest of them, as (seq, command, args)
+		self.gameno = 0 # games (or wagers) the table has been through
+		self.turn = None # (gameno, status) the table was last seen waiting in...
+		self.turnstart = 0 # ...and since when
+		self.contributors = set() # ids that have reported their contribution, which may be nothing after a forfeit
+	
+	def forumreset(self):
+		Game.forumreset(self)
+		self.gameno += 1
+		self.contributors = set()
+
+# server-side manager of every table and every connected player
+class GameServer:
+	
+	def __init__(self):
 		# configure logger to file and to console
+		# first, so that nothing logged below configures it by default
 		logging.basicConfig(level = SERVER_LOGGING_LEVEL,
 							filename = SERVER_LOGFILENAME,
 							format = LOGGING_FORMAT,
@@ -677,15 +1669,595 @@ class GameServer(Game):
 		console.setFormatter(logging.Formatter(LOGGING_FORMAT, LOGGING_DATE_FORMAT))
 		logging.getLogger().addHandler(console)
 		
+		self.players = {} # every named player, by id
+		self.tables = {} # table id: GameTable
+		self.seats = {} # player id: table id
+		self.nexttableid = 1
+		self.lock = threading.RLock() # guards the above when tables are handled on separate shards
+		self.createtable(DEFAULT_TABLE_NAME)
+		self.ledger = Ledger()
+		
+		if SERVER_IO_MODE == 'async': self.ni = AsyncNetworkInterfaceServer(self)
+		else: self.ni = NetworkInterfaceServer(self)
+		self.ui = None # no user interface to the server
+	
+	def start(self):
+		self.ledger.open()
+		self.ni.start()
+		while True: time.sleep(1000)
+	
+	# open a new table, returns it
+	def createtable(self, name):
+		table = GameTable(self.nexttableid, name)
+		self.tables[table.id] = table
+		self.nexttableid += 1
+		logging.info("Table %d (%s) created." % (table.id, name))
+		return table
+	
+	# the table a player is seated at, None if they're in the lobby
+	def tableof(self, pid): return self.tables.get(self.seats.get(pid))
+	
+	def seat(self, pid, tableid):
+		self.seats[pid] = tableid
+		self.tables[tableid].addplayer(self.players[pid])
+	
+	# take a player out of their table, returns the table they left
+	# tables other than the default one are closed once they're empty
+	def unseat(self, pid):
+		table = self.tableof(pid)
+		if table is None: return
+		del self.seats[pid]
+		table.removeplayer(pid)
+		if table.nplayers() == 0 and table.id != DEFAULT_TABLE_ID:
+			del self.tables[table.id]
+			logging.info("Table %d (%s) closed." % (table.id, table.name))
+		return table
+	
+	# summary of every table for the lobby e.g. ((1, 'main', 3, 'forum'), (2, 'high rollers', 2, 'round1'))
+	def tablelist(self):
+		with self.lock:
+			return tuple([(table.id, table.name, table.nplayers(), table.status) for tableid, table in sorted(self.tables.iteritems())])
+		
+# binary protocol encoding - see wire protocols under constants
+
+def packvarint(n):
+	out = []
+	while n > 0x7f:
+		out.append(chr(0x80 | (n & 0x7f)))
+		n >>= 7
+	out.append(chr(n))
+	return ''.join(out)
+
+# returns (value, position after it), or None if the buffer ends first
+def unpackvarint(buffer, pos, end):
+	n, shift = 0, 0
+	while pos < end:
+		byte = buffer[pos]
+		n |= (byte & 0x7f) << shift
+		pos += 1
+		if byte < 0x80: return n, pos
+		shift += 7
+	return None
+
+# append the tagged encoding of value to the list out
+def packvalue(value, out):
+	if value is None: out.append('\x80')
+	elif value is False: out.append('\x81')
+	elif value is True: out.append('\x82')
+	elif isinstance(value, (int, long)):
+		if 0 <= value <= 0x7f: out.append(chr(value))
+		else: out.append('\x83' + packvarint(value * 2 if value >= 0 else -value * 2 - 1))
+	elif isinstance(value, str):
+		if value in WIRE_SYMBOL_LUT: out.append(chr(0xc0 + WIRE_SYMBOL_LUT[value]))
+		else: out.append('\x84' + packvarint(len(value)) + value)
+	elif isinstance(value, tuple):
+		out.append('\x85' + packvarint(len(value)))
+		for item in value:
+			packvalue(item, out)
+	else:
+		raise ValueError("Unable to encode for binary protocol: %r" % (value,))
+
+# returns (value, position after it)
+# caller guarantees the whole value is in the buffer
+def unpackvalue(buffer, pos):
+	tag = buffer[pos]
+	pos += 1
+	if tag < 0x80: return tag, pos
+	if tag >= 0xc0: return WIRE_SYMBOLS[tag - 0xc0], pos
+	if tag == 0x80: return None, pos
+	if tag == 0x81: return False, pos
+	if tag == 0x82: return True, pos
+	n, pos = unpackvarint(buffer, pos, len(buffer))
+	if tag == 0x83: return (n >> 1 if n & 1 == 0 else -((n + 1) >> 1)), pos
+	if tag == 0x84: return str(buffer[pos:pos + n]), pos + n
+	if tag == 0x85:
+		items = []
+		for i in xrange(n):
+			item, pos = unpackvalue(buffer, pos)
+			items.append(item)
+		return tuple(items), pos
+	raise ValueError("Unknown binary protocol tag: %#x" % tag)
+
+# a complete binary packet
+def binaryframe(command, args):
+	payload = []
+	if args != '': packvalue(args, payload)
+	payload = ''.join(payload)
+	return chr(BINARY_MARKER) + chr(OPCODE_LUT[command]) + packvarint(len(payload)) + payload
+
+# incremental decoder for the rx byte stream
+# packet structure is command:arglength:argstring|
+# e.g.: contribution:12:Seeds(5,'y')|
+# e.g.: forum:0:|
+# final pipe is a waste of space, but since network activity is fairly low, keep for readability of data stream
+# data is received straight into one preallocated bytearray and parsed in place with offset cursors,
+# so each byte is looked at once no matter how many packets arrive pipelined in a single recv
+class FrameDecoder:
+	
+	def __init__(self, size = RX_BUFFER_SIZE, limit = None):
+		self.buffer = bytearray(size)
+		self.limit = limit # unparsed bytes we'll hold before overflowing says so, None for no limit
+		self.start = 0 # first unparsed byte
+		self.end = 0 # one past the last byte received
+		self.header = None # (command, argstart, argstop) of a packet still waiting for its args
+	
+	# number of received bytes not yet parsed into packets
+	def __len__(self): return self.end - self.start
+	
+	# whether the sender has left more unparsed than we'll hold (an oversized or never-ending packet)
+	def overflowing(self): return self.limit is not None and self.end - self.start > self.limit
+	
+	# guarantee room for n more bytes at the end of the buffer
+	# slides unparsed data to the front first, and only grows the buffer if that isn't enough
+	def reserve(self, n):
+		if len(self.buffer) - self.end >= n: return
+		if self.start > 0:
+			unparsed = self.end - self.start
+			self.buffer[:unparsed] = self.buffer[self.start:self.end]
+			if self.header:
+				command, argstart, argstop = self.header
+				self.header = (command, argstart - self.start, argstop - self.start)
+			self.start, self.end = 0, unparsed
+		if len(self.buffer) - self.end < n:
+			self.buffer.extend(bytearray(max(n, len(self.buffer))))
+	
+	# receive directly from a socket into the buffer, returns number of bytes received (0 if closed)
+	def recv_into(self, sock):
+		self.reserve(RX_CHUNK_SIZE)
+		nbytes = sock.recv_into(memoryview(self.buffer)[self.end:], RX_CHUNK_SIZE)
+		self.end += nbytes
+		return nbytes
+	
+	# append data that has already been received some other way
+	def feed(self, data):
+		self.reserve(len(data))
+		self.buffer[self.end:self.end + len(data)] = data
+		self.end += len(data)
+	
+	# parse as many complete packets as possible, returns a list of (command, args)
+	def packets(self):
+		packets = []
+		buffer = self.buffer
+		while True:
+			# binary frames are recognised by their first byte
+			if self.header is None and self.start < self.end and self.buffer[self.start] == BINARY_MARKER:
+				packet = self.binarypacket()
+				if packet is None: break
+				packets.append(packet)
+				continue
+			
+			# waiting for a header
+			if self.header is None:
+				colon1 = buffer.find(':', self.start, self.end)
+				if colon1 < 0: break
+				colon2 = buffer.find(':', colon1 + 1, self.end)
+				if colon2 < 0: break
+				arg_length = buffer[colon1 + 1:colon2]
+				if not arg_length.isdigit():
+					logging.error("Malformed packet header in rx: %s" % buffer[self.start:colon2 + 1])
+					raise Exception("Bad packet in rx")
+				command = str(buffer[self.start:colon1])
+				self.header = (command, colon2 + 1, colon2 + 1 + int(arg_length))
+			
+			# waiting for argument data and the closing pipe
+			command, argstart, argstop = self.header
+			if argstop >= self.end: break
+			if buffer[argstop] != ord('|'):
+				logging.error("Malformed packet in rx:")
+				logging.error("  >%s:%s:%s" % (command, argstop - argstart, buffer[argstart:self.end]))
+				raise Exception("Bad packet in rx")
+			packets.append((command, str(buffer[argstart:argstop])))
+			self.start = argstop + 1
+			self.header = None
+		
+		# rewind for free once everything has been consumed
+		if self.start == self.end and self.header is None:
+			self.start = self.end = 0
+		return packets
+	
+	# parse one binary frame at the start of the unparsed data, None if it hasn't all arrived
+	def binarypacket(self):
+		if self.end - self.start < 3: return None
+		opcode = self.buffer[self.start + 1]
+		length = unpackvarint(self.buffer, self.start + 2, self.end)
+		if length is None: return None
+		length, argstart = length
+		if argstart + length > self.end: return None
+		if opcode >= len(OPCODES):
+			logging.error("Unknown binary opcode in rx: %d" % opcode)
+			raise Exception("Bad packet in rx")
+		args = ''
+		if length: args = unpackvalue(self.buffer, argstart)[0]
+		self.start = argstart + length
+		return OPCODES[opcode], args
+
+# writes are already coalesced per command, so Nagle's algorithm would only add delay
+# (holding a batch back until the previous one is acked), turn it off where there's TCP
+def nodelay(sock):
+	try:
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	except socket.error:
+		pass
+
+# connections that can't answer pings are checked on by TCP keepalive instead, where the platform lets us tune it
+def keepalive(sock):
+	try:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+		if hasattr(socket, 'TCP_KEEPIDLE'):
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, HEARTBEAT_TIMEOUT)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, HEARTBEAT_INTERVAL)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+		elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+			sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, HEARTBEAT_TIMEOUT * 1000, HEARTBEAT_INTERVAL * 1000))
+	except socket.error:
+		pass
+
+# a connected pair of non-blocking sockets, (reader, writer) - a byte written to one wakes a loop waiting on the other
+# built from a loopback connection since socket.socketpair isn't available on windows
+def wakepair():
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(1)
+	writer = socket.create_connection(listener.getsockname())
+	reader, address = listener.accept()
+	listener.close()
+	reader.setblocking(False)
+	writer.setblocking(False)
+	return reader, writer
+
+# connect to whichever of the candidate addresses answers first, trying them all at once
+# more addresses may turn up on the queue 'more' while we wait (None marks the last of them)
+# an address is written off timeout seconds after it was tried, returns (socket, ip) or (None, None)
+def probe(ips, port, timeout, more = None):
+	pending = {} # socket: (ip, deadline)
+	tried = set()
+	winner = None, None
+	while True:
+		# take on anything newly discovered
+		while more is not None:
+			try:
+				ip = more.get_nowait()
+			except Queue.Empty:
+				break
+			if ip is None: more = None
+			else: ips.append(ip)
+		for ip in ips:
+			if not ip or ip in tried: continue
+			tried.add(ip)
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.setblocking(0)
+			try:
+				err = sock.connect_ex((ip, port))
+			except socket.error: # unresolvable
+				err = errno.EINVAL
+			if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', None)):
+				pending[sock] = ip, time.time() + timeout
+			else:
+				sock.close()
+		ips = []
+		
+		now = time.time()
+		for sock, (ip, deadline) in pending.items():
+			if deadline <= now:
+				sock.close()
+				del pending[sock]
+		if not pending and more is None: break
+		
+		# while discovery is still going, look back for it regularly
+		wait = min([deadline for ip, deadline in pending.values()] or [now + timeout]) - now
+		if more is not None: wait = min(wait, 0.05)
+		socks = pending.keys()
+		if not socks: # windows won't select on nothing
+			time.sleep(max(wait, 0))
+			continue
+		for sock in ready(socks, max(wait, 0), write = True):
+			if sock not in pending: continue
+			if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+				winner = sock, pending.pop(sock)[0]
+				break
+			sock.close()
+			del pending[sock]
+		if winner[0] is not None: break
+	
+	for sock in pending: sock.close()
+	if winner[0] is not None: winner[0].setblocking(1)
+	return winner
+
+# outgoing data for one connection
+# packets queue up here and go out in as few non-blocking sends as possible (python 2 has no sendmsg,
+# so everything waiting is joined into one write); whatever the socket won't take stays for later
+class Outbox:
+	
+	def __init__(self, sock):
+		sock.setblocking(0)
+		nodelay(sock)
+		self.sock = sock
+		self.packets = collections.deque()
+		self.nbytes = 0 # queued but not yet sent
+		self.lock = threading.Lock()
+	
+	# returns the number of bytes now waiting
+	def put(self, packet):
+		with self.lock:
+			self.packets.append(packet)
+			self.nbytes += len(packet)
+			return self.nbytes
+	
+	# send without blocking, returns True once nothing is left waiting
+	def flush(self):
+		with self.lock:
+			if not self.packets: return True
+			data = ''.join(self.packets)
+			self.packets.clear()
+			try:
+				nsent = self.sock.send(data)
+			except socket.error as error:
+				if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					self.nbytes = 0 # connection is dead, rx will notice and clean up
+					return True
+				nsent = 0
+			if nsent < len(data):
+				self.packets.append(data[nsent:])
+			self.nbytes = len(data) - nsent
+			return self.nbytes == 0
+	
+	# give up on a connection that won't drain - rx sees the hang up and cleans up as usual
+	def abandon(self):
+		with self.lock:
+			self.packets.clear()
+			self.nbytes = 0
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+
+# one worker thread draining its own task queue, with queue depth and wait time metrics
+class CommandShard:
+	
+	def __init__(self, index):
+		self.index = index
+		self.q = Queue.Queue()
+		self.nprocessed = 0
+		self.totalwait = 0.0 # seconds tasks spent queued, summed
+		self.maxwait = 0.0 # longest wait since the last metrics report
+		
+	def start(self):
+		self.thread = threading.Thread(target = self.work, name = 'shard-%d' % self.index)
+		self.thread.daemon = True # so that it will not attempt to persist when the program terminates
+		self.thread.start()
+	
+	def put(self, fn, args): self.q.put((time.time(), fn, args))
+	
+	def work(self):
+		while True:
+			queued, fn, args = self.q.get()
+			wait = time.time() - queued
+			self.nprocessed += 1
+			self.totalwait += wait
+			self.maxwait = max(self.maxwait, wait)
+			try:
+				fn(*args)
+			except:
+				logging.exception("Unhandled error on shard %d." % self.index)
+	
+	# e.g. "shard 2: depth 0, processed 312, mean wait 0.4 ms, max wait 3.1 ms"
+	def metrics(self):
+		meanwait = self.totalwait / self.nprocessed if self.nprocessed else 0.0
+		report = "shard %d: depth %d, processed %d, mean wait %.1f ms, max wait %.1f ms" % (self.index, self.q.qsize(), self.nprocessed, meanwait * 1000, self.maxwait * 1000)
+		self.maxwait = 0.0
+		return report
+
+# spreads tasks over several CommandShards by key
+# tasks with the same key always go to the same shard, so they run in the order submitted
+class ShardedDispatcher:
+	
+	def __init__(self, nshards):
+		self.shards = [CommandShard(i) for i in xrange(nshards)]
+	
+	def start(self):
+		for shard in self.shards:
+			shard.start()
+		if SHARD_METRICS_INTERVAL:
+			self.metrics_thread = threading.Thread(target = self.report, name = 'shard-metrics')
+			self.metrics_thread.daemon = True # so that it will not attempt to persist when the program terminates
+			self.metrics_thread.start()
+	
+	def submit(self, key, fn, *args):
+		self.shards[hash(key) % len(self.shards)].put(fn, args)
+	
+	# log every shard's metrics periodically
+	# runs as thread
+	def report(self):
+		while True:
+			time.sleep(SHARD_METRICS_INTERVAL)
+			for shard in self.shards:
+				logging.info(shard.metrics())
+
+# fills at rate tokens a second up to burst, and each command takes one
+class TokenBucket(object):
+	
+	__slots__ = ['rate', 'burst', 'tokens', 'stamp']
+	
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.stamp = time.time()
+	
+	def take(self):
+		now = time.time()
+		self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+		if self.tokens < 1: return False
+		self.tokens -= 1
+		return True
+
+# which connections the server takes (MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP) and how fast each may send (RATE_LIMITS)
+# counts whatever it turns away or drops for the metrics log
+# connections are admitted from the accepting thread, and let go and rate limited from the shards, hence the lock
+class Admission:
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.ips = {} # connectionID: address it came from
+		self.perip = collections.Counter() # address: connections from it
+		self.buckets = {} # connectionID: {command (None for the rest): TokenBucket}
+		self.violations = collections.Counter() # connectionID: commands dropped since it was admitted
+		self.peak = 0 # most connections held at once since the last report
+		self.refused = collections.Counter() # reason: connections turned away since the last report
+		self.dropped = collections.Counter() # command: commands dropped since the last report
+		self.ncutoff = 0 # connections cut off since the last report
+	
+	def start(self):
+		if ADMISSION_METRICS_INTERVAL:
+			self.metrics_thread = threading.Thread(target = self.report, name = 'admission-metrics')
+			self.metrics_thread.daemon = True # so that it will not attempt to persist when the program terminates
+			self.metrics_thread.start()
+	
+	# take a connection from ip unless we're full, returns None if it's in, otherwise why it isn't
+	def admit(self, id, ip):
+		with self.lock:
+			if len(self.ips) >= MAX_CONNECTIONS: reason = 'full'
+			elif MAX_CONNECTIONS_PER_IP and self.perip[ip] >= MAX_CONNECTIONS_PER_IP: reason = 'per-ip'
+			else:
+				self.ips[id] = ip
+				self.perip[ip] += 1
+				self.peak = max(self.peak, len(self.ips))
+				return None
+			self.refused[reason] += 1
+			return reason
+	
+	# a connection is gone (a no-op for one we never admitted, or have already let go)
+	def release(self, id):
+		with self.lock:
+			ip = self.ips.pop(id, None)
+			self.buckets.pop(id, None)
+			self.violations.pop(id, None)
+			if ip is None: return
+			self.perip[ip] -= 1
+			if not self.perip[ip]: del self.perip[ip]
+	
+	# whether a connection may send command now - if not it's counted against them
+	def allow(self, id, command):
+		key = command if command in RATE_LIMITS else None
+		bucket = self.buckets.setdefault(id, {}).get(key)
+		if bucket is None:
+			if key not in RATE_LIMITS: return True
+			bucket = self.buckets[id][key] = TokenBucket(*RATE_LIMITS[key])
+		if bucket.take(): return True
+		with self.lock: # counted from every shard
+			self.violations[id] += 1
+			self.dropped[command] += 1
+		return False
+	
+	# e.g. "admission: 40 connections (peak 42), refused 3 (full 1, per-ip 2), dropped 57 (message 57), cut off 0"
+	def metrics(self):
+		with self.lock:
+			refused = ', '.join(["%s %d" % item for item in sorted(self.refused.items())])
+			dropped = ', '.join(["%s %d" % item for item in self.dropped.most_common(5)])
+			report = "admission: %d connections (peak %d), refused %d%s, dropped %d%s, cut off %d" % (len(self.ips), self.peak,
+				sum(self.refused.values()), refused and " (%s)" % refused, sum(self.dropped.values()), dropped and " (%s)" % dropped, self.ncutoff)
+			self.peak = len(self.ips)
+			self.refused.clear()
+			self.dropped.clear()
+			self.ncutoff = 0
+		return report
+	
+	# log the metrics periodically
+	# runs as thread
+	def report(self):
+		while True:
+			time.sleep(ADMISSION_METRICS_INTERVAL)
+			logging.info(self.metrics())
+
+# wait up to timeout seconds (None for as long as it takes) for any of socks to be ready to read, or write
+# returns the ones that are - errors and hangups count as ready, the next recv or send will see them
+# poll takes any descriptor, where select can't take one past FD_SETSIZE (1024), so select is only for windows
+# (which has no poll, nor that limit)
+def ready(socks, timeout, write = False):
+	if not hasattr(select, 'poll'):
+		readable, writable, errored = select.select([] if write else socks, socks if write else [], socks, timeout)
+		return list(set(writable if write else readable) | set(errored)) # windows reports failed connects as errors
+	poller = select.poll()
+	byfd = {}
+	for sock in socks:
+		byfd[sock.fileno()] = sock
+		poller.register(sock, select.POLLOUT if write else select.POLLIN)
+	return [byfd[fd] for fd, event in poller.poll(None if timeout is None else timeout * 1000)]
+
+# readiness notification over a set of sockets
+# uses epoll where the platform has it, otherwise poll, otherwise select (see ready)
+class Poller:
+	
+	def __init__(self):
+		self.socks = {} # file descriptor: socket
+		if hasattr(select, 'epoll'):
+			self.kind = 'epoll'
+			self.epoll = select.epoll()
+		elif hasattr(select, 'poll'):
+			self.kind = 'poll'
+			self.pollobj = select.poll()
+		else:
+			self.kind = 'select'
+	
+	def register(self, sock):
+		self.socks[sock.fileno()] = sock
+		if self.kind == 'epoll':
+			self.epoll.register(sock.fileno(), select.EPOLLIN)
+		elif self.kind == 'poll':
+			self.pollobj.register(sock.fileno(), select.POLLIN)
+	
+	def unregister(self, sock):
+		fd = sock.fileno()
+		del self.socks[fd]
+		if self.kind == 'epoll':
+			self.epoll.unregister(fd)
+		elif self.kind == 'poll':
+			self.pollobj.unregister(fd)
+	
+	# wait up to timeout seconds, returns list of file descriptors that are ready to read
+	def poll(self, timeout):
+		if self.kind == 'epoll':
+			return [fd for fd, event in self.epoll.poll(timeout)]
+		if self.kind == 'poll':
+			return [fd for fd, event in self.pollobj.poll(timeout * 1000)]
+		readable, writable, errored = select.select(self.socks.keys(), [], [], timeout)
+		return readable
+
 # common functionality for server and client network interfaces
 class NetworkInterface:
 	
+	rxlimit = None # unparsed bytes a connection may leave waiting (see FrameDecoder.overflowing), no limit unless set
+	
 	# background thread pulls tasks off the queue and processes them
 	def queue_manager(self):
 		while True:
 			id, command, args = self.q.get()
 			logging.debug("Q: id / command / args = %d / %s / %s " % (id, command, args))
 			self.command_handler(id, command, args)
+	
+	# hand a received command over for processing
+	def enqueue(self, id, command, args): self.q.put((id, command, args))
 
 	# transmit a message to connection designated by id
 	# caution to user: all args will be converted to string for transmission
@@ -694,22 +2266,87 @@ class NetworkInterface:
 	def tx(self, command, args = '', id = SERVERID, log = True):
 		
 		if id not in self.connections:
-			self.game.ui.msg("Error: attempting to transmit to unknown connection.")
+			if self.game.ui: self.game.ui.msg("Error: attempting to transmit to unknown connection.")
 			logging.info("Error: attempting to transmit to unknown connection %d." % id)
+			return
 		
-		args = str(args)
-		arglength = len(args)
-		packet = "%s:%d:%s|" % (command, arglength, args)
+		packet = self.encode(command, args, self.protocols.get(id, PROTOCOL_TEXT))
 			
 		# log the communication BEFORE tx in case an immediate response follows
-		if log:
+		if log and command not in QUIET_COMMANDS:
 			ndigits_id = len(str(id))
 			ndigits_maxid = len(str(max(self.connections)))
 			padding = ndigits_maxid - ndigits_id
 			logging.info(' ' * padding + 'Channel %d tx:  %s:%s' % (id, command, args))
 	
-		thread, sock, sockdetails = self.connections[id]
-		sock.sendall(packet)
+		self.transmit(id, packet)
+	
+	# queue an encoded packet for a connection and send as much as the socket takes without blocking
+	# a connection that lets too much pile up is cut off rather than allowed to hold up the sender
+	def transmit(self, id, packet):
+		pending = getattr(self.batching, 'pending', None)
+		if pending is not None:
+			pending.setdefault(id, []).append(packet)
+			return
+		outbox = self.outboxes.get(id)
+		if outbox is None: return # connection is going away
+		if outbox.put(packet) > OUTBOX_LIMIT:
+			logging.warning("Channel %d is not keeping up with its output - disconnecting." % id)
+			outbox.abandon()
+		elif not outbox.flush():
+			self.flushwanted.set()
+	
+	# run fn, holding back everything it sends until it's done, then give each connection it all in one write
+	# a batch started inside another just joins the outer one
+	def batched(self, fn, *args):
+		if getattr(self.batching, 'pending', None) is not None:
+			return fn(*args)
+		self.batching.pending = {} # id: [packet, ...]
+		try:
+			return fn(*args)
+		finally:
+			pending, self.batching.pending = self.batching.pending, None
+			for id, packets in pending.iteritems():
+				self.transmit(id, ''.join(packets))
+	
+	# write out whatever outboxes couldn't send right away, as their sockets drain
+	# runs as thread
+	def flush_manager(self):
+		while True:
+			pending = [outbox for outbox in self.outboxes.values() if outbox.nbytes]
+			if not pending:
+				self.flushwanted.wait(SELECT_TIMEOUT)
+				self.flushwanted.clear()
+				continue
+			try:
+				writable = ready([outbox.sock for outbox in pending], SELECT_TIMEOUT, write = True)
+			except (select.error, socket.error): # a socket closed under us - flushing it will clear it out
+				writable = [outbox.sock for outbox in pending]
+			for outbox in pending:
+				if outbox.sock in writable: outbox.flush()
+	
+	def startflusher(self):
+		self.flushwanted = threading.Event()
+		self.flush_thread = threading.Thread(target = self.flush_manager, name = 'flusher')
+		self.flush_thread.daemon = True # so that it will not attempt to persist when the program terminates
+		self.flush_thread.start()
+	
+	# build the packet for a message in the given wire protocol
+	# caution to user: for the text protocol all args will be converted to string for transmission
+	def encode(self, command, args, protocol):
+		if protocol == PROTOCOL_BINARY and command in OPCODE_LUT:
+			return binaryframe(command, args)
+		args = str(args)
+		return "%s:%d:%s|" % (command, len(args), args)
+	
+	# encode a message once per wire protocol in use and queue it for each of the given connections
+	def fanout(self, ids, command, args):
+		packets = {} # protocol: packet
+		for id in ids:
+			protocol = self.protocols.get(id, PROTOCOL_TEXT)
+			if protocol not in packets:
+				packets[protocol] = self.encode(command, args, protocol)
+			self.transmit(id, packets[protocol])
 	
 	# transmit a message to all active connections
 	def broadcast(self, command, args = ''):
@@ -721,121 +2358,291 @@ class NetworkInterface:
 		padding = ndigits_maxid - len('B')
 		logging.info(' ' * padding + 'Channel B tx:  %s:%s' % (command,args))		
 		
-		for id in self.connections:
-			self.tx(command, args, id, log = False)
-			
+		self.fanout(self.connections.keys(), command, args)
 
 	
 	# run as thread to manage an individual connection rx line
 	# parses incoming data and places commands onto task queue
-	# packet structure is command:arglength:argstring|
-	# e.g.: contribution:12:Seeds(5,'y')|
-	# e.g.: forum:0:|
-	# final pipe is a waste of space, but since network activity is fairly low, keep for readability of data stream
 	def rx(self, id, sock):
 		
-		data = '' # empty buffer
-		seekHeader = True # waiting for a packet header
+		decoder = FrameDecoder(limit = self.rxlimit)
 		
 		# forever try to receive and parse commands, placing them in the queue
 		while True:
 		
 			# add new data to the buffer
+			# sockets are non-blocking so sends never stall, so wait for data before reading
 			try:
-				data += sock.recv(1024)
+				ready([sock], None)
+				nbytes = decoder.recv_into(sock)
 			except socket.error as error: # if the client has vanished...
-				if error.errno == errno.WSAECONNRESET:
+				if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					continue
+				elif error.errno in BROKEN_ERRNOS:
 					self.broken_connection(id)
 					return
 				else:
 					logging.exception("Indeterminate socket problem in rx.")
 					raise
+			
+			# an empty read means the peer hung up
+			if nbytes == 0:
+				self.broken_connection(id)
+				return
 						
 			# parse as many commands out of the data as possible until continuing to wait for more data
-			while True:
-				# waiting for a header
-				if seekHeader:
-					
-					# try to find a command amongst the data
-					header_re = '(.*?):(\d*):(.*)'
-					x = re.search(header_re, data)
-				
-					# if no complete command has been found, break and wait for more data
-					if x == None: break
-					
-					# parse the command
-					command, arg_length, moredata = x.group(1), int(x.group(2)), x.group(3)
-				
-					# leave behind the excess data
-					data = moredata
-					
-					seekHeader = False # look for data instead now
-
-				# waiting for argument data
-				if not seekHeader:
-					
-					# if there's insufficient data in the buffer, break and wait for more data
-					if len(data) < arg_length + 1:
-						break
+			try:
+				packets = decoder.packets()
+			except Exception: # malformed, already logged - nothing after it can be trusted
+				self.cutoff(id, "sent a malformed packet")
+				self.broken_connection(id)
+				return
+			for command, args in packets:
+				# log receipt BEFORE putting on Q in case of immediate follow up TX
+				self.logrx(id, command, args)
 				
-					# extrace the necessary amount of data
-					args = data[:arg_length]
-					
-					if data[arg_length] != '|':
-						logging.error("Malformed packet in rx:")
-						logging.error("  >%s:%s:%s" % (command, arg_length, data))
-						raise Exception("Bad packet in rx")
-					
-					# keep the rest of the data
-					data = data[arg_length + 1:]
-					
-					# log receipt BEFORE putting on Q in case of immediate follow up TX
-					# assumption: maxid is changing relatively slowly
-					# pad so that single and double digit channels are colon aligned
-					ndigits_id = len(str(id))
-					ndigits_maxid = len(str(max(self.connections)))
-					padding = ndigits_maxid - ndigits_id
-					logging.info(" " * padding + "Channel %d rx: %s:%s" % (id, command, args))
-
-					# place the command etc. in the queue
-					self.q.put((id, command, args))
-										
-					seekHeader = True
+				# place the command etc. in the queue
+				self.enqueue(id, command, args)
+			if decoder.overflowing():
+				self.cutoff(id, "overflowed its receive buffer")
+				self.broken_connection(id)
+				return
+	
+	# shut a connection we're giving up on - it then breaks the usual way
+	def cutoff(self, id, reason):
+		logging.warning("Channel %d %s - disconnecting." % (id, reason))
+		outbox = self.outboxes.get(id)
+		if outbox is not None: outbox.abandon()
+	
+	# log a received command
+	# assumption: maxid is changing relatively slowly
+	# pad so that single and double digit channels are colon aligned
+	def logrx(self, id, command, args):
+		if command in QUIET_COMMANDS: return
+		ndigits_id = len(str(id))
+		ndigits_maxid = len(str(max(self.connections)))
+		padding = ndigits_maxid - ndigits_id
+		logging.info(" " * padding + "Channel %d rx: %s:%s" % (id, command, args))
 
+	# map every command name to its bound cmd_ method once, so dispatch is a dict lookup
+	# e.g. 'handrelay' -> self.cmd_handrelay
+	def registerhandlers(self):
+		self.handlers = {}
+		for name in dir(self):
+			if name.startswith('cmd_'):
+				self.handlers[name[len('cmd_'):]] = getattr(self, name)
+	
 	# string to tuple safely for incoming command arguments
-	def tuple_unpack(self, args): return eval(args, {'__builtins__':None})
+	# binary protocol arguments arrive already decoded and pass straight through
+	# only understands what str() of our argument tuples produces: nested tuples, ints, strings, None/True/False
+	# e.g. "((1, 'd'), (2, 'f'))" -> ((1, 'd'), (2, 'f'))
+	def tuple_unpack(self, args):
+		if not isinstance(args, str): return args
+		stack = [[]] # items of each tuple still being built, innermost last
+		pos, end = 0, len(args)
+		while pos < end:
+			x = LITERAL_TOKEN_RE.match(args, pos)
+			if x == None:
+				raise ValueError("Unparseable arguments: %s" % args)
+			pos = x.end()
+			opener, closer, integer, string, constant = x.groups()
+			if opener: stack.append([])
+			elif closer:
+				items = stack.pop()
+				stack[-1].append(tuple(items))
+			elif integer: stack[-1].append(int(integer))
+			elif string: stack[-1].append(string[1:-1].decode('string_escape'))
+			elif constant: stack[-1].append(LITERAL_CONSTANTS[constant])
+		if len(stack) != 1 or len(stack[0]) != 1:
+			raise ValueError("Unparseable arguments: %s" % args)
+		return stack[0][0]
+
+# posts the server's IPs to IPS_FNAME
+class FilePublisher:
+	
+	def __init__(self, fname = IPS_FNAME):
+		self.fname = fname
+	
+	def publish(self, ips):
+		try:
+			fp = open(self.fname,'w')
+			fp.write('\n'.join(ips))
+			fp.close()
+		except IOError as e:
+			if e.errno == 2: # no such file or directory
+				logging.warning("Unable to write to IP file because directory is not found.")
+				logging.warning("Path: %s" % self.fname)
+
+# serves the server's IPs as a page of their own, the same as IPS_URL would
+class HTTPPublisher:
+	
+	def __init__(self, port = PUBLISH_HTTP_PORT):
+		self.httpd = BaseHTTPServer.HTTPServer(('', port), IPSRequestHandler)
+		self.httpd.body = ''
+		self.thread = threading.Thread(target = self.httpd.serve_forever, name = 'ips_http')
+		self.thread.daemon = True # so that it will not attempt to persist when the program terminates
+		self.thread.start()
+	
+	def publish(self, ips): self.httpd.body = '\n'.join(ips)
+
+class IPSRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	
+	def do_GET(self):
+		body = self.server.body
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def log_message(self, format, *args): pass # not worth a line in the server log
 
 # server network interface
 class NetworkInterfaceServer(NetworkInterface):
 
 	def __init__(self, game):
 		self.game = game
+		self.registerhandlers()
+		self.protocols = {} # connectionID: negotiated wire protocol, text unless stated
+		self.outboxes = {} # connectionID: Outbox, or AsyncChannel in async mode
+		self.batching = threading.local() # packets held back by the batch this thread is in
+		self.routes = {} # connectionID: shard key (table id) of the table the connection is bound for
+		self.dispatcher = None
+		self.loopthread = None # the one thread running every handler, in select and async modes
+		self.calls = collections.deque() # (fn, args) other threads have left for the loop thread
+		self.settlement = SettlementStage(game.ledger, self.settled)
+		self.sessions = {} # session token: player id, for every client that can resume
+		self.tokens = {} # player id: session token
+		self.away = {} # player id: grace period Timer, for players whose connection is broken
+		self.aliases = {} # connectionID: the player id it resumed
+		self.links = {} # player id: connectionID now serving them, where it isn't their own
+		self.lastheard = {} # connectionID (player id, once resumed): when it last sent us anything
+		self.admission = Admission()
+		self.rxlimit = RX_BUFFER_LIMIT
+		self.ips = ['127.0.0.1', '', ''] # until discovery says otherwise
+		self.publisher = None
+		self.launched = None # when start was called
 	
 	# starts the server
 	def start(self):
 	
 		logging.info("Launching server...")
-		
-		# find and post ip addresses
-		self.acquire_ips()
-		self.post_ips()
+		self.launched = time.time()
+		self.listener = self.listen()
 
-		# create and start the connection hub thread
-		self.hub_thread = threading.Thread(target = self.connection_hub, name = 'connection_hub')
-		self.hub_thread.daemon = True # so that it will not attempt to persist when the program terminates
-		self.hub_thread.start()
-		
 		# create connections dictionary
 		# format of a connection is connectionID: (thread, socket, socketDetails)
+		# thread is None for connections serviced by the select loop
 		self.connections = {}
+		self.nextid = 1 + SERVERID # start at 1 - 0 reserved for server
+		self.startflusher()
+		self.settlement.start()
+		self.admission.start()
+		
+		# select mode: one thread services the listener and every connection, no task queue
+		if SERVER_IO_MODE == 'select':
+			self.wakereader, self.wakewriter = wakepair()
+			self.hub_thread = self.loopthread = threading.Thread(target = self.event_loop, name = 'event_loop')
+			self.hub_thread.daemon = True # so that it will not attempt to persist when the program terminates
+			self.hub_thread.start()
+			self.startdiscovery()
+			self.startwatchdog()
+			return
 		
-		# create the task queue
-		self.q = Queue.Queue()
+		# create and start the sharded task queues
+		self.dispatcher = ShardedDispatcher(COMMAND_SHARDS)
+		self.dispatcher.start()
+		
+		# create and start the connection hub thread
+		self.hub_thread = threading.Thread(target = self.connection_hub, name = 'connection_hub')
+		self.hub_thread.daemon = True # so that it will not attempt to persist when the program terminates
+		self.hub_thread.start()
+		self.startdiscovery()
+		self.startwatchdog()
+	
+	def startwatchdog(self):
+		self.watchdog_thread = threading.Thread(target = self.watchdog, name = 'watchdog')
+		self.watchdog_thread.daemon = True # so that it will not attempt to persist when the program terminates
+		self.watchdog_thread.start()
+	
+	# keeps time for the heartbeat and the tables' turns, the work itself is done where the connections and tables are
+	# runs as thread
+	def watchdog(self):
+		lastbeat = time.time()
+		while True:
+			time.sleep(TURN_CHECK_INTERVAL)
+			if time.time() - lastbeat >= HEARTBEAT_INTERVAL:
+				lastbeat = time.time()
+				self.defer(LOBBY_ROUTE, self.heartbeat)
+			for table in self.game.tables.values():
+				if table.status in TURN_TIMEOUTS: self.defer(table.id, self.batched, self.checkturn, table)
+	
+	# ping every connection that can answer, and cut off any that's been quiet too long
+	# cutting one off breaks it the usual way, so its player gets the usual grace period
+	def heartbeat(self):
+		now = time.time()
+		alive = []
+		for id in self.connections.keys():
+			if id not in self.protocols: continue # never said hello, left to TCP keepalive
+			quiet = now - self.lastheard.get(id, now)
+			if quiet <= HEARTBEAT_TIMEOUT:
+				alive.append(id)
+				continue
+			self.cutoff(id, "has not been heard from in %d seconds" % quiet)
+		self.fanout(alive, 'ping', '')
+	
+	# milliseconds since start was called, for the startup log lines
+	def sincelaunch(self): return (time.time() - self.launched) * 1000
+	
+	# find and post our ips off the startup path - clients on this machine can connect in the meantime
+	def startdiscovery(self):
+		logging.info("Listening on port %d, %.0f ms after launch." % (BONES_PORT, self.sincelaunch()))
+		self.discovery_thread = threading.Thread(target = self.discover, name = 'discovery')
+		self.discovery_thread.daemon = True # so that it will not attempt to persist when the program terminates
+		self.discovery_thread.start()
+	
+	# runs as thread
+	# last launch's ips are posted first, so remote clients can find us while the network is still being asked
+	def discover(self):
+		if IP_PUBLISHER == 'http':
+			try:
+				self.publisher = HTTPPublisher(PUBLISH_HTTP_PORT)
+			except socket.error as e:
+				logging.warning("Unable to serve IPs on port %d: %s" % (PUBLISH_HTTP_PORT, e))
+		elif IP_PUBLISHER == 'file':
+			self.publisher = FilePublisher(IPS_FNAME)
+		
+		cached = self.cachedips()
+		if cached is not None:
+			self.ips = cached
+			self.post_ips()
+			logging.info("Cached IPs posted %.0f ms after launch: %s" % (self.sincelaunch(), cached))
 		
-		# create and start the queue handler thread
-		self.q_handler_thread = threading.Thread(target = self.queue_manager, name = 'q-manager')
-		self.q_handler_thread.daemon = True # so that it will not attempt to persist when the program terminates
-		self.q_handler_thread.start()
+		self.acquire_ips()
+		logging.info("IPs discovered %.0f ms after launch: %s" % (self.sincelaunch(), self.ips))
+		if cached is not None: # whatever couldn't be found this time, assume hasn't changed
+			self.ips = [ip or old for ip, old in zip(self.ips, cached)]
+		if self.ips != cached:
+			self.post_ips()
+			self.cacheips()
+			logging.info("IPs posted %.0f ms after launch." % self.sincelaunch())
+	
+	# the ips the last launch found, if they're recent enough to be worth posting
+	def cachedips(self):
+		try:
+			with open(IPS_CACHE_FNAME) as fp:
+				stamp, ips = json.load(fp)
+			if time.time() - stamp < IPS_CACHE_TTL: return [str(ip) for ip in ips]
+		except (IOError, ValueError):
+			pass
+		return None
+	
+	def cacheips(self):
+		try:
+			with open(IPS_CACHE_FNAME, 'w') as fp:
+				json.dump([time.time(), self.ips], fp)
+		except IOError:
+			logging.warning("Unable to cache IPs in %s" % IPS_CACHE_FNAME)
 			
 	# find the three ip addresses for this machine - localhost, the lan IP, and the www IP - in that order
 	def acquire_ips(self):
@@ -847,7 +2654,7 @@ class NetworkInterfaceServer(NetworkInterface):
 			s.connect(('duckduckgo.com', 0))
 			lanip = s.getsockname()[0]
 			s.close()
-		except socket.gaierror: # no web access? localhost is our only chance
+		except socket.error: # no web access? localhost is our only chance
 			lanip = ''
 			wwwip = ''
 			self.ips = [localhostip, lanip, wwwip]
@@ -858,10 +2665,10 @@ class NetworkInterfaceServer(NetworkInterface):
 			
 		# www ip
 		try:
-			webpagestring = urllib2.urlopen(WWW_IP_URL).read()
+			webpagestring = urllib2.urlopen(WWW_IP_URL, timeout = DISCOVERY_TIMEOUT).read()
 			ip_re = "Your IP address is (\d+\.\d+\.\d+\.\d+)"
 			wwwip = re.search(ip_re, webpagestring).group(1)
-		except urllib2.URLError:
+		except (urllib2.URLError, socket.error): # socket.timeout included
 			logging.warning("Unable to open the following URL for www IP acquisition.")
 			logging.warning(WWW_IP_URL)
 			logging.warning("Unable to host WWW game.")
@@ -873,263 +2680,718 @@ class NetworkInterfaceServer(NetworkInterface):
 			wwwip = ''
 		
 		self.ips = [localhostip, lanip, wwwip]
-		logging.info("IPs have been posted:")
-		logging.info(self.ips)
 		
-	# post ips to web accessible file
+	# post ips where clients will look for them
 	def post_ips(self):
+		if self.publisher is not None: self.publisher.publish(self.ips)
+	
+	# create a socket to receive incoming connections
+	def listen(self):
+		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		s.bind(('', BONES_PORT))
+		s.listen(MAX_CLIENTS)
+		return s
+	
+	# whether to take a freshly accepted connection - if not, say why in text (all anyone understands before hello) and close it
+	def admit(self, sock, sockdetails):
+		reason = self.admission.admit(self.nextid, sockdetails[0])
+		if reason is None: return True
+		logging.warning("Refused connection from %s / %d (%s)." % (sockdetails[0], sockdetails[1], reason))
 		try:
-			fp = open(IPS_FNAME,'w')
-			fp.write('\n'.join(self.ips))
-			fp.close()
-		except IOError as e:
-			if e.errno == 2: # no such file or directory
-				logging.warning("Unable to write to IP file because directory is not found.")
-				logging.warning("Path: %s" % IPS_FNAME)
+			sock.send(self.encode('orate', "The server is too busy to take you (%s). Try again later." % reason, PROTOCOL_TEXT))
+		except socket.error:
+			pass
+		sock.close()
+		return False
+	
+	# count a cut off connection for the metrics
+	def cutoff(self, id, reason):
+		with self.admission.lock:
+			self.admission.ncutoff += 1
+		NetworkInterface.cutoff(self, id, reason)
+	
+	# assign an incoming connection an id and update the connections register
+	# the outbox defaults to a non-blocking Outbox on the socket
+	def register(self, sock, sockdetails, thread = None, outbox = None):
+		connectionID = self.nextid
+		self.nextid += 1
+		self.outboxes[connectionID] = outbox or Outbox(sock)
+		self.connections[connectionID] = (thread, sock, sockdetails)
+		self.lastheard[connectionID] = time.time()
+		keepalive(getattr(sock, 'socket', sock)) # channels wrap theirs
+		logging.info("New connection. Id / Host / Port = %d / %s / %d" % (connectionID, sockdetails[0], sockdetails[1]))
+		return connectionID
 	
 	# listens indefinitely to establish incoming connections
 	# runs as thread
 	def connection_hub(self):
 		
-		# create a socket to receive incoming connections
-		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		s.bind(('', BONES_PORT))
-		s.listen(MAX_CLIENTS)
+		s = self.listener
 		logging.info("Connection hub activated...")
 		
 		# any time an incoming connection is received, assign it an id and start a dedicated thread to listen
-		connectionID = 1 + SERVERID # start at 1 - 0 reserved for server
 		while True:	
 			
 			# accept connections
 			sock, sockdetails = s.accept()
+			if not self.admit(sock, sockdetails): continue
 			
 			# start a thread to manage the new connection
+			connectionID = self.nextid
 			rx_thread = threading.Thread(target = self.rx, args = (connectionID, sock), name = 'server_rx')
 			rx_thread.daemon = True # so that it will not attempt to persist when the program terminates
-			rx_thread.start()
 			
-			# update the connections register
-			self.connections[connectionID] = (rx_thread, sock, sockdetails)
-			
-			logging.info("New connection. Id / Host / Port = %d / %s / %d" % (connectionID, sockdetails[0], sockdetails[1]))
+			# register before the thread runs so its first packet can be attributed
+			self.register(sock, sockdetails, rx_thread)
+			rx_thread.start()
+	
+	# select mode alternative to connection_hub + one rx thread per connection
+	# a single thread waits on the listener and all client sockets at once,
+	# frames whatever data is ready and feeds command_handler directly
+	# runs as thread
+	def event_loop(self):
 		
-			connectionID += 1
+		listener = self.listener
+		poller = Poller()
+		poller.register(listener)
+		poller.register(self.wakereader)
+		logging.info("Event loop activated (%s)..." % poller.kind)
 		
+		# socket file descriptor: (connectionID, socket, FrameDecoder)
+		channels = {}
+		
+		while True:
+			for fd in poller.poll(SELECT_TIMEOUT):
+			
+				# new connection
+				if fd == listener.fileno():
+					sock, sockdetails = listener.accept()
+					if not self.admit(sock, sockdetails): continue
+					connectionID = self.register(sock, sockdetails)
+					channels[sock.fileno()] = (connectionID, sock, FrameDecoder(limit = self.rxlimit))
+					poller.register(sock)
+					continue
+				
+				# work handed over by another thread
+				if fd == self.wakereader.fileno():
+					self.runcalls()
+					continue
+				
+				connectionID, sock, decoder = channels[fd]
+				
+				# readiness guarantees recv won't block - an empty read means the peer hung up
+				try:
+					nbytes = decoder.recv_into(sock)
+				except socket.error as error:
+					if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK): continue
+					nbytes = 0
+				hangup = nbytes == 0
+				
+				# a connection we cut off is hung up on straight away, rather than reading whatever else it sent
+				if not hangup:
+					try:
+						packets = decoder.packets()
+					except Exception: # malformed, already logged - nothing after it can be trusted
+						self.cutoff(connectionID, "sent a malformed packet")
+						packets, hangup = [], True
+					for command, args in packets:
+						self.logrx(connectionID, command, args)
+						try:
+							self.command_handler(connectionID, command, args)
+						except: # a bad command mustn't take down the loop every connection depends on
+							logging.exception("Unhandled error on channel %d." % connectionID)
+					if decoder.overflowing():
+						self.cutoff(connectionID, "overflowed its receive buffer")
+						hangup = True
+				
+				if hangup:
+					poller.unregister(sock)
+					del channels[fd]
+					outbox = self.outboxes.get(connectionID)
+					if outbox is not None and outbox.sock is sock: self.outboxes.pop(connectionID, None)
+					sock.close()
+					self.broken_connection(connectionID)
+		
+	# queue a command on the shard of the table its sender is bound for
+	def enqueue(self, id, command, args):
+		self.dispatcher.submit(self.route(id), self.command_handler, id, command, args)
+	
+	# shard key for a connection - that of the player it's resumed, if it's resumed one
+	def route(self, id):
+		return self.routes.get(self.aliases.get(id, id), self.routes.get(id, LOBBY_ROUTE))
+	
+	# run a function on the shard that owns key
+	# without a dispatcher there's only the one loop thread - run it there, right away if we're on it
+	# from inside a batch it's held back until the batch has gone out, so that whatever fn sends arrives after it
+	# (e.g. a newcomer's assignID before the seating on another shard)
+	def defer(self, key, fn, *args):
+		deferred = getattr(self.batching, 'deferred', None)
+		if deferred is not None:
+			deferred.append((key, fn, args))
+			return
+		if self.dispatcher: self.dispatcher.submit(key, fn, *args)
+		elif self.loopthread is None or threading.current_thread() is self.loopthread: fn(*args)
+		else:
+			self.calls.append((fn, args))
+			try:
+				self.wakewriter.send('!')
+			except socket.error:
+				pass # buffer full - the loop has plenty of wake-ups waiting already
+	
+	# on the loop thread, run whatever other threads have deferred to it
+	def runcalls(self):
+		try:
+			while self.wakereader.recv(RX_CHUNK_SIZE): pass
+		except socket.error:
+			pass
+		while self.calls:
+			fn, args = self.calls.popleft()
+			try:
+				fn(*args)
+			except:
+				logging.exception("Unhandled error in deferred call.")
+	
+	# as NetworkInterface.batched, then set off whatever the batch deferred
+	# every table the batch sent to is told where its transcript is up to, so clients know where to resume from
+	def batched(self, fn, *args):
+		if getattr(self.batching, 'pending', None) is not None:
+			return fn(*args)
+		self.batching.deferred = [] # (key, fn, args)
+		self.batching.touched = set() # tables sent to
+		try:
+			return NetworkInterface.batched(self, self.sequenced, fn, args)
+		finally:
+			deferred, self.batching.deferred = self.batching.deferred, None
+			for key, fn, args in deferred:
+				self.defer(key, fn, *args)
+	
+	def sequenced(self, fn, args):
+		try:
+			return fn(*args)
+		finally:
+			touched, self.batching.touched = self.batching.touched, None
+			for table in touched:
+				self.fanout([pid for pid in table.players if pid in self.tokens], 'seq', table.seq)
+	
+	# transmit a message to every player seated at a table
+	def tablecast(self, table, command, args = ''):
+		# log the communication BEFORE tx in case of immediate response
+		logging.info('Table %d tx:  %s:%s' % (table.id, command, args))
+		self.record(table, command, args)
+		self.fanout(table.players.keys(), command, args)
+	
+	# as tablecast, but only to the clients that said hello - older ones don't know the command
+	def newcast(self, table, command, args = ''):
+		logging.info('Table %d tx:  %s:%s' % (table.id, command, args))
+		self.record(table, command, args)
+		self.fanout([pid for pid in table.players if pid in self.protocols], command, args)
+	
+	# add a message to the table's transcript, for players who miss it to catch up on
+	def record(self, table, command, args):
+		table.seq += 1
+		table.transcript.append((table.seq, command, args))
+		touched = getattr(self.batching, 'touched', None)
+		if touched is not None: touched.add(table)
+	
 	# USER DEFINED
 	# The rest of the functions are user-defined
 	# 1. broken_connection - how to respond to a broken connection
 	# 2. command_handler - how to respond to received commands
 	
+	# handled on the shard of the player's table, as a table command would be
 	def broken_connection(self, id):
+		self.defer(self.route(id), self.batched, self.lose, id)
+	
+	# a connection is gone - a player with a session keeps their seat for SESSION_GRACE, anyone else is dropped
+	def lose(self, connectionID):
+		self.admission.release(connectionID) # admitted under its own id, whoever it came to speak for
+		id = self.aliases.pop(connectionID, connectionID)
+		if self.links.get(id, id) != connectionID: # another connection has taken over the player
+			if connectionID != id: self.forget(connectionID)
+			return
+		self.links.pop(id, None)
+		if id in self.away: return # lost already
+		table = self.game.tableof(id)
+		if id not in self.connections or id not in self.tokens or table is None:
+			self.drop(id)
+			return
+		
+		self.forget(id)
+		timer = threading.Timer(SESSION_GRACE, self.graceover, (id,))
+		timer.daemon = True # so that it will not attempt to persist when the program terminates
+		self.away[id] = timer
+		timer.start()
+		logging.info("Player %d is away, holding their seat for %d seconds." % (id, SESSION_GRACE))
+		self.newcast(table, 'playeraway', (id, SESSION_GRACE))
+	
+	# the connection register's entries for a connection
+	def forget(self, id):
+		self.lastheard.pop(id, None)
+		self.connections.pop(id, None)
+		self.outboxes.pop(id, None)
+		self.protocols.pop(id, None)
+	
+	# runs on the grace period's Timer
+	def graceover(self, id):
+		self.defer(self.routes.get(id, LOBBY_ROUTE), self.batched, self.expire, id, threading.current_thread())
+	
+	def expire(self, id, timer):
+		if self.away.get(id) is not timer: return # they're back, or gone already
+		logging.info("Player %d did not come back." % id)
+		self.drop(id)
+	
+	def drop(self, id):
 		# delete the player and connection
-		del self.connections[id]
-		del self.game.players[id]
+		if id not in self.connections and id not in self.away: return # already dropped
+		self.forget(id)
+		self.routes.pop(id, None)
+		timer = self.away.pop(id, None)
+		if timer is not None: timer.cancel()
+		self.sessions.pop(self.tokens.pop(id, None), None)
+		self.links.pop(id, None)
+		if id not in self.game.players: return # never introduced themselves
+		with self.game.lock:
+			table = self.game.unseat(id)
+			del self.game.players[id]
+		if table is None: return
 					
-		# then tell everyone the client has vanished
-		# reset to forum, then kill this thread
-		self.broadcast('mandown', id)
-		self.broadcast('forum')
-		self.game.forumreset()		
+		# then tell the table the client has vanished and reset it to forum
+		# (unless its game is being settled, in which case the spoils will do that)
+		self.tablecast(table, 'mandown', id)
+		if table.status == 'settling': return
+		self.revealdice(table)
+		self.tablecast(table, 'forum')
+		table.forumreset()
 		
 	def command_handler(self, id, command, args):
-		try:
-			handler = eval('self.cmd_%s' % command)
-		except:
+		# shed whatever a connection sends beyond its rate, before it can cost a broadcast
+		if not self.admission.allow(id, command):
+			if self.admission.violations[id] == RATE_VIOLATION_LIMIT: self.cutoff(id, "keeps sending faster than its rate limits")
+			return
+		handler = self.handlers.get(command)
+		if handler is None:
 			logging.warning("Channel " + str(id) + " unrecognized rx command: " + str((command,args)))
 			return
-		handler(id, args)
+		id = self.aliases.get(id, id) # a resumed connection speaks for the player it resumed
+		self.lastheard[id] = time.time()
+		
+		# everything but the lobby commands is played at the sender's table
+		if command not in LOBBY_COMMANDS and self.game.tableof(id) is None:
+			logging.warning("Channel " + str(id) + " is not seated for command: " + str((command,args)))
+			return
+		
+		# whatever the command sets off goes out as one write per recipient
+		self.batched(handler, id, args)
+	
+	###########################
+	### lobby
+	
+	# a client lists the wire protocols it speaks (sent just ahead of mynameis)
+	# answer with the best one we share in text, then switch to it for everything we send them
+	# clients that never say hello are spoken to in text
+	def cmd_hello(self, id, args):
+		versions = self.tuple_unpack(args)
+		common = [version for version in PROTOCOL_VERSIONS if version in versions]
+		if not common: return
+		self.tx('protocol', max(common), id)
+		self.protocols[id] = max(common)
+		self.tx('rollmode', ROLL_MODE, id)
+	
+	# answer to our ping - command_handler has already noted that the connection is alive
+	def cmd_pong(self, id, args): pass
 	
 	# a player is introducing themselves (immediately following connection)
-	# assign them an ID and notify everyone about players
+	# assign them an ID and seat them at the default table
 	def cmd_mynameis(self, id, args):
+		if id in self.game.players: return # already introduced
 			
 		# notify the new player of their player id
+		# along with a session they can resume if the connection breaks, if their client knows how
 		self.tx('assignID', id, id)
+		if id in self.protocols:
+			token = os.urandom(16).encode('hex')
+			self.sessions[token] = id
+			self.tokens[id] = token
+			self.tx('session', token, id)
 	
-		# for simplicity I broadcast EVERY player (so the newest player can hear about everyone)
-		#  and count on the clients to ignore redundant info
 		name = args
 		newplayer = Player(name)
 		newplayer.setid(id)
-		self.game.players[id] = newplayer
-		for playerid in self.game.players:
-			player = self.game.players[playerid]
-			self.broadcast('newplayer', (player.getid(), player.getname()))
+		with self.game.lock:
+			self.game.players[id] = newplayer
+		self.moveto(id, DEFAULT_TABLE_ID)
+	
+	# a client that lost its connection asks for its player back (in place of mynameis)
+	# the player's table picks them up on its own shard, as with moveto
+	def cmd_resume(self, id, args):
+		token, lastseq, name = self.tuple_unpack(args)
+		pid = self.sessions.get(token)
+		if pid is None or id not in self.protocols:
+			self.cmd_mynameis(id, name)
+			return
+		self.routes[id] = self.routes.get(pid, LOBBY_ROUTE)
+		self.links[pid] = id # any connection still serving them is now out of date
+		self.defer(self.routes[id], self.batched, self.rejoin, id, pid, token, lastseq, name)
+	
+	# hand a player over to the connection that resumed them, and replay what they missed
+	# if the table's transcript doesn't go back that far, they have to start afresh
+	def rejoin(self, id, pid, token, lastseq, name):
+		if self.links.get(pid) != id: return # superseded by a later resume
+		if id not in self.connections: # gone again already
+			del self.links[pid]
+			return
+		table = self.game.tableof(pid)
+		if self.tokens.get(pid) != token or table is None or lastseq is None or \
+				not table.seq - len(table.transcript) <= lastseq <= table.seq:
+			logging.info("Channel %d could not resume player %d." % (id, pid))
+			del self.links[pid]
+			self.routes.pop(id, None)
+			if pid in self.game.players: self.drop(pid)
+			self.cmd_mynameis(id, name)
+			return
+		
+		timer = self.away.pop(pid, None)
+		if timer is not None: timer.cancel()
+		replaced = self.outboxes.get(pid)
+		if replaced is not None: replaced.abandon() # the server hadn't noticed it was broken
+		self.connections[pid] = self.connections.pop(id)
+		self.outboxes[pid] = self.outboxes.pop(id, None) or replaced
+		self.protocols[pid] = self.protocols.pop(id)
+		self.lastheard.pop(id, None)
+		self.lastheard[pid] = time.time() # not whenever the link it replaced last spoke
+		self.routes.pop(id, None)
+		self.aliases[id] = pid
+		logging.info("Channel %d resumed player %d." % (id, pid))
+		
+		self.tx('delta', tuple([(command, args) for seq, command, args in table.transcript if seq > lastseq]), pid)
+		self.newcast(table, 'playerback', pid)
+	
+	# a player asks how someone (themselves by default) has done over time
+	def cmd_balance(self, id, args):
+		name = args or (id in self.game.players and self.game.players[id].getname())
+		if not name: return
+		net, ngames = self.game.ledger.balance(name)
+		self.tx('balanceis', (name, net, ngames), id)
+	
+	# a player wants to know what tables there are
+	def cmd_tables(self, id, args):
+		self.tx('tablelist', self.game.tablelist(), id)
+	
+	# a player opens a new table and moves to it
+	def cmd_newtable(self, id, args):
+		if not self.leavetable(id): return
+		with self.game.lock:
+			table = self.game.createtable(args)
+		self.moveto(id, table.id)
+	
+	# a player moves to an existing table
+	def cmd_jointable(self, id, args):
+		try:
+			tableid = int(args)
+		except ValueError:
+			self.tx('orate', "There is no table %s." % args, id)
+			return
+		if tableid not in self.game.tables:
+			self.tx('orate', "There is no table %d." % tableid, id)
+			return
+		if tableid == self.game.seats.get(id): return
+		if not self.leavetable(id): return
+		self.moveto(id, tableid)
+	
+	# send a player to a table
+	# the seating itself happens on that table's shard, and the player's later commands follow it there
+	def moveto(self, id, tableid):
+		self.routes[id] = tableid
+		self.defer(tableid, self.batched, self.seat, id, tableid)
+	
+	# seat a player and bring everyone at that table up to date
+	def seat(self, id, tableid):
+		if id not in self.game.players: return # gone while in transit
+		with self.game.lock:
+			if tableid not in self.game.tables: # closed while in transit
+				tableid = DEFAULT_TABLE_ID
+				self.routes[id] = tableid
+			self.game.seat(id, tableid)
+		table = self.game.tables[tableid]
+		self.tx('seated', (table.id, table.name), id)
+		
+		# the newcomer gets everyone at the table, everyone else just hears about the newcomer
+		# clients that never said hello predate roster, so they're sent newplayer for each instead
+		if id in self.protocols:
+			self.tx('roster', tuple([(pid, player.getname()) for pid, player in table.players.items()]), id)
+		else:
+			for pid, player in table.players.items():
+				if pid != id: self.tx('newplayer', (pid, player.getname()), id)
+		self.tablecast(table, 'newplayer', (id, table.players[id].getname()))
 								
 		# if game is already under way, just pretend the current player rejected the wager
-		if self.game.status != 'forum': self.game.players[id].reject()
-			
-		# tell them to wait if a game is already in progress
-		if self.game.status != 'forum':
+		# and tell them to wait
+		if table.status != 'forum':
+			table.players[id].reject()
 			self.tx('hold', '', id)
 	
+	# get up from the current table, only allowed between games
+	# returns whether the player is now free to sit elsewhere
+	def leavetable(self, id):
+		table = self.game.tableof(id)
+		if table is None: return True
+		if table.status != 'forum':
+			self.tx('orate', "You can only change tables between games.", id)
+			return False
+		with self.game.lock:
+			self.game.unseat(id)
+		self.game.players[id].reset()
+		self.tablecast(table, 'mandown', id)
+		return True
+	
+	###########################
+	### table
+	
 	# if someone announces a newname, broadcast the new name
 	def cmd_newname(self, id, args):
 		name = args
 		self.game.players[id].setname(name)
-		self.broadcast('nameadjust', (id, name))
+		self.tablecast(self.game.tableof(id), 'nameadjust', (id, name))
 			
 	# a wager is made
 	def cmd_wager(self, id, args):
-		if self.game.status != 'forum': return
+		table = self.game.tableof(id)
+		if table.status != 'forum': return
 		
 		# if you proposed the wager, you automatically accept it
-		self.game.players[id].accept()
+		table.players[id].accept()
 		
 		value, color = self.tuple_unpack(args)
-		self.game.wager = Seeds(value, color)
+		table.wager = Seeds(value, color)
 		
-		self.game.status = 'wagering'
-		self.broadcast('wagerontable', (id, value, color))
+		table.status = 'wagering'
+		self.tablecast(table, 'wagerontable', (id, value, color))
 			
 	# if someone accepts, log it and pass along the message to all
 	# if this is the final response, move to the next phase
 	def cmd_accept(self, id, args):
-		if self.game.status != 'wagering': return
-		self.game.players[id].accept()
-		self.broadcast('accepts', id)
-		self.acceptreject_helper() # act on final response
+		table = self.game.tableof(id)
+		if table.status != 'wagering': return
+		table.players[id].accept()
+		self.tablecast(table, 'accepts', id)
+		self.acceptreject_helper(table) # act on final response
 		
 	# if someone rejects log it and pass along the message to all
 	# if this is the final response, move to the next phase		
 	def cmd_reject(self, id, args):
-		if self.game.status != 'wagering': return
-		self.game.players[id].reject()
-		self.broadcast('rejects', id)
-		self.acceptreject_helper() # act on final response
+		table = self.game.tableof(id)
+		if table.status != 'wagering': return
+		table.players[id].reject()
+		self.tablecast(table, 'rejects', id)
+		self.acceptreject_helper(table) # act on final response
 		
 	# if someone sends a message, just relay to all
 	def cmd_message(self, id, args):
 		msg = args
-		outargs = str((id, msg))
-		self.broadcast("messagerelay", outargs)
+		self.tablecast(self.game.tableof(id), "messagerelay", (id, msg))
 
 	# if someone sends a hand, log it, relay it, and if it's the last one we're waiting for, move on
 	def cmd_hand(self, id, args):
-		if self.game.status not in ['round1', 'round2']: return
+		table = self.game.tableof(id)
+		if table.status not in ['round1', 'round2']: return
+		if ROLL_MODE != 'client':
+			logging.warning("Channel %d reported its own hand while the server rolls: %s" % (id, args))
+			return
 		hand = args
-		self.game.players[id].sethand(hand)
-		outargs = str((id, hand))
-		self.broadcast("handrelay", outargs)
+		table.players[id].sethand(hand)
+		self.handin(table, id)
+	
+	# server roll mode - roll for a player, and once they've rolled all they may this round, show the table
+	def cmd_roll(self, id, args):
+		table = self.game.tableof(id)
+		player = table.players[id]
+		if ROLL_MODE != 'server' or not player.accepted() or player.forfeited(): return
+		if not (table.status == 'round1' and player.nrolls() < 2 or table.status == 'round2' and player.nrolls() < 3): return
+		self.tx('rolled', player.roll(table.dice), id)
+		if player.nrolls() in [2, 3]: self.handin(table, id)
+	
+	# a player's hand is in for the round - relay it, and if it's the last one we're waiting for, move on
+	def handin(self, table, id):
+		self.tablecast(table, "handrelay", (id, table.players[id].gethand()))
 		
 		# Round 1:
 		# if this was the last person we're waiting to hear from, then move to response round
-		if self.game.status == 'round1' and self.game.nrolled(2) == self.game.naccepted():
-			self.game.status = 'response'
-			self.broadcast("response")
+		if table.status == 'round1' and table.nrolled(2) == table.naccepted():
+			table.status = 'response'
+			self.tablecast(table, "response")
 		
 		# Round 2
 		# if this was the last person we're waiting to hear from, move to denouement
-		if self.game.status == 'round2' and self.game.nrolled(3) == self.game.nround2():
-			self.game.status = 'denouement'
-			self.broadcast("denouement")
+		if table.status == 'round2' and table.nrolled(3) == table.nround2():
+			table.status = 'denouement'
+			self.tablecast(table, "denouement")
 	
 	# the client has chosen to continue
 	def cmd_continue(self, id, args):
-		if self.game.status != 'response': return
-		self.game.players[id].continue_()
-		self.cfd_helper() # act on final response
+		table = self.game.tableof(id)
+		if table.status != 'response': return
+		table.players[id].continue_()
+		self.cfd_helper(table) # act on final response
 		
 	# the client has chosen to forfeit
 	def cmd_forfeit(self, id, args):
-		if self.game.status != 'response': return
-		self.game.players[id].forfeit()
-		self.cfd_helper() # act on final response
+		table = self.game.tableof(id)
+		if table.status != 'response': return
+		table.players[id].forfeit()
+		self.cfd_helper(table) # act on final response
 		
 	# the client has chosen to double
 	def cmd_double(self, id, args):
-		if self.game.status != 'response': return
-		self.game.players[id].double()
-		self.cfd_helper() # act on final response
+		table = self.game.tableof(id)
+		if table.status != 'response': return
+		table.players[id].double()
+		self.cfd_helper(table) # act on final response
 		
 	# a player submits their contribution
 	# may be different than their debt in case of lots of doubling
 	# can't just relay because ties require arbitration for unequal division of winnings
 	def cmd_contribution(self, id, args):
+		table = self.game.tableof(id)
+		if table.status != 'denouement' or id in table.contributors: return
 		value, color = self.tuple_unpack(args)
-		self.game.players[id].setcontribution(Seeds(value, color))
-		
-		# let all clients know about this contribution
-		# (so they can calculate net earnings later)
-		cr_msg = str((id, value, color))
-		self.broadcast('contributionrelay', cr_msg)
+		self.contribute(table, id, Seeds(value, color))
 		
-		# if all contributions have been reported, calculate final distribution
-		if self.game.ncontributed() == self.game.naccepted():
-			pot = self.game.netcontributions()
-			self.game.calcrankings()
-			
-			winnerids = [player.getid() for player in self.game.winners()]
-			loserids = [player.getid() for player in self.game.losers()]
-			nwinners = self.game.nwinners()
-			
-			# easy if there's just one winner
-			if nwinners == 1:
-				winnerid = winnerids[0]
-				msg1 = ((winnerid, pot.getcount(), pot.getcolor()),)
-			
-			# if pot can be divided evenly, do it
-			elif pot % nwinners == Seeds(0, COLOR_BASE):
-				share = pot / nwinners
-				msg1 = tuple([(id, share.getcount(), share.getcolor()) for id in winnerids])
-			
-			# otherwise, randomly distribute the excess
-			else:
-				lowshare, residue = divmod(pot, nwinners)
-				highshare = lowshare + Seeds(1, COLOR_BASE)
-				lowshare.optimize()
-				highshare.optimize()
-				nhigh = residue.value()
-				winnerids.shuffle()
-				highids = winnerids[:nhigh]
-				lowids = winnerids[night:]
-				highlist = [(id, highshare.getcount(), highshare.getcolor()) for id in highids]
-				lowlist = [(id, lowshare.getcount(), lowshare.getcolor()) for id in lowids]
-				msg1 = tuple(highlist + lowlist)
-			
-			msg2 = tuple([(id, 0, pot.getcolor()) for id in loserids])
-			
-			msg = msg1 + msg2
-			msg = str(msg) # to offset faulty feature of single element tuple string interpolation
-			self.broadcast('spoils', msg)
-			self.broadcast('forum')
-			
-			self.game.status = 'forum'
-			self.game.forumreset()
+		# if all contributions have been reported, hand the game over to be split and put on the books
+		# (counting reports rather than seeds - a forfeit with no doubling owes nothing)
+		if len(table.contributors) == table.naccepted(): self.settle(table)
+	
+	# log a contribution and let all clients know about it (so they can calculate net earnings later)
+	def contribute(self, table, id, contribution):
+		table.players[id].setcontribution(contribution)
+		table.contributors.add(id)
+		self.tablecast(table, 'contributionrelay', (id, contribution.getcount(), contribution.getcolor()))
+	
+	# the table waits in 'settling' until the spoils come back (see settled)
+	def settle(self, table):
+		entries = tuple([(player.getid(), player.getname(), player.getcontribution(), player.getscore()) for player in table.accepted_players()])
+		otherids = tuple([player.getid() for player in table.playerlist() if not player.accepted()])
+		table.status = 'settling'
+		self.settlement.submit(table.id, entries, otherids)
+	
+	# a game's spoils are on the books, back to the table's own shard to announce them
+	def settled(self, tableid, spoils):
+		self.defer(tableid, self.batched, self.announcespoils, tableid, spoils)
+	
+	def announcespoils(self, tableid, spoils):
+		table = self.game.tables.get(tableid)
+		if table is None or table.status != 'settling': return # everyone left
+		
+		# leave out anyone who left while the game was settled, the others have already heard they're gone
+		self.tablecast(table, 'spoils', tuple([entry for entry in spoils if entry[0] in table.players]))
+		self.revealdice(table)
+		self.tablecast(table, 'forum')
+		table.forumreset()
 						
+	# act for whoever a table has waited on for longer than its phase allows
+	def checkturn(self, table):
+		turn = (table.gameno, table.status)
+		if table.turn != turn:
+			table.turn, table.turnstart = turn, time.time()
+			return
+		if table.status not in TURN_TIMEOUTS or time.time() - table.turnstart < TURN_TIMEOUTS[table.status]: return
+		table.turn = None # start the clock again, should anyone still be holding things up afterwards
+		logging.info("Table %d timed out in %s." % (table.id, table.status))
+		
+		# no answer to the wager is a no
+		if table.status == 'wagering':
+			for player in table.playerlist():
+				if player.responded_to_wager(): continue
+				player.reject()
+				self.tablecast(table, 'rejects', player.getid())
+			self.acceptreject_helper(table)
+		
+		# the server rolls whatever hasn't been rolled, with the game's dice if it has its own
+		elif table.status in ['round1', 'round2']:
+			nrolls = 2 if table.status == 'round1' else 3
+			dice = table.dice or DiceRNG()
+			for player in table.accepted_players():
+				if player.forfeited() or player.nrolls() >= nrolls: continue
+				while player.nrolls() < nrolls: player.roll(dice)
+				self.handin(table, player.getid())
+		
+		# no answer to continue, forfeit or double is a forfeit
+		elif table.status == 'response':
+			for player in table.accepted_players():
+				if not player.responded_to_cfd(): player.forfeit()
+			self.cfd_helper(table)
+		
+		# anyone who hasn't paid up is put down for what they owe
+		elif table.status == 'denouement':
+			for player in table.accepted_players():
+				if player.getid() in table.contributors: continue
+				liability = table.getwager() * (table.ndoubled() + 1)
+				if player.forfeited(): liability -= table.getwager()
+				self.contribute(table, player.getid(), liability)
+			self.settle(table)
+	
 	# check / act on final response to accept/reject
-	def acceptreject_helper(self):
-		if self.game.nrespondents() == self.game.nplayers():
-			if self.game.naccepted() >= 2:
-				self.game.status = 'round1'
-				self.nrespondents = 0
-				self.broadcast("round1")
+	def acceptreject_helper(self, table):
+		if table.nrespondents() == table.nplayers():
+			if table.naccepted() >= 2:
+				table.status = 'round1'
+				self.tablecast(table, "round1")
+				if ROLL_MODE != 'client':
+					table.dice = DiceRNG()
+					self.tablecast(table, "dicecommit", table.dice.commitment())
+				if ROLL_MODE == 'batch': self.batchroll(table, 2)
 			else:
-				self.game.status = 'forum'
-				self.game.wager = Seeds(0, COLOR_BASE)
-				self.broadcast("forum")
-				self.game.forumreset()
+				table.status = 'forum'
+				table.wager = Seeds(0, COLOR_BASE)
+				self.tablecast(table, "forum")
+				table.forumreset()
 			
 	# after a continue/forfeit/double checks if everyone has responded
 	# if so, decides appropriate subsequent transmissions
 	# should this be in scope of queue_manager() only?
-	def cfd_helper(self):
-		if self.game.ncfd() == self.game.naccepted():
-			responses = str(tuple([(player.getid(), player.getresponse()) for player in self.game.accepted_players()]))
+	def cfd_helper(self, table):
+		if table.ncfd() == table.naccepted():
+			responses = tuple([(player.getid(), player.getresponse()) for player in table.accepted_players()])
 			# e.g. ((1,'d'), (2, 'f'), (3,'c'))
-			self.broadcast('responses', responses)		
+			self.tablecast(table, 'responses', responses)		
 			
 			# if at least two players are still standing, move to round 2
 			# otherwise, game over (default or no contest)
-			if self.game.nround2() >= 2:
-				self.game.status = 'round2'
-			elif self.game.nround2() == 1:
-				self.game.status = 'denouement'
-				self.broadcast("denouement")
+			if table.nround2() >= 2:
+				table.status = 'round2'
+				if ROLL_MODE == 'batch': self.batchroll(table, 3)
+			elif table.nround2() == 1:
+				table.status = 'denouement'
+				self.tablecast(table, "denouement")
 			else:
-				self.game.status = 'forum'
-				self.game.forumreset()
+				table.status = 'forum'
+				self.revealdice(table)
+				table.forumreset()
+	
+	# batch roll mode - roll everyone still in the game up to nrolls at once, show the table, and move straight on
+	def batchroll(self, table, nrolls):
+		players = [player for player in table.accepted_players() if not player.forfeited()]
+		for player in players:
+			while player.nrolls() < nrolls: player.roll(table.dice)
+		hands = tuple([(player.getid(), player.gethand()) for player in players])
+		
+		# clients that never said hello predate rolls, so they're sent a handrelay for each instead
+		self.newcast(table, 'rolls', hands)
+		legacy = [pid for pid in table.players if pid not in self.protocols]
+		for hand in hands:
+			self.fanout(legacy, 'handrelay', hand)
+		
+		if nrolls == 2:
+			table.status = 'response'
+			self.tablecast(table, "response")
+		else:
+			table.status = 'denouement'
+			self.tablecast(table, "denouement")
+	
+	# the game's over - show everyone the seed of its dice, so they can check the rolls against the commitment
+	def revealdice(self, table):
+		if table.dice is None: return
+		self.tablecast(table, "diceseed", table.dice.seed)
+		table.dice = None
 
 # have chosen Network Interface to be steward of game.status
 # is this a good choice?
@@ -1137,11 +3399,25 @@ class NetworkInterfaceClient(NetworkInterface):
 	
 	def __init__(self, game):
 		self.game = game
+		self.registerhandlers()
+		self.protocols = {} # SERVERID: negotiated wire protocol, text until the server says otherwise
+		self.outboxes = {} # SERVERID: Outbox, or AsyncChannel in async mode
+		self.batching = threading.local() # packets held back by the batch this thread is in
+		self.rolls = Queue.Queue() # rolls the server has made for us, in server roll mode
+		self.started = time.time() # for reporting how long it took to get connected
+		self.latency = None # seconds from startup to the latest connection
+		self.reconnecting = threading.Lock() # held by the background reconnect thread while it's running
+		self.session = None # token to resume our player with if the connection breaks, from servers that offer one
+		self.lastseq = None # how far into our table's transcript we've heard
+		self.laststatus = None # game status when the connection broke, picked up again if we resume
+		self.lastheard = time.time() # when the server last sent us anything
+		self.watchdog_thread = None
 		
 	def start(self):
 		#self.s = '' # socket to be connected
 		#self.rx_thread = '' # rx line thread to be connected
 		self.connections = {} # store of connections - for compatibility with server code
+		self.startflusher()
 		
 		# create the task queue
 		# for client probably unnecessary to use Q, but just in case
@@ -1152,67 +3428,121 @@ class NetworkInterfaceClient(NetworkInterface):
 		self.q_handler_thread.daemon = True # so that it will not attempt to persist when the program terminates
 		self.q_handler_thread.start()
 		
-	# iteration parameter is only used internally for repeated connection attempts
-	def connect(self, iteration = 1):
-		# get IP contenders (localhost, lan ip, www ip)
+	# make one attempt to reach the server, returns whether it succeeded
+	# the remembered server and localhost are tried straight away, while IPS_URL is fetched in the background
+	# and whatever it lists joins the attempt as soon as it arrives
+	def connect(self):
+		began = time.time()
+		discovered = Queue.Queue()
+		fetch_thread = threading.Thread(target = self.fetchips, args = (discovered,), name = 'fetch-ips')
+		fetch_thread.daemon = True # so that it will not attempt to persist when the program terminates
+		fetch_thread.start()
+		
+		ips = ['127.0.0.1']
+		cached = self.cachedserver()
+		if cached is not None: ips.insert(0, cached)
+		sock, ip = probe(ips, BONES_PORT, CONNECT_TIMEOUT, discovered)
+		if sock is None:
+			logging.info("Unable to reach a server (%.0f ms)." % ((time.time() - began) * 1000))
+			return False
+		
+		now = time.time()
+		logging.info("Connected to %s in %.0f ms, %.0f ms since startup." % (ip, (now - began) * 1000, (now - self.started) * 1000))
+		self.latency = now - self.started
+		self.cacheserver(ip)
+		
+		self.attach(sock)
+		self.lastheard = time.time()
+		if self.watchdog_thread is None:
+			self.watchdog_thread = threading.Thread(target = self.watchdog, name = 'watchdog')
+			self.watchdog_thread.daemon = True # so that it will not attempt to persist when the program terminates
+			self.watchdog_thread.start()
+		
+		# offer our wire protocols - older servers ignore this and we carry on in text
+		# then ask for our player back if we had one, otherwise introduce ourselves
+		self.protocols = {}
+		self.tx('hello', PROTOCOL_VERSIONS)
+		if self.session is None:
+			self.game.status = 'forum'
+			self.tx('mynameis', self.game.localplayer().getname())
+		else:
+			self.game.status = self.laststatus
+			self.tx('resume', (self.session, self.lastseq, self.game.localplayer().getname()))
+		return True
+	
+	# look up the server's posted IPs, feeding them to the queue as they're found and None when done
+	def fetchips(self, discovered):
 		try: # locate servers
-			ips = urllib2.urlopen(IPS_URL).read().split()
-		except: # if unable to open IPS_URL, localhost is our only shot
+			ips = urllib2.urlopen(IPS_URL, timeout = IPS_URL_TIMEOUT).read().split()
+		except: # if unable to open IPS_URL, the remembered server and localhost are our only shot
 			logging.warning("Unable to access IPs @ %s" % IPS_URL)
-			logging.warning("Only eligible IP is localhost.")
-			ips = ['127.0.0.1']
-		
-		#debug
-		print ips
-		
-		# try sequentially to open a host on said IP
-		success = False
-		for ip in ips:
-			# using create_connection instead of connect because of timeout, otherwise it's eternal
-			try:
-				# timeout after 300ms
-				# sock = socket.create_connection((ip, BONES_PORT), 0.3) # equivalent?
-				sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				sock.settimeout(0.3)
-				sock.connect((ip, BONES_PORT))
-				success = True
-				break
-			except: # socket.timeout, socket.error:
-				continue
+			ips = []
+		for ip in ips: discovered.put(ip)
+		discovered.put(None)
 	
-		# if there's a failure to connect, try up to three more time
-		# 5 seconds later, then 20 seconds later, then 60 seconds later
-		# configurable in constants
-		if not success:
-			if iteration == MAX_RECONNECT_ITERATIONS + 1:
-				msg = "Unable to connect to server after %d attempts.\n" % iteration
-				msg += "Terminating program..."
-				self.game.ui.msg(msg, newprompt = False)
-				logging.info("Failed to connect to server after %d attempts." % iteration)
-				time.sleep(10) # so the user can see the message
-				# for some reason sys.exit() doesn't work here
-				sys.exit()
-				
-			delay = RECONNECT_DELAYS[iteration]
-			msg = "Unable to connect to bones server.\n"
-			msg += "Attempting reconnect in %d seconds." % delay
-			self.game.ui.msg(msg, newprompt = False)
-			time.sleep(delay)
-			self.connect(iteration = iteration + 1)
-			return
+	# the last server we reached, if it's recent enough to be worth trying
+	def cachedserver(self):
+		try:
+			with open(SERVER_CACHE_FNAME) as fp:
+				ip, stamp = fp.read().split()
+			if time.time() - float(stamp) < SERVER_CACHE_TTL: return ip
+		except (IOError, ValueError):
+			pass
+		return None
+	
+	def cacheserver(self, ip):
+		try:
+			with open(SERVER_CACHE_FNAME, 'w') as fp:
+				fp.write("%s %f" % (ip, time.time()))
+		except IOError:
+			logging.warning("Unable to remember server in %s" % SERVER_CACHE_FNAME)
+	
+	# keep trying to connect in the background, backing off exponentially with jitter
+	# a no-op if a reconnect thread is already at it
+	def reconnect(self):
+		if not self.reconnecting.acquire(False): return
+		reconnect_thread = threading.Thread(target = self.reconnect_loop, name = 'reconnect')
+		reconnect_thread.daemon = True # so that it will not attempt to persist when the program terminates
+		reconnect_thread.start()
+	
+	def reconnect_loop(self):
+		try:
+			delay = RECONNECT_BASE_DELAY
+			for attempt in xrange(MAX_RECONNECT_ATTEMPTS):
+				wait = delay * random.uniform(1 - RECONNECT_JITTER, 1 + RECONNECT_JITTER)
+				msg = "Unable to connect to bones server.\n"
+				msg += "Attempting reconnect in %.1f seconds." % wait
+				self.game.ui.msg(msg)
+				time.sleep(wait)
+				if self.connect():
+					self.game.ui.msg("You have been connected to the server.")
+					return
+				delay = min(delay * 2, RECONNECT_MAX_DELAY)
+			self.game.ui.msg("Unable to connect to server after %d attempts." % (attempt + 1))
+			logging.info("Failed to connect to server after %d attempts." % (attempt + 1))
+		finally:
+			self.reconnecting.release()
 			
-		sock.settimeout(None) # no timeout anymore
-		
+	# a server that speaks a protocol pings us, so if it's gone quiet the connection is dead even if TCP hasn't noticed
+	# cutting it off breaks it the usual way, and we reconnect
+	# runs as thread
+	def watchdog(self):
+		while True:
+			time.sleep(TURN_CHECK_INTERVAL)
+			if SERVERID not in self.protocols or time.time() - self.lastheard <= HEARTBEAT_TIMEOUT: continue
+			outbox = self.outboxes.get(SERVERID)
+			if outbox is None: continue
+			logging.info("Server has not been heard from in %d seconds - disconnecting." % (time.time() - self.lastheard))
+			self.lastheard = time.time()
+			outbox.abandon()
+	
+	# start listening to a freshly connected server socket
+	def attach(self, sock):
 		rx_thread = threading.Thread(target = self.rx, args = (SERVERID, sock), name = 'rxclient')
+		self.outboxes[SERVERID] = Outbox(sock)
+		self.connections[SERVERID] = (rx_thread, sock, sock.getpeername())
 		rx_thread.start()
 		
-		#TODO get sockdetails		
-		self.connections[SERVERID] = (rx_thread, sock, 'sockdetails - should be here!')
-		
-		self.game.status = 'forum'
-		
-		self.tx('mynameis', self.game.localplayer().getname())
-					
 	# USER DEFINED 
 	
 	def sendwager(self, count, color):
@@ -1228,9 +3558,22 @@ class NetworkInterfaceClient(NetworkInterface):
 		self.tx('newname', name)
 	
 	def messageall(self, msg): self.tx('message', msg)
+	
+	def listtables(self): self.tx('tables')
+	def balance(self, name): self.tx('balance', name)
+	def newtable(self, name): self.tx('newtable', name)
+	def jointable(self, tableid): self.tx('jointable', tableid)
 		
 	def hand(self, hand): self.tx('hand', hand)
 	
+	# ask the server to roll for us, returns the roll or None if it didn't answer in time
+	def roll(self):
+		self.tx('roll')
+		try:
+			return self.rolls.get(timeout = ROLL_TIMEOUT)
+		except Queue.Empty:
+			return None
+	
 	# name mangled - continue is python keyword
 	def continue_(self): self.tx('continue')
 	def forfeit(self): self.tx('forfeit')
@@ -1243,18 +3586,61 @@ class NetworkInterfaceClient(NetworkInterface):
 		self.game.ui.msg(msg)
 		
 		del self.connections[id]
-		self.connect()
-		self.game.ui.msg("You have been reconnected to the server.")
+		self.outboxes.pop(id, None)
+		self.laststatus = self.game.status
+		self.game.status = 'disconnected'
+		self.reconnect()
 		
 	def command_handler(self, id, command, args):
-		try:
-			handler = eval('self.cmd_%s' % command)
-		except:
+		handler = self.handlers.get(command)
+		if handler is None:
 			logging.warning("Channel " + str(id) + " unrecognized rx command: " + str((command,args)))
+			return
+		self.lastheard = time.time()
 		handler(id, args)
+	
+	def cmd_ping(self, id, args):
+		self.tx('pong')
+		
+	# the server picked a wire protocol from the ones we offered in hello
+	def cmd_protocol(self, id, args):
+		self.protocols[SERVERID] = int(args)
+	
+	# whether we roll our own dice or the server rolls them for us
+	def cmd_rollmode(self, id, args):
+		self.game.rollmode = args
+	
+	# the server rolled for us
+	def cmd_rolled(self, id, args):
+		self.game.localplayer().addroll(args)
+		self.rolls.put(args)
+	
+	def cmd_dicecommit(self, id, args):
+		self.game.dicecommit = args
+	
+	# the server rolled for everyone this round - show our own rolls as they would have come
+	def cmd_rolls(self, id, args):
+		for pid, hand in self.tuple_unpack(args):
+			player = self.game.players[pid]
+			if pid == self.game.localplayerid:
+				for nrolls in xrange(player.nrolls() + 1, len(hand) + 1):
+					self.game.ui.showroll(nrolls, hand[nrolls - 1])
+			player.sethand(hand)
+	
+	# the game's over and the server shows the seed of its dice - check everyone's rolls against it
+	def cmd_diceseed(self, id, args):
+		dice = DiceRNG(args)
+		forged = dice.commitment() != self.game.dicecommit
+		for player in self.game.accepted_players():
+			hand = player.gethand().replace('X', '')
+			if hand and hand != ''.join(dice.rolls(player.getid(), len(hand))): forged = True
+		if forged: self.game.ui.msg("Warning: the server's dice don't match what it committed to this game!")
+		self.game.dicecommit = None
 		
 	# clients is assigned an ID
+	# as a newcomer - any session we had is gone
 	def cmd_assignID(self, id, args):
+		self.session = None
 		oldid = self.game.localplayer().getid()
 		newid = int(args)
 		
@@ -1262,6 +3648,49 @@ class NetworkInterfaceClient(NetworkInterface):
 		self.game.localplayerid = newid
 		self.game.players[newid] = self.game.players.pop(oldid)
 					
+	# the token to resume our player with
+	def cmd_session(self, id, args):
+		self.session = args
+	
+	# how far into the table's transcript we are, sent after every batch of table messages
+	def cmd_seq(self, id, args):
+		self.lastseq = int(args)
+	
+	# we've got our player back - catch up on the table messages we missed
+	def cmd_delta(self, id, args):
+		missed = self.tuple_unpack(args)
+		self.game.ui.msg("Reconnected to the game, %d table message%s missed." % (len(missed), '' if len(missed) == 1 else 's'))
+		for command, commandargs in missed:
+			self.command_handler(id, command, commandargs)
+	
+	# you've been seated at a table - forget the players at any previous table
+	def cmd_seated(self, id, args):
+		self.lastseq = None # a new table, a new transcript
+		tableid, name = self.tuple_unpack(args)
+		for pid in self.game.players.keys():
+			if pid != self.game.localplayerid: self.game.removeplayer(pid)
+		self.game.tableid, self.game.tablename = tableid, name
+		self.game.status = 'forum'
+		self.game.forumreset()
+		self.game.ui.msg("You are seated at table %d (%s)." % (tableid, name))
+	
+	# the lobby's list of tables
+	def cmd_tablelist(self, id, args):
+		tables = self.tuple_unpack(args)
+		lines = 'Tables:\n'
+		for tableid, name, nplayers, status in tables:
+			lines += " %3d | %s (%d players, %s)\n" % (tableid, name, nplayers, status)
+		self.game.ui.msg(lines[:-1])
+	
+	# the ledger's account of a player
+	def cmd_balanceis(self, id, args):
+		name, net, ngames = self.tuple_unpack(args)
+		if ngames == 0:
+			self.game.ui.msg("%s hasn't finished a game yet." % name)
+			return
+		self.game.ui.msg("%s is %s %s over %d game%s." % \
+			(name, 'up' if net >= 0 else 'down', Seeds.ofvalue(abs(net)), ngames, 's' if ngames > 1 else ''))
+	
 	# you've just connected and the server reports the status of the current game
 	# if it's anything other than forum, you've just joined mid-game
 	# pretend you've been here all along, but rejected the wager for the present game
@@ -1276,9 +3705,20 @@ class NetworkInterfaceClient(NetworkInterface):
 			return
 		newplayer = Player(name)
 		newplayer.setid(id)
-		self.game.players[id] = newplayer
+		self.game.addplayer(newplayer)
 		self.game.ui.msg("%s has joined the game." % name)
 					
+	# everyone at the table we just sat down at, ourselves included
+	def cmd_roster(self, id, args):
+		names = []
+		for pid, name in self.tuple_unpack(args):
+			if pid in self.game.players: continue
+			player = Player(name)
+			player.setid(pid)
+			self.game.addplayer(player)
+			names.append(name)
+		if names: self.game.ui.msg("At the table: %s." % ', '.join(names))
+	
 	# if someone has changed their name, synch
 	def cmd_nameadjust(self, id, args):
 		id, newname = self.tuple_unpack(args)
@@ -1313,7 +3753,12 @@ class NetworkInterfaceClient(NetworkInterface):
 	# someone rejects the wager, will actually log if necessary
 	def cmd_rejects(self, id, args):
 		id = int(args)
-		if id == self.game.localplayerid: return
+		if id == self.game.localplayerid:
+			# the server answers for us if we take too long
+			if not self.game.localplayer().rejected():
+				self.game.localplayer().reject()
+				self.game.ui.msg("You didn't answer in time, so the wager was rejected for you.")
+			return
 		name = self.game.players[id].getname()
 		self.game.players[id].reject()
 		self.game.ui.msg("%s rejects the wager." % name)
@@ -1345,11 +3790,14 @@ class NetworkInterfaceClient(NetworkInterface):
 	# there were at least two takers on a wager: proceed to round1
 	def cmd_round1(self, id, args):
 		self.game.status = 'round1'
+		if self.game.rollmode == 'client': self.game.dice = DiceRNG()
 		
 		playernames = [player.getname() for player in self.game.accepted_players()]
 		
 		line1 = "Wager of %s has been accepted by %s.\n" % (self.game.wager, self.verballist(playernames))
-		if self.game.localplayer().accepted():
+		if self.game.localplayer().accepted() and self.game.rollmode == 'batch':
+			line2 = "Let the games begin! The bones are rolling..."
+		elif self.game.localplayer().accepted():
 			line2 = "Let the games begin! All players roll your bones!"
 		else: # rejected
 			line2 = "You will now watch them play..."
@@ -1360,6 +3808,8 @@ class NetworkInterfaceClient(NetworkInterface):
 	# redundantly overwrites own, but who cares?
 	def cmd_handrelay(self, id, args): # maybe cache these until appropriate state transition
 		id, hand = self.tuple_unpack(args)
+		if id == self.game.localplayerid and len(hand) > len(self.game.players[id].gethand()) and self.game.rollmode == 'client':
+			self.game.ui.msg("You didn't roll in time, so the server rolled for you: %s" % hand)
 		self.game.players[id].sethand(hand)
 						
 	# everyone has rolled in round1, we're moving to the response round
@@ -1396,6 +3846,8 @@ class NetworkInterfaceClient(NetworkInterface):
 		lines = ''
 		for pid, response in responses:
 			player = self.game.players[pid]
+			if pid == self.game.localplayerid and response == 'f' and not player.forfeited():
+				lines += "You didn't answer in time, so you forfeited.\n"
 			if response == 'c': player.continue_()
 			if response == 'f': player.forfeit()
 			if response == 'd': player.double()
@@ -1449,8 +3901,7 @@ class NetworkInterfaceClient(NetworkInterface):
 			short = liability - contribution
 			self.game.ui.msg("You're short %s!" % short)
 		
-		arg_tuple = str((contribution.getcount(), contribution.getcolor()))
-		self.tx("contribution", arg_tuple)
+		self.tx("contribution", (contribution.getcount(), contribution.getcolor()))
 		
 	# letting us know about other players' contributions
 	# redundantly overwrites own, but who cares?
@@ -1477,11 +3928,22 @@ class NetworkInterfaceClient(NetworkInterface):
 		self.game.forumreset()
 		self.game.status = 'forum'
 						
+	# someone's connection broke, the game waits a while for them to come back
+	def cmd_playeraway(self, id, args):
+		pid, grace = self.tuple_unpack(args)
+		if pid == self.game.localplayerid: return
+		self.game.ui.msg("%s has lost their connection. Holding their seat for %d seconds." % (self.game.players[pid].getname(), grace))
+	
+	def cmd_playerback(self, id, args):
+		pid = int(args)
+		if pid == self.game.localplayerid: return
+		self.game.ui.msg("%s is back." % self.game.players[pid].getname())
+	
 	# someone's gone. Remove them from the game and reset.
 	def cmd_mandown(self, id, args):
 		id = int(args)
 		self.game.ui.msg("%s has left the game. Resetting to forum phase." % self.game.players[id].getname())
-		del self.game.players[id]
+		self.game.removeplayer(id)
 		# presumably a forum reset will come from the server shortly
 		
 	###########################
@@ -1565,6 +4027,149 @@ class NetworkInterfaceClient(NetworkInterface):
 		
 		return table
 
+# asyncore channel for a single connection, server or client side
+# outgoing data is buffered and written only as the socket drains, so a slow peer never blocks the sender
+# incoming data is framed and routed straight to the network interface's command_handler
+class AsyncChannel(asynchat.async_chat):
+	
+	def __init__(self, ni, id, sock):
+		asynchat.async_chat.__init__(self, sock, map = ni.asyncmap)
+		nodelay(sock)
+		self.ni = ni
+		self.id = id
+		self.decoder = FrameDecoder(limit = ni.rxlimit)
+		self.nbytes = 0 # queued but not yet sent
+		self.broken = False
+		self.lock = threading.Lock() # client CLI thread may push while the loop thread writes
+		self.set_terminator(None) # framing is done by FrameDecoder
+	
+	def collect_incoming_data(self, data):
+		self.decoder.feed(data)
+		try:
+			packets = self.decoder.packets()
+		except Exception: # malformed, already logged - nothing after it can be trusted
+			self.ni.cutoff(self.id, "sent a malformed packet")
+			return
+		for command, args in packets:
+			if self.broken: return # cut off part way through
+			self.ni.logrx(self.id, command, args)
+			try:
+				self.ni.command_handler(self.id, command, args)
+			except: # as in the select loop, rather than let handle_error cut the sender off
+				logging.exception("Unhandled error on channel %d." % self.id)
+		if self.decoder.overflowing(): self.ni.cutoff(self.id, "overflowed its receive buffer")
+	
+	def found_terminator(self): pass
+	
+	def initiate_send(self):
+		with self.lock:
+			asynchat.async_chat.initiate_send(self)
+	
+	# Outbox interface - asynchat does the buffering and writes as the socket drains
+	def put(self, packet):
+		self.nbytes += len(packet)
+		self.push(packet)
+		return self.nbytes
+	def flush(self): return True
+	def abandon(self):
+		self.discard_buffers()
+		self.handle_close()
+	
+	def send(self, data):
+		nsent = asynchat.async_chat.send(self, data)
+		self.nbytes -= nsent
+		return nsent
+	
+	def handle_close(self):
+		self.close()
+		if self.broken: return
+		self.broken = True
+		self.ni.broken_connection(self.id)
+	
+	def handle_error(self):
+		logging.exception("Indeterminate socket problem on channel %d." % self.id)
+		self.handle_close()
+
+# asyncore dispatcher accepting incoming connections for AsyncNetworkInterfaceServer
+class AsyncListener(asyncore.dispatcher):
+	
+	def __init__(self, ni):
+		asyncore.dispatcher.__init__(self, map = ni.asyncmap)
+		self.ni = ni
+		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.bind(('', BONES_PORT))
+		self.listen(MAX_CLIENTS)
+	
+	def handle_accept(self):
+		pair = self.accept()
+		if pair is None: return # connection vanished before accept
+		sock, sockdetails = pair
+		if not self.ni.admit(sock, sockdetails): return
+		channel = AsyncChannel(self.ni, self.ni.nextid, sock)
+		self.ni.register(channel, sockdetails, outbox = channel)
+
+# asyncore dispatcher that runs the calls other threads defer to an async server's loop thread
+class AsyncWaker(asyncore.dispatcher):
+	
+	def __init__(self, ni):
+		asyncore.dispatcher.__init__(self, ni.wakereader, map = ni.asyncmap)
+		self.ni = ni
+	
+	def writable(self): return False
+	def handle_read(self): self.ni.runcalls()
+
+# run the asyncore loop over a socket map forever, idling while there are no channels to service
+# every interface has a map of its own, so that no two loop threads ever service the same socket
+def asyncloop(map):
+	while True:
+		asyncore.loop(SELECT_TIMEOUT, use_poll = hasattr(select, 'poll'), map = map)
+		time.sleep(SELECT_TIMEOUT)
+
+# server network interface running every connection on one asyncore loop thread
+# same wire protocol and cmd_ handlers as NetworkInterfaceServer
+class AsyncNetworkInterfaceServer(NetworkInterfaceServer):
+	
+	def start(self):
+		
+		logging.info("Launching server...")
+		self.launched = time.time()
+		
+		# format of a connection is connectionID: (None, channel, socketDetails)
+		self.connections = {}
+		self.nextid = 1 + SERVERID # start at 1 - 0 reserved for server
+		
+		self.asyncmap = {} # fd: channel, for this interface's loop only
+		self.listener = AsyncListener(self)
+		self.wakereader, self.wakewriter = wakepair()
+		self.waker = AsyncWaker(self)
+		self.settlement.start()
+		logging.info("Async connection hub activated...")
+		
+		self.loop_thread = self.loopthread = threading.Thread(target = asyncloop, args = (self.asyncmap,), name = 'async_loop')
+		self.loop_thread.daemon = True # so that it will not attempt to persist when the program terminates
+		self.loop_thread.start()
+		self.startdiscovery()
+		self.startwatchdog()
+
+# client network interface handling the server connection on an asyncore loop thread
+# same wire protocol and cmd_ handlers as NetworkInterfaceClient
+class AsyncNetworkInterfaceClient(NetworkInterfaceClient):
+	
+	def start(self):
+		self.connections = {} # store of connections - for compatibility with server code
+		self.asyncmap = {} # fd: channel, for this interface's loop only
+		self.loop_thread = None
+	
+	# wrap the connected socket in a channel and make sure the loop is running
+	def attach(self, sock):
+		channel = AsyncChannel(self, SERVERID, sock)
+		self.outboxes[SERVERID] = channel
+		self.connections[SERVERID] = (None, channel, sock.getpeername())
+		if self.loop_thread is None:
+			self.loop_thread = threading.Thread(target = asyncloop, args = (self.asyncmap,), name = 'async_loop')
+			self.loop_thread.daemon = True # so that it will not attempt to persist when the program terminates
+			self.loop_thread.start()
+
 # command line interface for client
 class CLI(cmd.Cmd):
 	def __init__(self, game):
@@ -1572,6 +4177,7 @@ class CLI(cmd.Cmd):
 		self.prompt = CLI_PROMPT
 		self.fastroll = False
 		self.game = game
+		self.flair = random.Random() # for show only, kept apart from the dice
 		
 	def start(self):
 		print INTRO_ART
@@ -1587,7 +4193,10 @@ class CLI(cmd.Cmd):
 		self.do_deposit(' '.join([y, r, b, g]))
 		
 		print "\nConnecting to server..."
-		self.game.ni.connect()
+		if self.game.ni.connect():
+			print "Connected in %.2f seconds." % self.game.ni.latency
+		else: # carry on while we keep trying in the background
+			self.game.ni.reconnect()
 		
 		# consolidated print in case interrupted by message rx
 		msg  = "\n"
@@ -1768,6 +4377,10 @@ class CLI(cmd.Cmd):
 			print "It does not make sense to roll at this time..."
 			return # comment out to allow testing of roll during forum phase
 		
+		if self.game.rollmode == 'batch':
+			print "The server rolls everyone's bones at once, just watch..."
+			return
+		
 		# how many rolls have happened so far?
 		nrolls = self.game.localplayer().nrolls()
 		
@@ -1781,9 +4394,23 @@ class CLI(cmd.Cmd):
 			print "Easy there, %s. Three rolls is all you get..." % TIGER_WORD
 			return
 			
-		result = self.game.localplayer().roll()
+		if self.game.rollmode == 'server':
+			result = self.game.ni.roll()
+			if result is None:
+				print "The server didn't roll for you, try again..."
+				return
+		else:
+			result = self.game.localplayer().roll(self.game.dice)
 		nrolls += 1
+		self.showroll(nrolls, result)
 		
+		# if two rolls (end of round1) or three rolls (end of round2) have occurred,
+		# tell the server the hand (unless it rolled them)
+		if nrolls in [2, 3] and self.game.rollmode == 'client':
+			self.game.ni.hand(self.game.localplayer().gethand())
+
+	# announce and animate a player's nth roll
+	def showroll(self, nrolls, result):
 		if nrolls == 1:
 			print "First roll..."	
 		elif nrolls == 2:
@@ -1792,12 +4419,7 @@ class CLI(cmd.Cmd):
 			print "Final roll..."
 			
 		self.animateroll(DIE_COLOR_LUT[result], self.fastroll)
-		
-		# if two rolls (end of round1) or three rolls (end of round2) have occurred,
-		# tell the server the hand
-		if nrolls in [2, 3]:
-			self.game.ni.hand(self.game.localplayer().gethand())
-
+	
 	def do_r(self, args):
 		if self.game.status == 'wagering':
 			self.do_reject(args)
@@ -1857,6 +4479,68 @@ class CLI(cmd.Cmd):
 		self.game.ni.messageall(msg)
 	do_m = do_message	
 	
+	# list the tables on the server
+	def do_tables(self, args): self.game.ni.listtables()
+	
+	# open a new table and move to it
+	def do_newtable(self, args):
+		if self.game.status != 'forum':
+			print "You can only change tables between games..."
+			return
+		name = args.replace('|','') or "%s's table" % self.game.localplayer().getname()
+		self.game.ni.newtable(name)
+	
+	# move to another table
+	def do_join(self, args):
+		if self.game.status != 'forum':
+			print "You can only change tables between games..."
+			return
+		try:
+			tableid = int(args)
+		except ValueError:
+			print "Need a table number (see tables)..."
+			return
+		self.game.ni.jointable(tableid)
+	
+	# how someone has done over every game the server has settled
+	def do_balance(self, args): self.game.ni.balance(args.replace('|',''))
+	
+	# your chances in the current game, given every hand known so far
+	def do_odds(self, args):
+		me = self.game.localplayer()
+		if self.game.status in ['forum', 'wagering', 'hold', 'disconnected']:
+			others = [''] * (self.game.nplayers() - 1) # assume everyone plays
+		elif me.accepted():
+			others = [player.gethand() for player in self.game.accepted_players() if player is not me]
+		else:
+			print "You're sitting this one out..."
+			return
+		if not others:
+			print "There's no one to play against yet..."
+			return
+		
+		win, tie, share = self.game.odds.against(me.gethand(), others)
+		print "Against %d other player%s: win %.1f%%, tie %.1f%%, expected share of the pot %.1f%%" % \
+			(len(others), 's' if len(others) > 1 else '', win * 100, tie * 100, share * 100)
+		dist = self.game.odds.scoredist(me.gethand())
+		print "Your final score: " + ', '.join(["%d: %.1f%%" % (score, dist[score] * 100) for score in sorted(dist)])
+	
+	# the best continue/forfeit/double response to the hands on the table
+	def do_hint(self, args):
+		me = self.game.localplayer()
+		if self.game.status != 'response' or not me.accepted():
+			print "Hints are for the response phase..."
+			return
+		if me.responded_to_cfd():
+			print "You already chose to %s." % RESPONSE_STATUS_LUT[me.getresponse()]
+			return
+		
+		others = [player.gethand() for player in self.game.accepted_players() if player is not me]
+		response, ev = self.game.policy.hint(me.gethand(), others)
+		print "Best response: %s (expected result %+.2f times the wager)" % (RESPONSE_STATUS_LUT[response], ev)
+		if response == 'd' and self.game.getwager().value() * 2 > me.bank.value():
+			print "...but you can't afford to double."
+	
 	
 	###############################
 	### DEBUG / TESTING COMMANDS
@@ -1876,8 +4560,8 @@ class CLI(cmd.Cmd):
 
 	# connect to the server
 	def _do_connect(self, args):
-		if self.game.status == 'disconnected':
-			self.game.ni.connect()
+		if self.game.status == 'disconnected' and not self.game.ni.connect():
+			self.game.ni.reconnect()
 		#print "Connected to server..."
 		
 	# disconnect from the server
@@ -2055,6 +4739,30 @@ class CLI(cmd.Cmd):
 		print "syntax: message [message]"
 		print "-- send a message to all other players"
 		
+	def help_tables(self):
+		print "syntax: tables"
+		print "-- lists the tables on the server"
+	
+	def help_newtable(self):
+		print "syntax: newtable [name]"
+		print "-- opens a new table and seats you at it"
+	
+	def help_join(self):
+		print "syntax: join [table #]"
+		print "-- moves you to another table between games"
+		
+	def help_balance(self):
+		print "syntax: balance [name]"
+		print "-- how much you (or name) have won or lost over every game played on this server"
+		
+	def help_odds(self):
+		print "syntax: odds"
+		print "-- your chances of winning, given the hands known so far"
+		
+	def help_hint(self):
+		print "syntax: hint"
+		print "-- suggests whether to continue, forfeit, or double"
+		
 	def help_rules(self):
 		print "Rules of BONES."
 		print " Forum Phase: Someone makes a wager. Other players accept or reject it."
@@ -2113,7 +4821,7 @@ class CLI(cmd.Cmd):
 			
 			# loop until this iteration we get a color that was different from last time
 			while True:
-				new = random.choice(DIE_COLOR_NAMES)
+				new = self.flair.choice(DIE_COLOR_NAMES)
 				if new != old: break
 			
 			# update the animation, then wait
@@ -2126,6 +4834,9 @@ class CLI(cmd.Cmd):
 # run as client if this program is run
 # to run as server use server launch script
 if __name__ == "__main__":
-	game = GameClient()
-	game.start()
+	if sys.argv[1:2] == ['simulate']:
+		simulation_report(sys.argv[2:])
+	else:
+		game = GameClient()
+		game.start()
 
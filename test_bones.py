@@ -0,0 +1,151 @@
+# bones tests - run with: python -m unittest test_bones
+# FrameDecoder: every stream is fed split at every byte (and a byte at a time), so a packet may arrive in any number of pieces
+
+import logging
+import random
+import socket
+import unittest
+
+import bones
+
+# a mix of text and binary frames, with args that look like framing and args bigger than the initial buffer
+FRAMES = [
+	('text', 'forum', ''),
+	('binary', 'wagerontable', (1, 5, 'y')),
+	('text', 'message', 'a:b|c::|'),
+	('binary', 'forum', ''),
+	('text', 'handrelay', (2, 'RBG')),
+	('binary', 'message', 'x' * 5000),
+	('binary', 'tablelist', ((1, 'main', 3, 'forum'), (2, 'carols', -1, None), (300, '', True, False))),
+	('text', 'message', 'y' * 5000),
+	('binary', 'spoils', ((1, 20, 'y'), (2, 0, 'y'))),
+	('text', 'mynameis', 'Bob'),
+]
+
+def encode(kind, command, args):
+	if kind == 'binary': return bones.binaryframe(command, args)
+	args = str(args)
+	return "%s:%d:%s|" % (command, len(args), args)
+
+# text args arrive as the string that was sent, binary ones already decoded
+def expected(kind, command, args):
+	if kind == 'binary': return command, args
+	return command, str(args)
+
+STREAM = ''.join([encode(*frame) for frame in FRAMES])
+EXPECTED = [expected(*frame) for frame in FRAMES]
+
+class FrameDecoderTest(unittest.TestCase):
+
+	def setUp(self): logging.disable(logging.CRITICAL) # malformed input is logged as well as raised
+	def tearDown(self): logging.disable(logging.NOTSET)
+
+	def feed(self, decoder, pieces):
+		packets = []
+		for piece in pieces:
+			decoder.feed(piece)
+			packets.extend(decoder.packets())
+		return packets
+
+	def test_whole_stream(self):
+		decoder = bones.FrameDecoder()
+		self.assertEqual(self.feed(decoder, [STREAM]), EXPECTED)
+		self.assertEqual(len(decoder), 0)
+
+	def test_split_at_every_byte(self):
+		for i in xrange(len(STREAM) + 1):
+			decoder = bones.FrameDecoder(size = 16)
+			self.assertEqual(self.feed(decoder, [STREAM[:i], STREAM[i:]]), EXPECTED, "split at %d" % i)
+			self.assertEqual(len(decoder), 0)
+
+	def test_byte_at_a_time(self):
+		decoder = bones.FrameDecoder(size = 16)
+		self.assertEqual(self.feed(decoder, list(STREAM)), EXPECTED)
+
+	def test_random_pieces(self):
+		rng = random.Random(0)
+		for trial in xrange(200):
+			cuts = sorted(rng.sample(xrange(1, len(STREAM)), rng.randint(1, 40)))
+			pieces = [STREAM[i:j] for i, j in zip([0] + cuts, cuts + [len(STREAM)])]
+			self.assertEqual(self.feed(bones.FrameDecoder(size = 64), pieces), EXPECTED)
+
+	def test_recv_into(self):
+		near, far = socket.socketpair()
+		near.settimeout(1)
+		far.sendall(STREAM) # taken RX_CHUNK_SIZE at a time
+		decoder = bones.FrameDecoder(size = 16)
+		packets = []
+		while len(packets) < len(EXPECTED):
+			self.assertTrue(decoder.recv_into(near))
+			packets.extend(decoder.packets())
+		near.close()
+		far.close()
+		self.assertEqual(packets, EXPECTED)
+
+	def test_malformed_length(self):
+		decoder = bones.FrameDecoder()
+		decoder.feed('forum:x:|')
+		self.assertRaises(Exception, decoder.packets)
+
+	def test_missing_pipe(self):
+		decoder = bones.FrameDecoder()
+		decoder.feed('message:2:hi!')
+		self.assertRaises(Exception, decoder.packets)
+
+	def test_unknown_opcode(self):
+		decoder = bones.FrameDecoder()
+		decoder.feed(chr(bones.BINARY_MARKER) + chr(len(bones.OPCODES)) + '\x00')
+		self.assertRaises(Exception, decoder.packets)
+
+	def test_good_packets_before_malformed_one(self):
+		decoder = bones.FrameDecoder()
+		decoder.feed(encode('text', 'forum', '') + encode('binary', 'forum', ''))
+		self.assertEqual(decoder.packets(), [('forum', ''), ('forum', '')])
+		decoder.feed('forum:x:|')
+		self.assertRaises(Exception, decoder.packets)
+
+	def test_oversized_text_packet(self):
+		decoder = bones.FrameDecoder(limit = 100)
+		decoder.feed('message:1000:' + 'z' * 50)
+		self.assertEqual(decoder.packets(), [])
+		self.assertFalse(decoder.overflowing())
+		decoder.feed('z' * 100)
+		self.assertEqual(decoder.packets(), [])
+		self.assertTrue(decoder.overflowing())
+
+	def test_oversized_binary_packet(self):
+		frame = encode('binary', 'message', 'z' * 1000)
+		decoder = bones.FrameDecoder(limit = 100)
+		decoder.feed(frame[:50])
+		self.assertEqual(decoder.packets(), [])
+		self.assertFalse(decoder.overflowing())
+		decoder.feed(frame[50:200])
+		self.assertEqual(decoder.packets(), [])
+		self.assertTrue(decoder.overflowing())
+
+	def test_limit_counts_only_unparsed_bytes(self):
+		decoder = bones.FrameDecoder(limit = 100)
+		for i in xrange(50):
+			decoder.feed(encode('text', 'message', 'hello'))
+			decoder.packets()
+			self.assertFalse(decoder.overflowing())
+
+	def test_no_limit(self):
+		decoder = bones.FrameDecoder()
+		decoder.feed('message:1000000:' + 'z' * 100000)
+		self.assertEqual(decoder.packets(), [])
+		self.assertFalse(decoder.overflowing())
+
+class SeedsTest(unittest.TestCase):
+
+	# the intern table mustn't let through what construction would refuse (1.0 == 1)
+	def test_non_integer_count_after_interning(self):
+		bones.Seeds(1, 'y')
+		self.assertRaises(Exception, bones.Seeds, 1.0, 'y')
+		self.assertRaises(Exception, bones.Seeds, 1, 'purple')
+
+	def test_interned(self):
+		self.assertTrue(bones.Seeds(3, 'r') is bones.Seeds(3, 'r'))
+
+if __name__ == '__main__':
+	unittest.main()